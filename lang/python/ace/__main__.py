@@ -17,11 +17,13 @@ import numpy as np
 from google.protobuf import json_format
 from grpc_health.v1 import health_pb2, health_pb2_grpc
 
-from ace import aceclient, analytic_pb2, analyticservice, grpcservice
+from ace import aceclient, analytic_pb2, analyticservice, grpcservice, resultsink
+from ace.balancer import ReplicaPool
+from ace.joiner import JoinService
 from ace.rtsp import RTSPHandler
 from ace.streamproxy import StreamingProxy, TestClient
-from ace.utils import FrameFilter, render
-from ace.video_file_server import VideoFileServer
+from ace.utils import FilterProfiles, FrameFilter, render
+from ace.video_file_server import FilteredCapture, FilteredStreamServer, VideoFileServer
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +41,31 @@ def parse_tag(s):
     return {pieces[0]: pieces[1]}
 
 
+def build_frame_request(analytic_addrs):
+    """Builds a FrameRequest for the given analytics. Comma separated addresses are replicas of the same analytic."""
+    f_req = analytic_pb2.FrameRequest()
+    for a in analytic_addrs:
+        addrs = a.split(",")
+        analytic = analytic_pb2.AnalyticData()
+        analytic.addr = addrs[0]
+        analytic.replica_addrs.extend(addrs[1:])
+        f_req.analytics.append(analytic)
+    return f_req
+
+
+def write_results(resp, db, sink):
+    """Writes the results for a frame to the database and/or results sink (either may be None)."""
+    for output in (db, sink):
+        if output:
+            output.write_proto(resp)
+
+
+def close_outputs(db, sink):
+    for output in (db, sink):
+        if output:
+            output.close()
+
+
 logger.setLevel(logging.INFO)
 
 
@@ -96,15 +123,22 @@ def kill(ctx, analytic_host, analytic_port):
 @click.option("--fil", "-f", multiple=True, default=None, help="Filters to applied to the stream, of the form '<filter>=<value>'.")
 @click.option("--filter_host", "-h", default="localhost", help="Host address of the filter")
 @click.option("--filter_port", "-p", default=50000, help="Port for the filtering service")
-def filter(ctx, fil, filter_host, filter_port):
+@click.option("--session_id", "-s", default=None, help="Session whose frames the filters are applied to. By default the filters apply to every session without filters of its own.")
+@click.option("--end", is_flag=True, default=False, help="End the session given by --session_id, removing its filters and the state the filter keeps for it.")
+def filter(ctx, fil, filter_host, filter_port, session_id, end):
     """ Applies the specified filter(s) to the stream processed by the StreamFilter at the host and port specified."""
+    if end:
+        if not session_id:
+            raise ValueError("Must specify the session to end with --session_id")
+        aceclient.FilterClient(host=filter_host, port=filter_port).remove(session_id)
+        return
     if not fil:
         raise ValueError("Must specify at least one filtering operaion (of the form '<filter>=<value>'")
     client = aceclient.FilterClient(host=filter_host, port=filter_port)
     filters = {}
     for f in fil:
         filters.update(parse_tag(f))
-    client.update(**filters)
+    client.update(session_id=session_id, **filters)
 
 
 @main.group()
@@ -166,11 +200,17 @@ def rtsp(ctx, src, endpoint, verbose):
 @serve.command()
 @click.option("--port", "-p", default="3000", help="Port the configuration endpoint runs on.")
 @click.option("--analytic_addr", "-a", default="localhost:50051", help="Address of the analytic to process the stream")
+@click.option("--num_workers", default=4, help="Maximum number of frames in flight to the analytic at once.")
+@click.option("--jpeg_quality", default=95, help="JPEG quality at which frames read from the stream are sent to the analytic.")
+@click.option("--grpc_port", default=None, type=int, help="Also accept frames over gRPC on this port, forwarding them to the analytic without re-encoding.")
+@click.option("--timeout", default=None, type=float, help="Deadline (in seconds) for requests forwarded to the analytic.")
+@click.option("--sink_dir", default=None, type=click.Path(file_okay=False), help="Directory to which the results of configured streams are also written as Parquet files (requires pyarrow).")
 @click.pass_context
-def proxy(ctx, port, analytic_addr):
+def proxy(ctx, port, analytic_addr, num_workers, jpeg_quality, grpc_port, timeout, sink_dir):
     """ Starts a proxy server which connects to an RTSP stream and forwards frames to an analytic or StreamFilter using the gRPC service library."""
     proxy_svc = StreamingProxy(
-        name=__name__, port=port, analytic_addr=analytic_addr)
+        name=__name__, port=port, analytic_addr=analytic_addr, num_workers=num_workers, jpeg_quality=jpeg_quality,
+        grpc_port=grpc_port, timeout=timeout, sink_dir=sink_dir)
     sys.exit(proxy_svc.Run())
 
 
@@ -181,71 +221,149 @@ def proxy(ctx, port, analytic_addr):
 @click.option("--filter_port", default=50000, help="Port that the filtering service runs on.")
 @click.option("--analytic_addr", "-a", default="localhost:50051", help="Address of the analytic to process the stream")
 @click.option("--verbose/--no-verbose", "-v", default=False, help="Display verbose output of the service.")
+@click.option("--max_msg_mb", default=64, help="Maximum size (in MB) of gRPC messages sent or received.")
+@click.option("--compression", default=None, type=click.Choice(list(aceclient.COMPRESSION.keys())), help="Compression applied to gRPC messages.")
+@click.option("--max_queue", default=None, type=int, help="Number of queued requests after which new requests are rejected.")
+@click.option("--timeout", default=None, type=float, help="Deadline (in seconds) for requests forwarded to the analytic.")
+@click.option("--filter_threads", default=1, help="Number of threads used to blur each large frame in tiles.")
+@click.option("--src", default=None, help="Source of the stream to filter and re-serve (with --no-grpc).")
+@click.option("--stream_address", default="0.0.0.0", help="Address the filtered stream is served on (with --no-grpc).")
+@click.option("--stream_port", default=6420, help="Port the filtered MJPEG stream is served on (with --no-grpc).")
+@click.option("--fps", default=None, type=float, help="Rate at which frames are read from the source. Use for video files (with --no-grpc).")
+@click.option("--rtsp_endpoint", default=None, help="Also serve the filtered stream over RTSP on this endpoint (with --no-grpc, requires GStreamer).")
 @click.pass_context
-def streamfilter(ctx, grpc, grpc_port, port, filter_port, analytic_addr, verbose):
+def streamfilter(ctx, grpc, grpc_port, port, filter_port, analytic_addr, verbose, max_msg_mb, compression, max_queue, timeout,
+                 filter_threads, src, stream_address, stream_port, fps, rtsp_endpoint):
     """ 
     Start up a 'StreamFilter' server which can be used to modify indivdual frames en route to an analytic. The endpoint 
     running on the 'filter_port' can be used to change the types and magnitudes of the filters applied to each frame.
+
+    With --no-grpc, the filter instead reads the stream at 'src', filters each frame once and re-serves the filtered
+    stream (as an MJPEG, or over RTSP) to any number of analytics.
     """
-    frame_filter = FrameFilter()
-    client = aceclient.AnalyticClient(addr=analytic_addr)
+    frame_filter = FrameFilter(num_threads=filter_threads)
+    if not grpc:
+        serve_filtered_stream(frame_filter, src, filter_port, stream_address, stream_port, fps, rtsp_endpoint, verbose)
+        return
+    options = aceclient.grpc_options(max_message_length=max_msg_mb * 1024 * 1024)
+    client = aceclient.AnalyticClient(addr=analytic_addr, options=options, compression=compression, timeout=timeout)
+
+    profiles = FilterProfiles(frame_filter)
 
     def degrade_grpc(handler):
-        orig_frame = handler.get_frame()
-        frame = frame_filter.filter(orig_frame, handler)
-        resp = client.process_frame(frame)
+        session_id = handler.resp.session_id
+        frame = profiles.filter_jpeg(handler.get_frame("JPEG"), handler, session_id=session_id)
+        resp = client.process_frame(frame, session_id=session_id)
         handler.merge_response(resp)
         handler.add_encoded_frame(frame)
 
-    if grpc:
-        svc = grpcservice.AnalyticServiceGRPC(verbose=verbose)
-        svc.RegisterProcessVideoFrame(degrade_grpc)
-        proxysvc = grpcservice.ProxySvc(__name__, frame_filter, port=filter_port)
-        t1 = threading.Thread(target=svc.Run, kwargs=dict(analytic_port=int(grpc_port)), daemon=True)
-        t2 = threading.Thread(target=proxysvc.run)
-        print("Starting grpc service.")
-        t1.start()
-        print("Starting filter service.")
-        t2.start()
-    else:
-        print("RTSP filter not implemented")
+    svc = grpcservice.AnalyticServiceGRPC(verbose=verbose, max_queue=max_queue)
+    svc.RegisterProcessVideoFrame(degrade_grpc)
+    proxysvc = grpcservice.ProxySvc(__name__, profiles, port=filter_port)
+    t1 = threading.Thread(target=svc.Run, kwargs=dict(analytic_port=int(grpc_port), options=options,
+                                                      compression=compression), daemon=True)
+    t2 = threading.Thread(target=proxysvc.run)
+    print("Starting grpc service.")
+    t1.start()
+    print("Starting filter service.")
+    t2.start()
+
+
+def serve_filtered_stream(frame_filter, src, filter_port, address, port, fps, rtsp_endpoint, verbose):
+    """Filters the stream at 'src' once and re-serves it as an MJPEG (and over RTSP if 'rtsp_endpoint' is given)."""
+    if not src:
+        raise click.UsageError("--src is required with --no-grpc")
+    server = FilteredStreamServer(src, frame_filter, server_address=(address, port), fps=fps)
+    # Fails here if the source can't be opened, rather than serving an empty stream.
+    server.start_capture()
+    proxysvc = grpcservice.ProxySvc(__name__, frame_filter, port=filter_port)
+    print("Starting filter service.")
+    threading.Thread(target=proxysvc.run, daemon=True).start()
+    if rtsp_endpoint is None:
+        print("Serving the filtered stream as an mjpg on http://{!s}:{!s}/cam.mjpg".format(address, port))
+        server.serve_forever()
         return
 
+    if not importlib.util.find_spec("gi"):
+        print("Gstreamer is not installed. Please serve the filtered stream as an mjpg instead")
+        return
+    import gi
+    gi.require_version('Gst', '1.0')
+    gi.require_version('GstRtspServer', '1.0')
+    from gi.repository import GObject, Gst
+
+    from ace.rtspserver import GstServer
+    GObject.threads_init()
+    Gst.init(None)
+
+    print("Serving the filtered stream as an mjpg on http://{!s}:{!s}/cam.mjpg".format(address, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    GstServer(FilteredCapture(server.latest), "/{!s}".format(rtsp_endpoint), verbose)
+    GObject.MainLoop().run()
+
+
+@serve.command()
+@click.option("--msg_addr", "-m", default="nats://localhost:4222", help="Address of the NATS server.")
+@click.option("--stream_id", "-s", default="*", help="Stream whose results are joined. By default the results of every stream are joined.")
+@click.option("--analytic", "-a", default=[], multiple=True, help="Analytic (the last token of its subject) whose results are expected for every frame. By default every analytic publishing results for the stream is expected.")
+@click.option("--window_seconds", default=2.0, help="Maximum time to wait for the results of a frame.")
+@click.option("--window_frames", default=30, help="Maximum number of frames to wait for the results of a frame.")
+@click.pass_context
+def join(ctx, msg_addr, stream_id, analytic, window_seconds, window_frames):
+    """ Joins the results of the analytics processing a stream, publishing the results of each frame together on 'stream.<stream id>.joined'."""
+    svc = JoinService(msg_addr, stream_id=stream_id, analytics=analytic, window_seconds=window_seconds,
+                      window_frames=window_frames)
+    svc.run()
+
 
 @main.group()
 @click.pass_context
 @click.option("--db_addr", "-d", default=None, help="Address of the influx database to use")
-def stream(ctx, db_addr):
+@click.option("--max_msg_mb", default=64, help="Maximum size (in MB) of gRPC messages sent or received.")
+@click.option("--compression", default=None, type=click.Choice(list(aceclient.COMPRESSION.keys())), help="Compression applied to gRPC messages.")
+@click.option("--lb_policy", default="round_robin", type=click.Choice(list(ReplicaPool.POLICIES)), help="Policy used to balance frames across the replicas of an analytic.")
+@click.option("--window", default=4, help="Maximum number of frames in flight to the analytics at once.")
+@click.option("--hedge_percentile", default=None, type=float, help="Latency percentile after which a request is duplicated to another replica.")
+@click.option("--rollup_window", default=None, type=float, help="Also write per class aggregates of the results over windows of this many seconds to the database.")
+@click.option("--rollup_only/--no-rollup_only", default=False, help="Write only the aggregates (see --rollup_window) to the database.")
+@click.option("--sink_dir", default=None, type=click.Path(file_okay=False), help="Directory to which results are written as Parquet files for offline analysis (requires pyarrow).")
+def stream(ctx, db_addr, max_msg_mb, compression, lb_policy, window, hedge_percentile, rollup_window, rollup_only,
+           sink_dir):
     """Subcommand for directly streaming video (frame by frame) to an analytic running the gRPC service"""
     ctx.ensure_object(Context)
     ctx.obj.db = None
+    ctx.obj.sink = resultsink.ParquetSink(sink_dir) if sink_dir else None
+    ctx.obj.grpc_options = aceclient.grpc_options(max_message_length=max_msg_mb * 1024 * 1024)
+    ctx.obj.compression = compression
+    ctx.obj.lb_policy = lb_policy
+    ctx.obj.window = window
+    ctx.obj.hedge_percentile = hedge_percentile
     if db_addr:
         addr_list = db_addr.split(":")
         if len(addr_list) != 2:
             raise ValueError("Address must be of the form <host>:<port>")
         logging.info("Connecting to database. Host: {!s} Port: {!s}".format(
             addr_list[0], addr_list[1]))
-        ctx.obj.db = aceclient.AceDB(host=addr_list[0], port=addr_list[1])
+        ctx.obj.db = aceclient.AceDB(host=addr_list[0], port=addr_list[1], rollup_window=rollup_window,
+                                     write_raw=not (rollup_window and rollup_only))
 
 
 @stream.command()
 @click.pass_context
 @click.option('--video-file', '-v', help='Path to video file being processed.', type=click.Path())
-@click.option("--analytic_addr", "-a", default=[], multiple=True, help="Address of the analytic to process the stream.")
+@click.option("--analytic_addr", "-a", default=[], multiple=True, help="Address of the analytic to process the stream. Separate the addresses of replicas of the same analytic with commas.")
 def video(ctx, video_file, analytic_addr):
     """Stream the contents of a video file to an analytic"""
     if not analytic_addr:
         analytic_addr = ["localhost:50051"]
     db = ctx.obj.db
-    client = aceclient.AnalyticMultiClient()
+    sink = ctx.obj.sink
+    client = aceclient.AnalyticMultiClient(options=ctx.obj.grpc_options, compression=ctx.obj.compression,
+                                           policy=ctx.obj.lb_policy, hedge_percentile=ctx.obj.hedge_percentile)
     classes = {}
     cap = cv2.VideoCapture(video_file)
     window_names = []
-    f_req = analytic_pb2.FrameRequest()
-    for a in analytic_addr:
-        analytic = analytic_pb2.AnalyticData()
-        analytic.addr = a
-        f_req.analytics.append(analytic)
+    f_req = build_frame_request(analytic_addr)
     # Load all frames into a queue buffer
     buf = Queue()
     while (cap.isOpened()):
@@ -253,19 +371,20 @@ def video(ctx, video_file, analytic_addr):
         if not ret:
             break
         buf.put(frame)
+    pipeline = aceclient.AnalyticPipeline(client, window=ctx.obj.window)
+    frames = (buf.get(block=False) for _ in range(buf.qsize()))
     try:
-        while not buf.empty():
-            frame = buf.get(block=False)
-            resp = analytic_pb2.CompositeResults()
-            resp = client.process_frame(frame, f_req, resp)
+        for frame, resp in pipeline.imap(((frame, frame) for frame in frames), frame_req=f_req):
+            write_results(resp, db, sink)
             render(resp, window_names, classes, frame, db)
     finally:
         cv2.destroyAllWindows()
+        close_outputs(db, sink)
         print("Shutting down")
 
 
 @stream.command()
-@click.option("--analytic_addr", "-a", default=[], multiple=True, help="Address of the analytic to process the stream.")
+@click.option("--analytic_addr", "-a", default=[], multiple=True, help="Address of the analytic to process the stream. Separate the addresses of replicas of the same analytic with commas.")
 @click.option('--cam_id', '-c', default=0, help="The numerical identifier for the camera/webcam.  Default is 0.")
 @click.option("--width", '-w', default=640, help="Width of the video (pixels)")
 @click.option("--height", '-h', default=480, help="Height of the video (pixels)")
@@ -275,29 +394,32 @@ def camera(ctx, cam_id, analytic_addr, width, height):
     if not analytic_addr:
         analytic_addr = ["localhost:50051"]
     db = ctx.obj.db
-    client = aceclient.AnalyticMultiClient()
+    sink = ctx.obj.sink
+    client = aceclient.AnalyticMultiClient(options=ctx.obj.grpc_options, compression=ctx.obj.compression,
+                                           policy=ctx.obj.lb_policy, hedge_percentile=ctx.obj.hedge_percentile)
     cap = cv2.VideoCapture(int(cam_id))
     cap.set(cv2.CAP_PROP_FRAME_WIDTH, int(width))
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, int(height))
     classes = {}
     window_names = []
-    f_req = analytic_pb2.FrameRequest()
-    for a in analytic_addr:
-        analytic = analytic_pb2.AnalyticData()
-        analytic.addr = a
-        f_req.analytics.append(analytic)
+    f_req = build_frame_request(analytic_addr)
+    pipeline = aceclient.AnalyticPipeline(client, window=ctx.obj.window)
     try:
         while cap.isOpened():
             ret, frame = cap.read()
             if not ret:
                 print("Stream unavailable. Exiting.")
                 break
-            resp = analytic_pb2.CompositeResults()
-            resp = client.process_frame(frame, f_req, resp)
-            print(len(window_names))
+            for frame, resp in pipeline.submit(frame, frame, frame_req=f_req):
+                write_results(resp, db, sink)
+                render(resp, window_names, classes, frame, db)
+        # Wait for the frames still in flight to the analytics.
+        for frame, resp in pipeline.flush():
+            write_results(resp, db, sink)
             render(resp, window_names, classes, frame, db)
     finally:
         cv2.destroyAllWindows()
+        close_outputs(db, sink)
         print("Shutting down")
 
 
@@ -312,13 +434,19 @@ def test(ctx):
 @click.option("--src", required=True, help="Stream source to send to analytic")
 @click.option("--analytic_addr", default="localhost:50051", help="Analytic to process the stream.")
 @click.option("--verbose/--no-verbose", default=False, help="Displays additional output.")
+@click.option("--window", default=4, help="Maximum number of frames in flight to the analytic at once.")
+@click.option("--buffer_size", default=1, help="Number of captured frames waiting to be sent after which the oldest are dropped.")
+@click.option("--instrument/--no-instrument", default=False, help="Record the timings of each frame and print the end-to-end latency and achieved fps on exit.")
+@click.option("--display/--no-display", default=True, help="Display the results. Use --no-display to measure performance without a display.")
+@click.option("--duration", default=None, type=float, help="Number of seconds after which the test stops.")
 @click.pass_context
-def analytic(ctx, src, analytic_addr, verbose):
+def analytic(ctx, src, analytic_addr, verbose, window, buffer_size, instrument, display, duration):
     """
     Process a stream using an ACE analytic and display the output (with any bounding boxes) to the user. The 
     verbose flag can be used to output the analytic output data to the terminal"""
 
-    client = TestClient(src, analytic_addr=analytic_addr, verbose=False)
+    client = TestClient(src, analytic_addr=analytic_addr, verbose=False, window=window, buffer_size=buffer_size,
+                        instrument=instrument, display=display, duration=duration)
     client.run()
 
 
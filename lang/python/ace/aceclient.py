@@ -1,5 +1,6 @@
 #!/bin/python3
 # import ansyncio
+import collections
 import logging
 import os.path
 import sys
@@ -14,10 +15,80 @@ import requests
 from google.protobuf import json_format
 from influxdb import InfluxDBClient
 
-from ace import analytic_pb2, analytic_pb2_grpc
+from ace import analytic_pb2, analytic_pb2_grpc, lineprotocol
+from ace.balancer import HedgePolicy, ReplicaPool
+from ace.rollup import Rollup
+from ace.utils import jpeg_shape
 
 logger = logging.getLogger(__name__)
 
+# gRPC defaults to a 4 MB receive limit, which a single 4K frame encoded at JPEG quality 100 can exceed.
+DEFAULT_MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate
+}
+
+
+# Prefix of the trailing metadata keys used by analytic servers to report their load.
+LOAD_METADATA_PREFIX = "ace-load-"
+
+# Seconds `AceDB.close` waits for buffered points to be written before dropping them.
+DEFAULT_CLOSE_TIMEOUT = 10.0
+
+
+def parse_load_report(metadata):
+    """Returns a dict of the load values found in gRPC (trailing) metadata, e.g. {"in_flight": 2.0, "p99_latency_ms": 41.5}."""
+    report = {}
+    for key, value in metadata or ():
+        if not key.startswith(LOAD_METADATA_PREFIX):
+            continue
+        try:
+            report[key[len(LOAD_METADATA_PREFIX):].replace("-", "_")] = float(value)
+        except ValueError:
+            logger.debug("Ignoring malformed load metadata {!s}={!s}".format(key, value))
+    return report
+
+
+def get_compression(compression):
+    """Return the grpc.Compression value for 'compression', which may be a name (e.g. "gzip") or a grpc.Compression value."""
+    if compression is None or isinstance(compression, grpc.Compression):
+        return compression
+    algorithm = COMPRESSION.get(str(compression).lower())
+    if algorithm is None:
+        raise ValueError("Invalid compression specified: {!s}. Must be one of: {!s}".format(compression, list(COMPRESSION.keys())))
+    return algorithm
+
+
+def grpc_options(max_message_length=DEFAULT_MAX_MESSAGE_LENGTH, keepalive_time_ms=None, keepalive_timeout_ms=None,
+                 keepalive_permit_without_calls=None, initial_window_size=None, bdp_probe=None, extra_options=None):
+    """Build the list of channel arguments shared by ACE gRPC clients and servers.
+
+    Options left as None use the gRPC defaults. 'initial_window_size' sets the HTTP/2 stream window (in bytes);
+    disabling 'bdp_probe' keeps gRPC from resizing it dynamically.
+    """
+    options = []
+    if max_message_length:
+        options.append(("grpc.max_send_message_length", int(max_message_length)))
+        options.append(("grpc.max_receive_message_length", int(max_message_length)))
+    if keepalive_time_ms is not None:
+        options.append(("grpc.keepalive_time_ms", int(keepalive_time_ms)))
+    if keepalive_timeout_ms is not None:
+        options.append(("grpc.keepalive_timeout_ms", int(keepalive_timeout_ms)))
+    if keepalive_permit_without_calls is not None:
+        options.append(("grpc.keepalive_permit_without_calls", int(bool(keepalive_permit_without_calls))))
+        options.append(("grpc.http2.max_pings_without_data", 0))
+    if initial_window_size is not None:
+        options.append(("grpc.http2.lookahead_bytes", int(initial_window_size)))
+    if bdp_probe is not None:
+        options.append(("grpc.http2.bdp_probe", int(bool(bdp_probe))))
+    if extra_options:
+        options.extend(extra_options)
+    return options
+
+
 class ConfigClient:
     def __init__(self, host="localhost", port="3000"):
         self.addr = "http://{!s}:{!s}".format(host, port)
@@ -64,8 +135,10 @@ class FilterClient:
     def __init__(self, host="localhost", port="3000"):
         self.addr = "http://{!s}:{!s}/update".format(host, port)
 
-    def update(self, **kwargs):
-        r = requests.post(self.addr, json=kwargs)
+    def update(self, session_id=None, **kwargs):
+        """Updates the filters applied to the frames of 'session_id' (or the default filters if not given)."""
+        params = {"session_id": session_id} if session_id else None
+        r = requests.post(self.addr, json=kwargs, params=params)
         results = {"status": {
             "code": r.status_code
            }
@@ -74,78 +147,335 @@ class FilterClient:
             results["status"]["msg"] = r.reason
         logger.debug(results)
 
+    def remove(self, session_id):
+        """Removes the filters of 'session_id', whose frames are then filtered with the default filters. Call it when
+        the session ends, so the filter releases the state kept for the session."""
+        r = requests.delete(self.addr, params={"session_id": session_id})
+        return r.status_code
+
 class AnalyticClient(analytic_pb2_grpc.AnalyticStub):
     """Client for talking directly to a single ACE analytic"""
 
-    def __init__(self, addr="localhost:50051"):
+    def __init__(self, addr="localhost:50051", options=None, compression=None, timeout=None, replica_addrs=None,
+                 policy="round_robin", health_check_interval=None, hedge_percentile=None, hedge_min_delay=0.0):
+        """
+        'options' is a list of gRPC channel arguments (see `grpc_options`) and 'compression' is the default
+        compression applied to each call (e.g. "gzip"). 'timeout' is the default deadline (in seconds) of each call,
+        which lets an overloaded analytic drop frames the client has given up on. Both can be overridden per call
+        with the `compression` and `timeout` keywords.
+
+        If 'replica_addrs' are given, frames are spread across the analytic at 'addr' and its replicas using the
+        load balancing 'policy' ("round_robin" or "least_outstanding"), see `ace.balancer.ReplicaPool`.
+
+        Setting 'hedge_percentile' (e.g. 95) enables hedged requests across replicas: a request which has not been
+        answered within that percentile of recent latencies (and at least 'hedge_min_delay' seconds) is duplicated to
+        another replica and the first response is used. See `hedge_stats` for how often hedges are sent and win.
+        """
         self.addr = addr
-        channel = grpc.insecure_channel(self.addr)
-        super(AnalyticClient, self).__init__(channel)
+        self.options = grpc_options() if options is None else options
+        self.compression = get_compression(compression)
+        self.timeout = timeout
+        addrs = [addr] + [a for a in replica_addrs or [] if a != addr]
+        self.pool = ReplicaPool(addrs, policy=policy, options=self.options,
+                                health_check_interval=health_check_interval)
+        self.channel = self.pool.replicas[0].channel
+        self.hedge = HedgePolicy(percentile=hedge_percentile, min_delay=hedge_min_delay) if hedge_percentile else None
+        super(AnalyticClient, self).__init__(self.channel)
 
     def check_status(self):
-        self.CheckStatus(analytic_pb2.Empty())
+        return self.CheckStatus(analytic_pb2.Empty()).status
+
+    def get_load(self, timeout=None):
+        """Returns the analytic's status along with its current load report (in-flight requests, queue depth,
+        p50/p99 latency and estimated capacity), as reported in the CheckStatus trailing metadata."""
+        resp, call = self.CheckStatus.with_call(analytic_pb2.Empty(), timeout=timeout)
+        report = parse_load_report(call.trailing_metadata())
+        report["status"] = resp.status
+        return report
 
     def process_frame(self, frame, **kwargs):
         """Receive a video frame (numpy array) and send as bytes to an analytic"""
-        req = analytic_pb2.ProcessFrameRequest()
-        if type(frame) != bytes:
-            req.frame.frame.height = frame.shape[0]
-            req.frame.frame.width = frame.shape[1]
-            req.frame.frame.color = frame.shape[2]
-            logging.info("Encoding as jpeg string")
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 100]
-            frame = cv2.imencode(".jpeg", frame, encode_param)[1].tostring()
+        return self.process_frame_async(frame, **kwargs).result()
 
-        req.frame.frame.img = frame
+    def process_frame_async(self, frame, **kwargs):
+        """Sends the frame to the analytic without waiting for the response.
+
+        Takes the same arguments as `process_frame` and returns a gRPC future; its `result()` is the ProcessedFrame.
+        """
+        req = analytic_pb2.ProcessFrameRequest()
+        self.encode_frame(req.frame, frame)
         req.session_id = kwargs.get("session_id", "")
         req.frame.frame_num = kwargs.get("frame_num", -1)
         req.frame.timestamp = kwargs.get("timestamp", -1)
 
-        return self.ProcessVideoFrame(req)
+        return self.call_async("ProcessVideoFrame", req, **self.call_options(kwargs))
+
+    def process_frame_batch(self, frames, **kwargs):
+        """Send a batch of video frames (numpy arrays or encoded bytes) to an analytic in a single request.
+
+        Frame numbers and timestamps can be given as lists with the `frame_nums` and `timestamps` keywords. The
+        returned ProcessedFrameBatch holds one ProcessedFrame per input frame, in the same order.
+        """
+        req = analytic_pb2.ProcessFrameBatchRequest()
+        req.session_id = kwargs.get("session_id", "")
+        if kwargs.get("analytic"):
+            req.analytic.MergeFrom(kwargs.get("analytic"))
+        frame_nums = kwargs.get("frame_nums") or [-1] * len(frames)
+        timestamps = kwargs.get("timestamps") or [-1] * len(frames)
+        for frame, frame_num, timestamp in zip(frames, frame_nums, timestamps):
+            input_frame = req.frame.add()
+            self.encode_frame(input_frame, frame)
+            input_frame.frame_num = frame_num
+            input_frame.timestamp = timestamp
+
+        return self.call_async("ProcessVideoFrameBatch", req, **self.call_options(kwargs)).result()
+
+    def call_async(self, method, req, **kwargs):
+        """Starts the RPC 'method' on one of the analytic's replicas, hedging the request if enabled. Returns a future
+        for the response."""
+        if self.hedge and len(self.pool.replicas) > 1:
+            return self.pool.hedged_future(method, req, self.hedge, **kwargs)
+        return self.pool.future(method, req, **kwargs)[1]
+
+    def hedge_stats(self):
+        """Returns how many requests were sent and how many of them were hedged and won by the hedge."""
+        if not self.hedge:
+            return {}
+        return self.hedge.stats()
+
+    def call_options(self, kwargs):
+        """Returns the deadline and compression for a call, using the client defaults unless given in 'kwargs'."""
+        return dict(timeout=kwargs.get("timeout", self.timeout),
+                    compression=get_compression(kwargs.get("compression", self.compression)))
+
+    def encode_frame(self, input_frame, frame):
+        """Populates the InputFrame message with the frame, encoding it as a JPEG if it is not already encoded. The
+        dimensions of an encoded frame are read from its headers."""
+        if type(frame) == bytes:
+            shape = jpeg_shape(frame)
+            if shape:
+                input_frame.frame.height, input_frame.frame.width, input_frame.frame.color = shape
+        else:
+            input_frame.frame.height = frame.shape[0]
+            input_frame.frame.width = frame.shape[1]
+            input_frame.frame.color = frame.shape[2]
+            logging.info("Encoding as jpeg string")
+            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 100]
+            frame = cv2.imencode(".jpeg", frame, encode_param)[1].tostring()
+        input_frame.frame.img = frame
+
+    def close(self):
+        self.pool.close()
 
     def multiprocess_frame(self, req, data, frame_meta=None):
-        res = self.ProcessVideoFrame(req)
+        res = self.call_async("ProcessVideoFrame", req, timeout=self.timeout, compression=self.compression).result()
         if res.frame.frame.ByteSize() == 0:
             res.frame.MergeFrom(req.frame)
         data.results.append(res)
 
 
 class AnalyticMultiClient:
-    def __init__(self):
-        self.clients = []
+    """Client for sending each frame to several ACE analytics concurrently.
+
+    A single client (and gRPC channel) is kept per analytic address and set of replicas for the lifetime of the
+    multi-client, and frames
+    are fanned out to the analytics using gRPC futures rather than a thread per analytic.
+    """
+
+    def __init__(self, options=None, compression=None, timeout=None, policy="round_robin", health_check_interval=None,
+                 hedge_percentile=None, hedge_min_delay=0.0):
+        self.clients = {}
+        self.options = options
+        self.compression = compression
+        self.timeout = timeout
+        self.policy = policy
+        self.health_check_interval = health_check_interval
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self._lock = threading.Lock()
 
     def connect(self, addr):
         self.addr = addr
         for a in addr:
-            self.clients.append(AnalyticClient(addr=a))
+            self.get_client(a)
+
+    def get_client(self, addr, replica_addrs=None):
+        """Returns the client for the analytic at 'addr' (balancing across 'replica_addrs', if any), creating it the
+        first time the address and set of replicas is seen. A request with a different set of replicas for the same
+        address gets its own client."""
+        replicas = tuple(replica_addrs or ())
+        with self._lock:
+            client = self.clients.get((addr, replicas))
+            if client is None:
+                client = AnalyticClient(addr=addr, options=self.options, compression=self.compression,
+                                        timeout=self.timeout, replica_addrs=list(replicas) or None, policy=self.policy,
+                                        health_check_interval=self.health_check_interval,
+                                        hedge_percentile=self.hedge_percentile, hedge_min_delay=self.hedge_min_delay)
+                self.clients[(addr, replicas)] = client
+            return client
 
     def process_frame(self, frame, frame_req, resp, frame_meta=None):
         """ Send frame to all analytics"""
-        threads = []
-        req = analytic_pb2.ProcessFrameRequest()
-        logging.info("Frame shape {!s}".format(frame.shape))
-        logging.info("Encoding as byte string")
-        img_shape = frame.shape
-        req.frame.frame.height = img_shape[0]
-        req.frame.frame.width = img_shape[1]
-        req.frame.frame.color = img_shape[2]
-        req.frame.frame.img = cv2.imencode(".jpeg", frame)[1].tostring()
+        resp.MergeFrom(self.process_frame_async(frame, frame_req, frame_meta=frame_meta).result())
+        return resp
+
+    def process_frame_async(self, frame, frame_req, frame_meta=None):
+        """Sends the frame to all analytics without waiting for the responses. Returns a `CompositeFuture`."""
+        input_frame = analytic_pb2.InputFrame()
+        input_frame.frame.height = frame.shape[0]
+        input_frame.frame.width = frame.shape[1]
+        input_frame.frame.color = frame.shape[2]
+        input_frame.frame.img = cv2.imencode(".jpeg", frame)[1].tostring()
+        if frame_meta:
+            input_frame.frame_num = frame_meta.get("frame_num", -1)
+            input_frame.timestamp = frame_meta.get("timestamp", -1)
+
+        calls = []
         for a in frame_req.analytics:
-            if frame_meta:
-                req.frame.frame_num = frame_meta.get("frame_num", -1)
-                req.frame.frame.timestamp = frame_meta.get("timestamp", -1)
-            req.analytic.MergeFrom(a)
-            c = AnalyticClient(addr=a.addr)
-            t = threading.Thread(target=c.multiprocess_frame,
-                                 kwargs=dict(req=req, data=resp))
-            t.start()
-            threads.append(t)
-
-        for t in threads:
-            t.join()
+            # Each analytic gets its own request since the requests are in flight at the same time.
+            req = analytic_pb2.ProcessFrameRequest(frame=input_frame, analytic=a)
+            client = self.get_client(a.addr, replica_addrs=a.replica_addrs)
+            call = client.call_async("ProcessVideoFrame", req, timeout=client.timeout, compression=client.compression)
+            calls.append((a, call))
+        return CompositeFuture(input_frame, calls)
+
+    def close(self):
+        with self._lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+
+
+class CompositeFuture:
+    """
+    The pending results of a frame sent to several analytics by `AnalyticMultiClient.process_frame_async`. Supports
+    the same parts of the gRPC future interface as `balancer.HedgedCall`; it is done once every analytic's call is.
+    """
+
+    def __init__(self, input_frame, calls):
+        self.input_frame = input_frame
+        self.calls = calls
+        self._remaining = len(calls)
+        self._callbacks = []
+        self._lock = threading.Lock()
+        for _, call in calls:
+            call.add_done_callback(self._on_done)
+        if not calls:
+            self._on_done(None)
+
+    def _on_done(self, call):
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining > 0:
+                return
+            callbacks, self._callbacks = self._callbacks, None
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        """Calls 'fn' with this future once every analytic's call has finished (immediately if they all have)."""
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def done(self):
+        return all(call.done() for _, call in self.calls)
+
+    def cancel(self):
+        for _, call in self.calls:
+            call.cancel()
+
+    def result(self, timeout=None):
+        """Waits (up to 'timeout' seconds in all) for every analytic and returns their results as a CompositeResults.
+        Analytics which fail are logged and left out of the results."""
+        deadline = time.time() + timeout if timeout is not None else None
+        resp = analytic_pb2.CompositeResults()
+        for a, call in self.calls:
+            try:
+                res = call.result(timeout=max(0.0, deadline - time.time()) if deadline is not None else None)
+            except grpc.RpcError as e:
+                logger.error("Analytic at {!s} failed to process frame: {!s}".format(a.addr, e))
+                continue
+            if res.frame.frame.ByteSize() == 0:
+                res.frame.MergeFrom(self.input_frame)
+            resp.results.append(res)
         return resp
 
 
+class AnalyticPipeline:
+    """
+    Keeps up to 'window' frames in flight to an analytic so that the analytic is not left idle while the client
+    encodes the next frame or waits on the network.
+
+    'client' is an AnalyticClient or AnalyticMultiClient (anything with a `process_frame_async` method). Results are
+    delivered in the order the frames were submitted, as (context, response) tuples, where 'context' is whatever was
+    passed to `submit` with the frame. They are returned by `submit` and `flush` and also passed to 'callback', if
+    given. Frames which fail are logged and skipped.
+
+    If 'stamp' is set, each result is instead a (context, response, receive_time) tuple, where 'receive_time' is when
+    the response arrived. Responses may arrive well before they are delivered, as they are delivered in order.
+    """
+
+    def __init__(self, client, window=4, callback=None, stamp=False):
+        if window < 1:
+            raise ValueError("Pipeline window must be at least 1, got {!s}".format(window))
+        self.client = client
+        self.window = window
+        self.callback = callback
+        self.stamp = stamp
+        self._pending = collections.deque()
+
+    def submit(self, frame, context=None, **kwargs):
+        """Sends the frame, first waiting for the oldest frame if the window is full. Keyword arguments are passed to
+        the client's `process_frame_async`. Returns the results which are ready, in order."""
+        results = []
+        while len(self._pending) >= self.window:
+            self._deliver(self._pending.popleft(), results)
+        call = self.client.process_frame_async(frame, **kwargs)
+        received = []
+        if self.stamp:
+            call.add_done_callback(lambda _: received.append(time.time()))
+        self._pending.append((context, call, received))
+        while self._pending and self._pending[0][1].done():
+            self._deliver(self._pending.popleft(), results)
+        return results
+
+    def flush(self):
+        """Waits for every frame in flight and returns their results, in order."""
+        results = []
+        while self._pending:
+            self._deliver(self._pending.popleft(), results)
+        return results
+
+    def imap(self, items, **kwargs):
+        """Yields (context, response) for each (frame, context) in 'items', keeping the window full."""
+        for frame, context in items:
+            for result in self.submit(frame, context, **kwargs):
+                yield result
+        for result in self.flush():
+            yield result
+
+    def in_flight(self):
+        return len(self._pending)
+
+    def _deliver(self, pending, results):
+        context, call, received = pending
+        try:
+            resp = call.result()
+        except grpc.RpcError as e:
+            logger.error("Failed to process frame: {!s}".format(e))
+            return
+        if self.stamp:
+            # The done callback may still be running on the channel's thread.
+            results.append((context, resp, received[0] if received else time.time()))
+        else:
+            results.append((context, resp))
+        if self.callback:
+            self.callback(context, resp)
+
+
 class FrameServer:
     def __init__(self, addr):
         self.addr = addr
@@ -179,81 +509,241 @@ class FrameServer:
 
 
 class AceDB:
-    def __init__(self, host="localhost", port=8086, db_name="ace"):
+    def __init__(self, host="localhost", port=8086, db_name="ace", batch_size=500, flush_interval=1.0,
+                 max_buffer=50000, retries=3, retry_delay=0.5, drop_oldest=True, tag_keys=None, rollup_window=None,
+                 write_raw=True):
+        """
+        Client for writing analytic results to InfluxDB. Points are encoded as line protocol (see
+        `ace.lineprotocol`) as soon as they are written.
+
+        'tag_keys' lists the result columns written as tags (by default `lineprotocol.DEFAULT_TAG_KEYS`); the other
+        columns are written as fields. If 'rollup_window' is set, results are also aggregated per stream, analytic,
+        class and 'rollup_window' seconds (see `ace.rollup.Rollup`). Set 'write_raw' to False to write only the
+        rollups.
+
+        Unless 'batch_size' is 0 (or None), points are buffered and written by a background thread in batches of up
+        to 'batch_size' points, at least every 'flush_interval' seconds. A failed batch is retried 'retries' times
+        with exponential backoff starting at 'retry_delay' seconds and is then put back on the buffer. At most
+        'max_buffer' points are held in memory; once the buffer is full the oldest points are dropped (or the newest,
+        if 'drop_oldest' is False). Call `close` to flush the remaining points and stop the writer; once it is called
+        failed batches are no longer retried, and points which cannot be written are dropped.
+        """
         try:
             self.client = InfluxDBClient(host=host, port=port, database="ace")
             self.db_name = db_name
             # self.initialize_db(db_name)
         except requests.exceptions.ConnectionError:
             raise ValueError("Unable to connect to database")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.drop_oldest = drop_oldest
+        self.tag_keys = lineprotocol.DEFAULT_TAG_KEYS if tag_keys is None else frozenset(tag_keys)
+        self.rollup = Rollup(window=rollup_window) if rollup_window else None
+        self.write_raw = write_raw
+        self.buffer = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.failed_writes = 0
+        self._writing = 0
+        self._flushing = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._writer = None
+        if self.batch_size:
+            self._writer = threading.Thread(target=self._run_writer, daemon=True)
+            self._writer.start()
 
     def write(self, **kwargs):
         data = self.build_json(kwargs)
-        self._write(data)
+        self._write([lineprotocol.point_line(p["measurement"], p["tags"], p["fields"]) for p in data])
 
     def write_proto(self, proto):
-        data = self.json_from_resp(proto)
-        if data:
-            self._write(data)
+        """Writes a ProcessedFrame (or a ProcessedFrameBatch) as line protocol."""
+        if self.rollup:
+            self.rollup.add(proto)
+            if not self._writer:
+                self._write_rollups()
+        if not self.write_raw:
+            return
+        lines = lineprotocol.encode(proto, tag_keys=self.tag_keys)
+        if lines:
+            self._write(lines)
+
+    def _write_rollups(self, force=False):
+        lines = self.rollup.collect(force=force)
+        if lines:
+            self._write(lines)
 
     def _write(self, data):
         if not self.db_name:
             raise ValueError("No database initialized")
-        self.client.write_points(data)
+        if not self._writer:
+            self.client.write_points(data, protocol="line")
+            return
+        with self._cond:
+            if self._closed:
+                raise ValueError("Database writer has been closed")
+            self._buffer_points(data)
+            if len(self.buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _buffer_points(self, points, front=False):
+        """Adds points to the buffer (must be called holding the lock), dropping points once it is full."""
+        if front:
+            self.buffer.extendleft(reversed(points))
+        else:
+            self.buffer.extend(points)
+        overflow = len(self.buffer) - self.max_buffer
+        if overflow <= 0:
+            return
+        for _ in range(overflow):
+            if self.drop_oldest:
+                self.buffer.popleft()
+            else:
+                self.buffer.pop()
+        self.dropped += overflow
+        logger.warning("Database write buffer full, dropped {:d} points".format(overflow))
+
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                if not (self._closed or self._flushing) and len(self.buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self.rollup:
+                    lines = self.rollup.collect(force=self._closed)
+                    if lines:
+                        self._buffer_points(lines)
+                if self._closed and not self.buffer:
+                    return
+                batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+                self._writing = len(batch)
+            if batch:
+                self._write_batch(batch)
+            with self._cond:
+                self._writing = 0
+                self._cond.notify_all()
+
+    def _write_batch(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.client.write_points(batch, protocol="line")
+                with self._cond:
+                    self.written += len(batch)
+                return
+            except Exception as e:
+                logger.warning("Failed to write {:d} points to database (attempt {:d}): {!s}".format(
+                    len(batch), attempt + 1, e))
+            with self._cond:
+                # Closing wakes the writer from its backoff and stops it retrying.
+                if self._closed or attempt == self.retries:
+                    break
+                self._cond.wait(delay)
+                delay *= 2
+        with self._cond:
+            self.failed_writes += 1
+            if self._closed:
+                # The database is unavailable, so drop the rest of the buffer rather than delaying shutdown further.
+                self._drop_buffered(len(batch))
+                return
+            self._buffer_points(batch, front=True)
+
+    def _drop_buffered(self, count=0):
+        """Drops every buffered point (must be called holding the lock), along with 'count' points already taken
+        from the buffer."""
+        count += len(self.buffer)
+        self.buffer.clear()
+        if count:
+            self.dropped += count
+            logger.warning("Dropped {:d} points which could not be written to the database before closing".format(
+                count))
+
+    def flush(self, timeout=None):
+        """Blocks until every buffered point has been written (or dropped). Returns False if 'timeout' expired."""
+        if not self._writer:
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self.buffer or self._writing:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def close(self, timeout=DEFAULT_CLOSE_TIMEOUT):
+        """Writes any buffered points (and open rollup windows) and stops the background writer, waiting at most
+        'timeout' seconds for it. Points still buffered after that are dropped."""
+        if not self._writer:
+            if self.rollup:
+                self._write_rollups(force=True)
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join(timeout)
+        if self._writer.is_alive():
+            with self._cond:
+                self._drop_buffered()
+
+    def stats(self):
+        """Returns the number of points written, buffered and dropped, and the number of failed batch writes."""
+        with self._cond:
+            return {
+                "written": self.written,
+                "buffered": len(self.buffer) + self._writing,
+                "dropped": self.dropped,
+                "failed_writes": self.failed_writes
+            }
 
     def json_from_resp(self, resp, measurement="FrameInfo", tags=None, fields=None):
-        data_list = []
+        tag_keys = self.tag_keys
+        base_tags = {}
+        base_fields = {
+            "analytic_start_time": resp.data.start_time_millis,
+            "analytic_end_time": resp.data.end_time_millis,
+            "frame_byte_size": resp.frame.frame_byte_size
+        }
+        for key, value in (("analytic_name", resp.analytic.name), ("analytic_addr", resp.analytic.addr),
+                           ("frame_num", resp.frame.frame_num), ("frame_timestamp", resp.frame.timestamp),
+                           ("stream_address", resp.data.stream_addr), ("session_id", resp.session_id)):
+            (base_tags if key in tag_keys else base_fields)[key] = value
+
         if not resp.data.roi:
             data = {
-                    "measurement": measurement,
-                    "tags": {
-                        "analytic_name": resp.analytic.name,
-                        "analytic_addr": resp.analytic.addr,
-                        "classification": None,
-                        "frame_num": resp.frame.frame_num,
-                        "frame_timestamp": resp.frame.timestamp,
-                        "stream_address": resp.data.stream_addr
-                    },
-                    "fields": {
-                        "confidence": 0.0,
-                        "analytic_start_time": resp.data.start_time_millis,
-                        "analytic_end_time": resp.data.end_time_millis,
-                        "frame_byte_size": resp.frame.frame_byte_size
-                    }
-                }
-
+                "measurement": measurement,
+                "tags": dict(base_tags),
+                "fields": dict(base_fields, confidence=0.0)
+            }
             data["tags"].update(resp.data.tags)
             data["fields"].update(resp.analytic.filters)
             return [data]
 
+        data_list = []
         for roi in resp.data.roi:
-
             data = {
                 "measurement": measurement,
-                "tags": {
-                    "analytic_name": resp.analytic.name,
-                    "analytic_addr": resp.analytic.addr,
-                    "classification": roi.classification,
-                    "frame_num": resp.frame.frame_num,
-                    "frame_timestamp": resp.frame.timestamp,
-                    "stream_address": resp.data.stream_addr,
-                    "session_id": resp.session_id
-                },
-                "fields": {
+                "tags": dict(base_tags),
+                "fields": dict(base_fields, **{
                     "confidence": roi.confidence,
-                    "analytic_start_time": resp.data.start_time_millis,
-                    "analytic_end_time": resp.data.end_time_millis,
-                    "frame_byte_size": resp.frame.frame_byte_size,
                     "box_x1": roi.box.corner1.x,
                     "box_y1": roi.box.corner1.y,
                     "box_x2": roi.box.corner2.x,
                     "box_y2": roi.box.corner2.y
-                }
+                })
             }
-
+            if roi.classification:
+                (data["tags"] if "classification" in tag_keys else data["fields"])["classification"] = roi.classification
             data["tags"].update(resp.data.tags)
             data["fields"].update(resp.analytic.filters)
-        
             data_list.append(data)
         return data_list
 
@@ -48,17 +48,32 @@ def crop_box_to_frame(frame, box_rect):
 
 
 class FrameHandler:
+    # The frame as received (if it was received encoded) and decoded. A frame received as a JPEG is only decoded the
+    # first time `frame` is used, so handlers which only forward the JPEG never decode it.
+    jpeg = None
+    _frame = None
+
     @classmethod
     def from_request(cls, req):
         self = cls()
         self.input_frame = req.frame
         self.analytic = req.analytic
         self.jpeg = self.input_frame.frame.img
-        self.frame = cv2.imdecode(np.fromstring(self.jpeg, dtype=np.uint8), 1)
         self.resp = analytic_pb2.ProcessedFrame()
+        self.resp.session_id = req.session_id
 
         return self
 
+    @property
+    def frame(self):
+        if self._frame is None and self.jpeg:
+            self._frame = cv2.imdecode(np.frombuffer(self.jpeg, dtype=np.uint8), 1)
+        return self._frame
+
+    @frame.setter
+    def frame(self, frame):
+        self._frame = frame
+
     def __init__(self, frame_batch_obj=None, stream_addr="", session_id=""):
 
         if not frame_batch_obj:
@@ -74,12 +89,12 @@ class FrameHandler:
         self.input_frame.frame_num = frame_batch_obj[0][1]
         self.input_frame.timestamp = frame_batch_obj[0][0]
 
-    def get_frame(self, format=None):
+    def get_frame(self, format=None, quality=100):
         if format == "JPEG":
-            logger.info("Getting image as jpeg")
+            logger.debug("Getting image as jpeg")
             if not self.jpeg:
                 self.jpeg = cv2.imencode(".jpeg", self.frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])[
-                    1].tostring()
+                    1].tobytes()
             return self.jpeg
         return self.frame
 
@@ -114,7 +129,10 @@ class FrameHandler:
     def add_frame_info(self, include_frame=False):
         self.resp.frame.frame_num = self.input_frame.frame_num
         self.resp.frame.timestamp = self.input_frame.timestamp
-        self.resp.frame.frame_byte_size = len(cv2.imencode(".jpeg", self.frame, [int(cv2.IMWRITE_JPEG_QUALITY), 100])[1].tostring())
+        if self.jpeg:
+            self.resp.frame.frame_byte_size = len(self.jpeg)
+        else:
+            self.resp.frame.frame_byte_size = len(cv2.imencode(".jpeg", self.frame, [int(cv2.IMWRITE_JPEG_QUALITY), 100])[1].tostring())
         if include_frame:
             self.add_frame()
 
@@ -168,10 +186,11 @@ class FrameHandler:
         if filters:
             self.analytic.filters = filters
         if replica_addrs:
-            self.analytic.replica_addrs
+            del self.analytic.replica_addrs[:]
+            self.analytic.replica_addrs.extend(replica_addrs)
 
     def add_filter(self, f, value):
-        logger.info("Adding filter: {!s} = {!s}".format(f, value))
+        logger.debug("Adding filter: {!s} = {!s}".format(f, value))
         self.resp.analytic.filters[f] = str(value)
 
     def merge_response(self, resp):
@@ -233,8 +252,23 @@ class BatchHandler:
                 session_id=session_id
             )])
 
-    def from_request(self, req):
-        raise NotImplementedError()
+    @classmethod
+    def from_request(cls, req):
+        """Creates a handler from a ProcessFrameBatchRequest, decoding each of the frames in the batch."""
+        self = cls()
+        self.input_frames = list(req.frame)
+        self.analytic = req.analytic
+        self.resp = analytic_pb2.ProcessedFrameBatch()
+
+        self.jpegs = [input_frame.frame.img for input_frame in self.input_frames]
+        self.frames = [cv2.imdecode(np.fromstring(jpeg, dtype=np.uint8), 1) for jpeg in self.jpegs]
+        self.frame_nums = [input_frame.frame_num for input_frame in self.input_frames]
+        self.timestamps = [input_frame.timestamp for input_frame in self.input_frames]
+
+        self.frame_index = 0
+
+        self.initialize_response("", req.session_id)
+        return self
 
     def get_next_frame(self):
         self.frame_index = min(self.frame_index + 1, len(self.frames) - 1)
@@ -245,17 +279,17 @@ class BatchHandler:
 
     def add_bounding_box(self, classification, confidence, x1, y1, x2, y2, supplement=None, frame_index=None):
         """Add bounding box for classification to the response. If no frame index is specified, it will be applied to all frames"""
-        if frame_index:
-            x1, y1, x2, y2 = crop_box_to_frame(self.frame, [x1, y1, x2, y2])
+        if frame_index is not None:
+            x1, y1, x2, y2 = crop_box_to_frame(self.frames[frame_index], [x1, y1, x2, y2])
             box = analytic_pb2.RegionOfInterest(
                 box=analytic_pb2.BoundingBox(corner1=analytic_pb2.Point(
                     x=x1, y=y1), corner2=analytic_pb2.Point(x=x2, y=y2)),
                 classification=classification, confidence=confidence, supplement=supplement)
             self.resp.processed_frames[frame_index].data.roi.extend([box])
 
-        if not frame_index:
+        if frame_index is None:
             for i, frame in enumerate(self.frames):
-                x1, y1, x2, y2 = crop_box_to_frame(self.frame, [x1, y1, x2, y2])
+                x1, y1, x2, y2 = crop_box_to_frame(frame, [x1, y1, x2, y2])
                 box = analytic_pb2.RegionOfInterest(
                     box=analytic_pb2.BoundingBox(corner1=analytic_pb2.Point(
                         x=x1, y=y1), corner2=analytic_pb2.Point(x=x2, y=y2)),
@@ -330,10 +364,11 @@ class BatchHandler:
         if filters:
             self.analytic.filters = filters
         if replica_addrs:
-            self.analytic.replica_addrs
+            del self.analytic.replica_addrs[:]
+            self.analytic.replica_addrs.extend(replica_addrs)
 
     def add_filter(self, f, value):
-        logger.info("Adding filter: {!s} = {!s}".format(f, value))
+        logger.debug("Adding filter: {!s} = {!s}".format(f, value))
         self.analytic.filters[f] = str(value)
 
     def merge_response(self, resp):
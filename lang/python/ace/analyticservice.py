@@ -23,7 +23,8 @@ from kafka import KafkaProducer
 from ace import analytic_pb2
 from ace.aceclient import AceDB
 from ace.analytichandler import FrameHandler, BatchHandler, get_analytic_handler
-from ace.messenger import ACEProducer
+from ace.messenger import ACEProducer, DirectoryFrameStore
+from ace.resultsink import ParquetSink
 from ace.rtsp import RTSPHandler
 
 logger = logging.getLogger(__name__)
@@ -41,7 +42,16 @@ class EndpointAction(object):
 class AnalyticService:
     """ """
 
-    def __init__(self, name, port=3000, debug=False, stream_video=False, verbose=False, num_workers=1, messenger_type="NATS"):
+    def __init__(self, name, port=3000, debug=False, stream_video=False, verbose=False, num_workers=1, messenger_type="NATS",
+                 frame_store_dir=None, message_compression=None, split_frames=True, sink_dir=None):
+        """
+        'frame_store_dir' is a directory (e.g. a shared volume) to which returned frames are written instead of being
+        published on the frame subject, 'message_compression' is the compression applied to published messages
+        ("gzip" for NATS; "gzip", "snappy", "lz4" or "zstd" for Kafka) and 'split_frames' controls whether frames are
+        published separately from the results (see `messenger.ResultPublisher`). If 'sink_dir' is given, the results
+        of each configured stream are also written there as Parquet files (see `resultsink.ParquetSink`), which are
+        closed when the stream is stopped or the service shuts down.
+        """
         self.app = Flask(name)
         self._add_endpoint("/config", "config", self.config, methods=["PUT"])
         self._add_endpoint("/kill", "kill", self.kill, methods=["POST"])
@@ -53,12 +63,20 @@ class AnalyticService:
         self.verbose = verbose
         self.loop = asyncio.new_event_loop()
         self.messenger_type = messenger_type
+        self.frame_store = DirectoryFrameStore(frame_store_dir) if frame_store_dir else None
+        self.message_compression = message_compression
+        self.split_frames = split_frames
+        self.sink_dir = sink_dir
         self.return_frame = False
 
     def Run(self):
         """ """
         logger.info("REST config service running on ::{!s}".format(self.port))
-        self.app.run(host="::", port=self.port)
+        try:
+            self.app.run(host="::", port=self.port)
+        finally:
+            if self.handler:
+                self.handler.terminate()
 
     def config(self):
         """ """
@@ -80,6 +98,7 @@ class AnalyticService:
                                    cap_width=req.frame_width,
                                    cap_height=req.frame_height,
                                    analytic_data=req.analytic,
+                                   num_workers=self.num_workers,
                                    stream_id=req.stream_id,
                                    verbose=self.verbose,
                                    return_frame=req.return_frame,
@@ -88,10 +107,14 @@ class AnalyticService:
         self.stream_addr = req.stream_source
         if req.messenger_addr:
             self.handler.add_producer(producer=ACEProducer(
-                addr=req.messenger_addr, value_serializer=lambda value: value.SerializeToString(), loop=self.loop, messenger_type=self.messenger_type))
+                addr=req.messenger_addr, value_serializer=lambda value: value.SerializeToString(), loop=self.loop,
+                messenger_type=self.messenger_type, compression_type=self.message_compression),
+                frame_store=self.frame_store, split_frames=self.split_frames)
         if req.db_addr:
             host, port = req.db_addr.split(":")
             self.handler.add_database(db_client=AceDB(host=host, port=port))
+        if self.sink_dir:
+            self.handler.add_sink(ParquetSink(self.sink_dir, prefix=req.stream_id or "results"))
         t = threading.Thread(target=self.handler.run)
         t.start()
         return {"code": 200}
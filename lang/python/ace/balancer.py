@@ -0,0 +1,332 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import grpc
+from grpc_health.v1 import health_pb2, health_pb2_grpc
+
+from ace import analytic_pb2_grpc
+from ace.utils import percentile
+
+logger = logging.getLogger(__name__)
+
+# Status codes which indicate a problem with the replica itself (rather than with the request or with load).
+EJECT_CODES = frozenset([grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.UNKNOWN, grpc.StatusCode.INTERNAL])
+
+
+class Replica:
+    """A single replica of an analytic, along with the bookkeeping used to balance requests across replicas."""
+
+    def __init__(self, addr, options=None):
+        self.addr = addr
+        self.channel = grpc.insecure_channel(addr, options=options)
+        self.stub = analytic_pb2_grpc.AnalyticStub(self.channel)
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def is_ejected(self, now=None):
+        return self.ejected_until > (now or time.time())
+
+    def __repr__(self):
+        return "Replica(addr={!r}, outstanding={:d}, failures={:d})".format(self.addr, self.outstanding, self.failures)
+
+
+class ReplicaPool:
+    """
+    Spreads requests for one logical analytic across its replicas.
+
+    Two policies are supported: "round_robin" cycles through the replicas and "least_outstanding" picks the replica
+    with the fewest requests in flight from this client. A replica is ejected for 'ejection_time' seconds after
+    'max_failures' consecutive calls fail with one of the EJECT_CODES. If 'health_check_interval' is set, replicas are
+    also checked with the gRPC health service in the background, ejecting any replica that is not SERVING. When every
+    replica is ejected, requests are spread across all of them rather than failing outright.
+    """
+
+    POLICIES = ("round_robin", "least_outstanding")
+
+    def __init__(self, addrs, policy="round_robin", options=None, max_failures=3, ejection_time=10.0,
+                 health_check_interval=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Invalid load balancing policy specified: {!s}. Must be one of: {!s}".format(
+                policy, list(self.POLICIES)))
+        if not addrs:
+            raise ValueError("At least one replica address must be specified")
+        self.policy = policy
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.replicas = [Replica(addr, options=options) for addr in addrs]
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if health_check_interval:
+            t = threading.Thread(target=self._health_check_loop, args=(health_check_interval,), daemon=True)
+            t.start()
+
+    def pick(self, exclude=()):
+        """Returns the replica which should receive the next request, skipping ejected replicas and those in 'exclude'."""
+        now = time.time()
+        with self._lock:
+            candidates = [r for r in self.replicas if r not in exclude and not r.is_ejected(now)]
+            if not candidates:
+                candidates = [r for r in self.replicas if r not in exclude] or self.replicas
+            offset = next(self._counter)
+            if self.policy == "least_outstanding":
+                least = min(r.outstanding for r in candidates)
+                candidates = [r for r in candidates if r.outstanding == least]
+            return candidates[offset % len(candidates)]
+
+    def future(self, method, req, exclude=(), **kwargs):
+        """Starts the RPC 'method' (e.g. "ProcessVideoFrame") on the next replica.
+
+        Returns a tuple of the replica and the gRPC future for the call. Keyword arguments are passed to the call.
+        """
+        replica = self.pick(exclude)
+        with self._lock:
+            replica.outstanding += 1
+        call = getattr(replica.stub, method).future(req, **kwargs)
+        call.add_done_callback(lambda f: self._finish(replica, f))
+        return replica, call
+
+    def call(self, method, req, **kwargs):
+        """Calls 'method' on the next replica and blocks until the response is received."""
+        return self.future(method, req, **kwargs)[1].result()
+
+    def hedged_future(self, method, req, policy, **kwargs):
+        """Like `future`, but duplicates the request to another replica if it has not completed within the delay given
+        by the HedgePolicy 'policy'. Returns a HedgedCall."""
+        return HedgedCall(self, method, req, policy, kwargs)
+
+    def _finish(self, replica, call):
+        with self._lock:
+            replica.outstanding -= 1
+            if call.cancelled():
+                return
+            code = call.code()
+            if code not in EJECT_CODES:
+                replica.failures = 0
+                return
+            replica.failures += 1
+            if replica.failures >= self.max_failures and not replica.is_ejected():
+                logger.warning("Ejecting replica {!s} after {:d} consecutive failures ({!s})".format(
+                    replica.addr, replica.failures, code))
+                replica.ejected_until = time.time() + self.ejection_time
+
+    def _health_check_loop(self, interval):
+        stubs = [(r, health_pb2_grpc.HealthStub(r.channel)) for r in self.replicas]
+        while not self._closed.wait(interval):
+            for replica, stub in stubs:
+                try:
+                    status = stub.Check(health_pb2.HealthCheckRequest(service="ace.Analytic"), timeout=interval).status
+                    serving = status == health_pb2.HealthCheckResponse.SERVING
+                except grpc.RpcError:
+                    serving = False
+                with self._lock:
+                    if serving:
+                        replica.ejected_until = 0.0
+                        replica.failures = 0
+                    elif not replica.is_ejected():
+                        logger.warning("Ejecting replica {!s}: failed health check".format(replica.addr))
+                        replica.ejected_until = time.time() + self.ejection_time
+
+    def close(self):
+        self._closed.set()
+        for replica in self.replicas:
+            replica.channel.close()
+
+
+class _Scheduler:
+    """Runs callbacks after a delay on a single background thread."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay, func):
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), func))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                when, _, func = self._heap[0]
+                wait = when - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+            try:
+                func()
+            except Exception:
+                logger.exception("Scheduled callback failed")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = _Scheduler()
+        return _scheduler
+
+
+class HedgePolicy:
+    """
+    Decides when to hedge a request and keeps statistics on how often hedges are sent and win.
+
+    The hedge delay is the 'percentile' of recent successful call latencies (but at least 'min_delay' seconds), so
+    only the slowest requests are duplicated. No request is hedged until 'min_samples' latencies have been recorded.
+    """
+
+    def __init__(self, percentile=95, min_delay=0.0, window=200, min_samples=20):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Seconds to wait before hedging, or None if there are not yet enough samples to hedge."""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = list(self.latencies)
+        return max(self.min_delay, percentile(latencies, self.percentile))
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def count(self, requests=0, hedges_sent=0, hedges_won=0):
+        with self._lock:
+            self.requests += requests
+            self.hedges_sent += hedges_sent
+            self.hedges_won += hedges_won
+
+    def stats(self):
+        """Returns the number of requests, hedges sent and hedges won, along with the hedge and win rates."""
+        with self._lock:
+            requests, sent, won = self.requests, self.hedges_sent, self.hedges_won
+        return {
+            "requests": requests,
+            "hedges_sent": sent,
+            "hedges_won": won,
+            "hedge_rate": float(sent) / requests if requests else 0.0,
+            "hedge_win_rate": float(won) / sent if sent else 0.0
+        }
+
+
+class HedgedCall:
+    """
+    A request which is sent to one replica and, if it has not completed within the hedge delay, duplicated to a
+    second replica. The first successful response wins and the other call is cancelled. Supports the parts of the
+    gRPC future interface used by ACE clients (`done`, `result`, `cancel` and `add_done_callback`).
+
+    If a 'timeout' is given, it is the deadline of the whole request: the hedge is only given the time remaining.
+    """
+
+    def __init__(self, pool, method, req, policy, kwargs):
+        self.pool = pool
+        self.method = method
+        self.req = req
+        self.policy = policy
+        self.kwargs = kwargs
+        self.calls = []
+        self.winner = None
+        timeout = kwargs.get("timeout")
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+        policy.count(requests=1)
+        delay = policy.delay()
+        self._start()
+        if delay is not None:
+            get_scheduler().schedule(delay, self._hedge)
+
+    def _start(self, exclude=()):
+        start_time = time.time()
+        kwargs = self.kwargs
+        if self.deadline is not None:
+            kwargs = dict(kwargs, timeout=max(0.0, self.deadline - start_time))
+        replica, call = self.pool.future(self.method, self.req, exclude=exclude, **kwargs)
+        with self._lock:
+            if self.winner is not None:
+                call.cancel()
+                return None
+            self.calls.append((replica, call))
+        call.add_done_callback(lambda c: self._on_done(c, start_time))
+        return call
+
+    def _hedge(self):
+        with self._lock:
+            if self.winner is not None:
+                return
+            exclude = [replica for replica, _ in self.calls]
+        if self.deadline is not None and time.time() >= self.deadline:
+            return
+        if self._start(exclude=exclude) is not None:
+            self.policy.count(hedges_sent=1)
+
+    def _on_done(self, call, start_time):
+        succeeded = not call.cancelled() and call.code() == grpc.StatusCode.OK
+        if succeeded:
+            self.policy.add_latency(time.time() - start_time)
+        with self._lock:
+            if self.winner is not None:
+                return
+            pending = [c for _, c in self.calls if c is not call and not c.done()]
+            if not succeeded and pending:
+                # Wait for the other replica rather than failing the request.
+                return
+            self.winner = call
+            losers = pending
+            hedge_won = succeeded and len(self.calls) > 1 and self.calls[0][1] is not call
+        for loser in losers:
+            loser.cancel()
+        if hedge_won:
+            self.policy.count(hedges_won=1)
+        self._done.set()
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, None
+        for fn in callbacks:
+            fn(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        with self._lock:
+            calls = [c for _, c in self.calls]
+        for call in calls:
+            call.cancel()
+        return True
+
+    def add_done_callback(self, fn):
+        """Calls 'fn' with this call once the winning call has finished (immediately if it already has)."""
+        with self._lock:
+            if self._callbacks is not None:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise grpc.FutureTimeoutError()
+        return self.winner.result()
@@ -1,9 +1,12 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import collections
+import contextlib
 import logging
 import os
 import sys
+import threading
 import time
 from concurrent import futures
 
@@ -11,10 +14,13 @@ import cv2
 import grpc
 from flask import Flask, Response, jsonify, request
 from google.protobuf import json_format
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 
 from ace import analytic_pb2, analytic_pb2_grpc
-from ace.analytichandler import FrameHandler
+from ace.aceclient import LOAD_METADATA_PREFIX, get_compression, grpc_options
+from ace.analytichandler import BatchHandler, FrameHandler
 from ace.rtsp import RTSPHandler
+from ace.utils import FilterProfiles, percentile
 
 logger = logging.getLogger(__name__)
 
@@ -30,13 +36,25 @@ class EndpointAction(object):
 
 
 class ProxySvc:
+    """
+    Endpoint for updating the filters of a stream filter. 'frame_filter' is either a FrameFilter or FilterProfiles;
+    filters are updated per session by passing a 'session_id' query parameter to "/update" (DELETE removes the
+    session's filters and releases the state kept for the session, so should be sent when a session ends), and
+    "/filters" returns the current settings.
+    """
+
     def __init__(self, name, frame_filter, host="::", port=3000, debug=False):
         self.app = Flask(name)
         self.add_endpoint("/update", "update", self.update, methods=["POST"])
+        self.add_endpoint("/update", "remove", self.remove, methods=["DELETE"])
+        self.add_endpoint("/filters", "filters", self.get_filters, methods=["GET"])
         self.host = host
         self.port = port
         self.handler = None
-        self.filter = frame_filter
+        if not isinstance(frame_filter, FilterProfiles):
+            frame_filter = FilterProfiles(frame_filter)
+        self.profiles = frame_filter
+        self.filter = frame_filter.default
 
     def run(self):
         print("Running on {!s}::{!s}".format(self.host, self.port))
@@ -44,15 +62,131 @@ class ProxySvc:
 
     def update(self):
         data = request.json
-        self.filter.update(data)
-        logger.info("Applying Filters: ", self.filter.filters)
+        session_id = request.args.get("session_id")
+        frame_filter = self.profiles.update(data, session_id=session_id)
+        logger.info("Applying Filters{!s}: {!s}".format(
+            " for session {!s}".format(session_id) if session_id else "", frame_filter.filters))
+        return {"code": 200}
+
+    def remove(self):
+        session_id = request.args.get("session_id")
+        if not session_id or not self.profiles.remove(session_id):
+            return {"code": 404}, 404
         return {"code": 200}
 
+    def get_filters(self):
+        return jsonify(self.profiles.filters())
+
     def add_endpoint(self, endpoint=None, endpoint_name=None, handler=None, methods=None):
         self.app.add_url_rule(endpoint, endpoint_name,
                               EndpointAction(handler), methods=methods)
 
 
+# Reasons a request can be rejected by admission control, reported as "shed_<reason>" in the load report.
+SHED_REASONS = ("queue_full", "deadline_decode", "deadline_process")
+# Server threads kept free of analytic requests for the health and status RPCs, which are not subject to admission.
+STATUS_THREADS = 2
+
+
+class LoadTracker:
+    """Keeps track of the load on an analytic server so it can be reported to clients and load balancers."""
+
+    def __init__(self, max_workers=10, window=200):
+        self.max_workers = max_workers
+        self.in_flight = 0
+        self.queued = 0
+        self.processed = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.shed = collections.Counter()
+        self._lock = threading.Lock()
+
+    def admit(self, limit=None):
+        """Counts a request as queued, unless 'limit' requests are already queued or in flight (in which case it is
+        counted as shed). Returns whether the request was admitted."""
+        with self._lock:
+            if limit is not None and self.queued + self.in_flight >= limit:
+                self.shed["queue_full"] += 1
+                return False
+            self.queued += 1
+            return True
+
+    @contextlib.contextmanager
+    def track_request(self, workers=None, admitted=False):
+        """
+        Counts a request as in flight for the duration of the block, first waiting for one of 'workers' (a semaphore),
+        if given. 'admitted' is set if the request has already been counted as queued by `admit`.
+        """
+        if not admitted:
+            with self._lock:
+                self.queued += 1
+        try:
+            if workers is not None:
+                workers.acquire()
+        finally:
+            with self._lock:
+                self.queued -= 1
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            if workers is not None:
+                workers.release()
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds * 1000)
+            self.processed += 1
+
+    def add_shed(self, reason):
+        """Counts a request rejected by admission control for the given reason."""
+        with self._lock:
+            self.shed[reason] += 1
+
+    def expected_latency(self):
+        """Median analytic latency in seconds over the window, or 0 if nothing has been processed yet."""
+        with self._lock:
+            latencies = list(self.latencies)
+        return (percentile(latencies, 50) or 0.0) / 1000
+
+    def queue_depth(self):
+        """Number of requests waiting for a free worker."""
+        with self._lock:
+            return self.queued
+
+    def is_overloaded(self):
+        return self.queue_depth() > 0
+
+    def report(self):
+        """Returns the current load as a dict. Latencies are in milliseconds and capacity is in frames per second."""
+        with self._lock:
+            latencies = list(self.latencies)
+            in_flight = self.in_flight
+            queued = self.queued
+            processed = self.processed
+            shed = dict(self.shed)
+        p50 = percentile(latencies, 50)
+        p99 = percentile(latencies, 99)
+        report = {
+            "in_flight": in_flight,
+            "queue_depth": queued,
+            "processed": processed,
+            "p50_latency_ms": p50 or 0.0,
+            "p99_latency_ms": p99 or 0.0,
+            "capacity_fps": self.max_workers * 1000.0 / p50 if p50 else 0.0
+        }
+        for reason in SHED_REASONS:
+            report["shed_" + reason] = shed.get(reason, 0)
+        return report
+
+    def metadata(self):
+        """Returns the load report as gRPC metadata."""
+        return tuple((LOAD_METADATA_PREFIX + key.replace("_", "-"), "{:.3f}".format(value))
+                     for key, value in self.report().items())
+
+
 class _AnalyticServicer(analytic_pb2_grpc.AnalyticServicer):
     """The class registered with gRPC, handles endpoints."""
 
@@ -61,12 +195,28 @@ class _AnalyticServicer(analytic_pb2_grpc.AnalyticServicer):
         self.svc = svc
 
     def ProcessVideoFrame(self, req, ctx):
-        handler = FrameHandler.from_request(req)
-        handler.set_start_time()
-        self.svc._CallEndpoint(self.svc.PROCESS_FRAME, handler, ctx)
-        handler.set_end_time()
-        handler.update_analytic_metadata(name=self.svc.get_name())
-        return handler.get_response()
+        return self._Process(FrameHandler, self.svc.PROCESS_FRAME, req, ctx)
+
+    def ProcessVideoFrameBatch(self, req, ctx):
+        return self._Process(BatchHandler, self.svc.PROCESS_BATCH, req, ctx)
+
+    def _Process(self, handler_class, ep_type, req, ctx):
+        """Decodes the request and calls the registered endpoint, shedding requests that cannot be served in time."""
+        if not self.svc.load.admit(self.svc.max_admitted):
+            ctx.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Analytic queue is full ({!s} requests waiting)".format(
+                self.svc.max_queue))
+        with self.svc.load.track_request(self.svc._workers, admitted=True):
+            self.svc._CheckAdmission(ctx, self.svc.STAGE_DECODE)
+            handler = handler_class.from_request(req)
+            self.svc._CheckAdmission(ctx, self.svc.STAGE_PROCESS)
+            handler.set_start_time()
+            start_time = time.time()
+            self.svc._CallEndpoint(ep_type, handler, ctx)
+            self.svc.load.add_latency(time.time() - start_time)
+            handler.set_end_time()
+            handler.update_analytic_metadata(name=self.svc.get_name())
+            ctx.set_trailing_metadata(self.svc.load.metadata())
+            return handler.get_response()
 
     def ProcessVideoStream(self, req, ctx):
         raise NotImplementedError()
@@ -76,7 +226,8 @@ class _AnalyticServicer(analytic_pb2_grpc.AnalyticServicer):
 
     def CheckStatus(self, req, ctx):
         resp = analytic_pb2.AnalyticStatus()
-        resp.status = "Running"
+        resp.status = "Overloaded" if self.svc.load.is_overloaded() else "Running"
+        ctx.set_trailing_metadata(self.svc.load.metadata())
         return resp
 
 
@@ -84,16 +235,30 @@ class AnalyticServiceGRPC:
     """Actual implementation of the service, with function registration."""
 
     PROCESS_FRAME = "ProcessFrame"
+    PROCESS_BATCH = "ProcessFrameBatch"
     PROCESS_STREAM = "ProcessStream"
     GET_FRAME = "GetFrame"
 
-    _ALLOWED_IMPLS = frozenset([PROCESS_FRAME, GET_FRAME])
+    _ALLOWED_IMPLS = frozenset([PROCESS_FRAME, PROCESS_BATCH, GET_FRAME])
 
-    def __init__(self, verbose=False):
+    STAGE_DECODE = "decode"
+    STAGE_PROCESS = "process"
+
+    def __init__(self, verbose=False, max_queue=None, deadline_margin=0.0):
+        """
+        'max_queue' limits the number of requests waiting for a worker; once it is reached new requests are rejected
+        with RESOURCE_EXHAUSTED as they arrive, without waiting for a worker. Requests whose client deadline will
+        expire within 'deadline_margin' seconds (plus the median analytic latency, once the frame is decoded) are
+        rejected with DEADLINE_EXCEEDED.
+        """
         self.verbose = verbose
+        self.max_queue = max_queue
+        self.deadline_margin = deadline_margin
         self._impls = {}
+        self._workers = None
         self.analytic_name = None
-        # self._health_servicer = health.HealthServicer()
+        self.load = LoadTracker()
+        self._health_servicer = health.HealthServicer()
 
     def get_name(self):
         return self.analytic_name
@@ -101,41 +266,66 @@ class AnalyticServiceGRPC:
     def register_name(self, name):
         self.analytic_name = name
 
-    def Start(self, analytic_port=50051, max_workers=10, concurrency_safe=False):
+    def Start(self, analytic_port=50051, max_workers=10, concurrency_safe=False, options=None, compression=None):
+        """Start the gRPC server. 'options' are gRPC server arguments (see `ace.aceclient.grpc_options`) and
+        'compression' (e.g. "gzip") is the default compression applied to responses."""
         self.concurrency_safe = concurrency_safe
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers),
-                             options=(('grpc.so_reuseport', 0),))
+        options = grpc_options() if options is None else options
+        self.load.max_workers = max_workers
+        # At most 'max_workers' requests are processed at once. Admitted requests wait for a worker on their own
+        # server thread, so that requests beyond the queue are rejected as soon as they arrive and the health and
+        # status RPCs are still answered when every worker is busy. Without a 'max_queue', up to 'max_workers'
+        # requests wait on server threads and the rest wait for one.
+        self._workers = threading.BoundedSemaphore(max_workers)
+        queue_threads = self.max_queue if self.max_queue is not None else max_workers
+        executor = futures.ThreadPoolExecutor(max_workers=max_workers + queue_threads + STATUS_THREADS)
+        server = grpc.server(executor,
+                             options=[('grpc.so_reuseport', 0)] + list(options),
+                             compression=get_compression(compression))
         analytic_pb2_grpc.add_AnalyticServicer_to_server(
             _AnalyticServicer(self), server)
-        # health_pb2_grpc.add_HealthServicer_to_server(self._health_servicer, server)
+        health_pb2_grpc.add_HealthServicer_to_server(self._health_servicer, server)
         if not server.add_insecure_port('[::]:{:d}'.format(analytic_port)):
             raise RuntimeError(
                 "can't bind to port {}: already in use".format(analytic_port))
         server.start()
-        # self._health_servicer.set('', health_pb2.HealthCheckResponse.SERVING)
+        self.set_serving(True)
         logger.info("Analytic server started on port {} with PID {}".format(
-            analytic_port, os.getpid()), file=sys.stderr)
+            analytic_port, os.getpid()))
         return server
 
-    def Run(self, analytic_port=50051, max_workers=10, concurrency_safe=False):
+    def Run(self, analytic_port=50051, max_workers=10, concurrency_safe=False, options=None, compression=None):
         server = self.Start(analytic_port=analytic_port,
-                            max_workers=max_workers, concurrency_safe=concurrency_safe)
+                            max_workers=max_workers, concurrency_safe=concurrency_safe,
+                            options=options, compression=compression)
         logger.info("Serving {!s}".format(self.analytic_name))
         try:
             while True:
                 time.sleep(3600 * 24)
         except KeyboardInterrupt:
+            self.set_serving(False)
             server.stop(0)
             logging.info("Server stopped")
             return 0
         except Exception as e:
+            self.set_serving(False)
             server.stop(0)
             logging.error("Caught exception: %s", e)
             return -1
 
+    def set_serving(self, serving):
+        """Sets the status reported by the gRPC health service for the server and the Analytic service."""
+        status = health_pb2.HealthCheckResponse.SERVING if serving else health_pb2.HealthCheckResponse.NOT_SERVING
+        self._health_servicer.set("", status)
+        self._health_servicer.set("ace.Analytic", status)
+
     def RegisterProcessVideoFrame(self, f):
         return self._RegisterImpl(self.PROCESS_FRAME, f)
 
+    def RegisterProcessFrameBatch(self, f):
+        """Registers a function which receives a BatchHandler for each ProcessVideoFrameBatch request."""
+        return self._RegisterImpl(self.PROCESS_BATCH, f)
+
     def RegiterProcessVideoStream(self, f):
         return self._RegisterImpl(self.PROCESS_STREAM, f)
 
@@ -152,6 +342,33 @@ class AnalyticServiceGRPC:
         self._impls[type_name] = f
         return self
 
+    @property
+    def max_admitted(self):
+        """The number of requests which may be processed or waiting at once, or None if there is no limit."""
+        if self.max_queue is None or self._workers is None:
+            return None
+        return self.load.max_workers + self.max_queue
+
+    def _CheckAdmission(self, ctx, stage):
+        """Aborts the call if the client's deadline cannot be met. (Requests are rejected when the queue is full
+        as they arrive, see `_AnalyticServicer._Process`.)
+
+        Args:
+            ctx: The context of the call being admitted.
+            stage: STAGE_DECODE before the frame(s) are decoded, STAGE_PROCESS before the analytic is called.
+        """
+        remaining = ctx.time_remaining()
+        if remaining is None:
+            return
+        required = self.deadline_margin
+        if stage == self.STAGE_PROCESS:
+            required += self.load.expected_latency()
+        if remaining <= required:
+            self.load.add_shed("deadline_" + stage)
+            ctx.abort(grpc.StatusCode.DEADLINE_EXCEEDED,
+                      "Deadline cannot be met before {!s}: {:.3f}s remaining, {:.3f}s required".format(
+                          stage, remaining, required))
+
     def _CallEndpoint(self, ep_type, handler, ctx):
         """Implements calling endpoints and handling various exceptions that can come back.
 
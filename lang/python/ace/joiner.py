@@ -0,0 +1,178 @@
+"""
+Joins the results of several analytics processing the same stream.
+
+Each analytic publishes its results on its own subject ("stream.<stream id>.analytic.<analytic>"). The ResultJoiner
+collects the ProcessedFrames for each frame and emits them together as a single CompositeResults message, and the
+JoinService runs a joiner on the message bus.
+"""
+import collections
+import logging
+import time
+
+from google.rpc import code_pb2
+
+from ace import analytic_pb2
+from ace.messenger import ACEProducer, NATSConsumer
+
+logger = logging.getLogger(__name__)
+
+MISSING_MESSAGE = "No result received within the join window"
+
+
+def parse_subject(subject):
+    """Returns the stream id and analytic of a result subject ("stream.<stream id>.analytic.<analytic>")."""
+    parts = subject.split(".")
+    if len(parts) != 4 or parts[0] != "stream" or parts[2] != "analytic":
+        raise ValueError("Invalid result subject: {!s}".format(subject))
+    return parts[1], parts[3]
+
+
+class ResultJoiner:
+    """
+    Joins ProcessedFrames from several analytics into one CompositeResults per (stream, frame number).
+
+    A frame is emitted as soon as results from all of the 'analytics' have arrived. If 'analytics' is not given, the
+    joiner waits for every analytic it has seen on the stream within the last 'window_seconds' (so frames may be
+    emitted before a newly started analytic has been seen). Incomplete frames are emitted once they have waited
+    'window_seconds', once a frame 'window_frames' later has arrived on the same stream or when more than
+    'max_pending' frames are waiting. Each missing analytic is represented by a
+    ProcessedFrame with a DEADLINE_EXCEEDED status, so consumers can tell a missing result from an empty one.
+    Results arriving after their frame was emitted are counted in `late` and passed to 'late_callback' if given.
+
+    'callback' is called with the stream id, frame number and CompositeResults of each joined frame.
+    """
+
+    def __init__(self, callback, analytics=None, window_seconds=2.0, window_frames=30, max_pending=1000,
+                 late_callback=None, clock=time.time):
+        self.callback = callback
+        self.analytics = frozenset(analytics) if analytics else None
+        self.window_seconds = window_seconds
+        self.window_frames = window_frames
+        self.max_pending = max_pending
+        self.late_callback = late_callback
+        self.clock = clock
+        self.pending = collections.OrderedDict()
+        self.emitted = collections.OrderedDict()
+        self.seen = {}
+        self.latest_frame = {}
+        self.joined = 0
+        self.incomplete = 0
+        self.late = 0
+
+    def add(self, stream_id, analytic, resp):
+        """Adds the result of 'analytic' for a frame of the stream 'stream_id'."""
+        now = self.clock()
+        key = (stream_id, resp.frame.frame_num)
+        self.seen.setdefault(stream_id, {})[analytic] = now
+        if key in self.emitted:
+            self.late += 1
+            if self.late_callback:
+                self.late_callback(stream_id, analytic, resp)
+            return
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = (now, {})
+        entry[1][analytic] = resp
+        if self.latest_frame.get(stream_id, -1) < key[1]:
+            self.latest_frame[stream_id] = key[1]
+        if self.expected(stream_id, now) <= entry[1].keys():
+            self._emit(key)
+        self.expire(now, full=False)
+
+    def expected(self, stream_id, now=None):
+        """Returns the analytics whose results are expected for each frame of 'stream_id'."""
+        if self.analytics:
+            return self.analytics
+        now = self.clock() if now is None else now
+        return {a for a, t in self.seen.get(stream_id, {}).items() if now - t <= self.window_seconds}
+
+    def expire(self, now=None, full=True):
+        """
+        Emits the frames which have waited too long. Frames are checked oldest first and, unless 'full' is set, the
+        check stops at the first frame which has not expired.
+        """
+        now = self.clock() if now is None else now
+        for key in list(self.pending):
+            first_seen = self.pending[key][0]
+            expired = (len(self.pending) > self.max_pending or now - first_seen >= self.window_seconds or
+                       key[1] <= self.latest_frame[key[0]] - self.window_frames)
+            if expired:
+                self._emit(key)
+            elif not full:
+                break
+
+    def flush(self):
+        """Emits every pending frame."""
+        for key in list(self.pending):
+            self._emit(key)
+
+    def _emit(self, key):
+        stream_id, frame_num = key
+        _, results = self.pending.pop(key)
+        missing = self.expected(stream_id) - results.keys()
+        composite = analytic_pb2.CompositeResults()
+        for analytic in sorted(results):
+            composite.results.add().CopyFrom(results[analytic])
+        for analytic in sorted(missing):
+            placeholder = composite.results.add()
+            placeholder.analytic.name = analytic
+            placeholder.frame.frame_num = frame_num
+            placeholder.data.status.code = code_pb2.DEADLINE_EXCEEDED
+            placeholder.data.status.message = MISSING_MESSAGE
+        if missing:
+            self.incomplete += 1
+        else:
+            self.joined += 1
+        self.emitted[key] = True
+        while len(self.emitted) > self.max_pending:
+            self.emitted.popitem(last=False)
+        self.callback(stream_id, frame_num, composite)
+
+    def stats(self):
+        return {"joined": self.joined, "incomplete": self.incomplete, "late": self.late, "pending": len(self.pending)}
+
+
+class JoinService:
+    """
+    Subscribes to the results of every analytic for a stream (or for every stream if 'stream_id' is "*") and
+    publishes the joined results of each frame as CompositeResults on "stream.<stream id>.joined". Every result of a
+    stream must reach the same joiner, so the work is scaled out by running a service per stream (or set of streams)
+    rather than with a queue group. Other keyword arguments are passed to the ResultJoiner.
+    """
+
+    def __init__(self, addr, stream_id="*", messenger_type="NATS", expire_interval=0.1, loop=None, consumer=None,
+                 producer=None, **kwargs):
+        self.subject = "stream.{!s}.analytic.*".format(stream_id)
+        self.expire_interval = expire_interval
+        self.joiner = ResultJoiner(self.publish, **kwargs)
+        self.producer = producer or ACEProducer(addr, value_serializer=lambda value: value.SerializeToString(),
+                                                messenger_type=messenger_type)
+        self.consumer = consumer or NATSConsumer(
+            addr, loop=loop, batch_callback=self.on_results,
+            value_deserializer=lambda data: analytic_pb2.ProcessedFrame.FromString(data))
+
+    def on_results(self, results):
+        for result in results:
+            try:
+                stream_id, analytic = parse_subject(result["subject"])
+            except ValueError:
+                logger.warning("Ignoring message on subject {!s}".format(result["subject"]))
+                continue
+            self.joiner.add(stream_id, analytic, result["data"])
+
+    def publish(self, stream_id, frame_num, composite):
+        self.producer.send("stream.{!s}.joined".format(stream_id), composite)
+
+    def _expire(self):
+        self.joiner.expire()
+        self.consumer.loop.call_later(self.expire_interval, self._expire)
+
+    def run(self):
+        logger.info("Joining results published on {!s}".format(self.subject))
+        self.consumer.subscribe(self.subject)
+        self.consumer.loop.call_later(self.expire_interval, self._expire)
+        try:
+            self.consumer.loop.run_forever()
+        finally:
+            self.joiner.flush()
+            self.producer.close()
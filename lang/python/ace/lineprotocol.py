@@ -0,0 +1,172 @@
+"""
+Encodes analytic results as InfluxDB line protocol.
+
+Lines are built directly from ProcessedFrame messages rather than from intermediate dictionaries, and use the same
+points (measurement, tags, fields and value types) as `AceDB.json_from_resp` with the same 'tag_keys'.
+"""
+import functools
+import math
+import numbers
+import re
+
+from ace import analytic_pb2
+
+DEFAULT_MEASUREMENT = "FrameInfo"
+# Columns written as tags by default. Values which change with every frame (frame_num, frame_timestamp) or session
+# (session_id) are written as fields, since each distinct set of tag values creates a new series in InfluxDB.
+DEFAULT_TAG_KEYS = frozenset(["analytic_name", "analytic_addr", "classification", "stream_address"])
+
+_TAG_ESCAPES = str.maketrans({"\\": "\\\\", " ": "\\ ", ",": "\\,", "=": "\\=", "\n": "\\n"})
+_STRING_ESCAPES = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n"})
+_NEEDS_TAG_ESCAPE = re.compile(r"[\\ ,=\n]")
+_NEEDS_STRING_ESCAPE = re.compile(r"[\\\"\n]")
+
+
+def escape_key(key):
+    """Escapes a measurement name, tag key, tag value or field key."""
+    key = str(key)
+    return key.translate(_TAG_ESCAPES) if _NEEDS_TAG_ESCAPE.search(key) else key
+
+
+# Measurement names, keys and class labels come from a small set, so their escaped forms are cached.
+_escape_name = functools.lru_cache(maxsize=1024)(escape_key)
+
+
+def format_field(value):
+    """Formats a field value, returning None if the value is not written (NaN, infinity, None and empty strings)."""
+    value_type = type(value)
+    if value_type is float:
+        return repr(value) if math.isfinite(value) else None
+    if value_type is int:
+        return "{:d}i".format(value)
+    if value_type is str:
+        if not value:
+            return None
+        if _NEEDS_STRING_ESCAPE.search(value):
+            value = value.translate(_STRING_ESCAPES)
+        return "\"" + value + "\""
+    if value_type is bool:
+        return "true" if value else "false"
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return format_field(value.decode("utf-8"))
+    if isinstance(value, numbers.Integral):
+        return format_field(int(value))
+    if isinstance(value, numbers.Real):
+        return format_field(float(value))
+    return format_field(str(value))
+
+
+def _tag_pairs(tags):
+    """Returns the escaped "key=value" pairs for 'tags', sorted by key. Tags with empty values are omitted."""
+    pairs = []
+    for key in sorted(tags):
+        value = tags[key]
+        if value is None or value == "":
+            continue
+        pairs.append(_escape_name(key) + "=" + escape_key(value))
+    return pairs
+
+
+def _field_pairs(fields):
+    pairs = []
+    for key, value in fields.items():
+        value = format_field(value)
+        if value is not None:
+            pairs.append(_escape_name(key) + "=" + value)
+    return pairs
+
+
+def point_line(measurement, tags, fields, timestamp=None):
+    """Encodes a single point. 'timestamp' is an integer in the precision used for the write (nanoseconds by default)."""
+    line = ",".join([_escape_name(measurement)] + _tag_pairs(tags or {}))
+    line += " " + ",".join(_field_pairs(fields))
+    if timestamp is not None:
+        line += " {:d}".format(int(timestamp))
+    return line
+
+
+def frame_lines(resp, measurement=DEFAULT_MEASUREMENT, tag_keys=DEFAULT_TAG_KEYS):
+    """
+    Encodes a ProcessedFrame as one line per region of interest (or a single line if there are none).
+
+    Columns named in 'tag_keys' are written as tags and the others as fields (see `DEFAULT_TAG_KEYS`). Tags set by
+    the analytic (`FrameData.tags`) are always written as tags.
+    """
+    frame, data, analytic = resp.frame, resp.data, resp.analytic
+    tags = {}
+    fields = {
+        "analytic_start_time": data.start_time_millis,
+        "analytic_end_time": data.end_time_millis,
+        "frame_byte_size": frame.frame_byte_size
+    }
+    for key, value in (("analytic_name", analytic.name), ("analytic_addr", analytic.addr),
+                       ("frame_num", frame.frame_num), ("frame_timestamp", frame.timestamp),
+                       ("stream_address", data.stream_addr), ("session_id", resp.session_id)):
+        (tags if key in tag_keys else fields)[key] = value
+    tags.update(data.tags)
+    fields.update(analytic.filters)
+    common = ",".join(_field_pairs(fields))
+
+    # The classification tag differs between the lines of a frame, so the tags are split around where it sorts.
+    classification = tags.pop("classification", None)
+    classification_tag = classification is not None or "classification" in tag_keys
+    head = [_escape_name(measurement)]
+    tail = []
+    for key in sorted(tags):
+        value = tags[key]
+        if value is not None and value != "":
+            (head if key < "classification" else tail).append(_escape_name(key) + "=" + escape_key(value))
+    head = ",".join(head)
+    tail = "".join("," + pair for pair in tail)
+
+    if not data.roi:
+        if classification:
+            head += ",classification=" + _escape_name(classification)
+        return ["{!s}{!s} confidence=0.0,{!s}".format(head, tail, common)]
+
+    lines = []
+    for roi in data.roi:
+        label = roi.classification if classification is None else classification
+        if not label:
+            tag, field = "", ""
+        elif classification_tag:
+            tag, field = ",classification=" + _escape_name(label), ""
+        else:
+            tag, field = "", "classification=" + format_field(label) + ","
+        # A NaN or infinite confidence is left out, as InfluxDB would reject the line (and the rest of its batch).
+        confidence = format_field(roi.confidence)
+        if confidence is not None:
+            field += "confidence=" + confidence + ","
+        corner1, corner2 = roi.box.corner1, roi.box.corner2
+        lines.append("{!s}{!s}{!s} {!s}box_x1={:d}i,box_y1={:d}i,box_x2={:d}i,box_y2={:d}i,{!s}".format(
+            head, tag, tail, field, corner1.x, corner1.y, corner2.x, corner2.y, common))
+    return lines
+
+
+def frames(results):
+    """
+    Returns the ProcessedFrames in 'results', which may be a ProcessedFrame, a ProcessedFrameBatch, CompositeResults
+    or an iterable of ProcessedFrames.
+    """
+    if isinstance(results, analytic_pb2.ProcessedFrame):
+        return [results]
+    if isinstance(results, analytic_pb2.ProcessedFrameBatch):
+        return results.processed_frames
+    if isinstance(results, analytic_pb2.CompositeResults):
+        return results.results
+    return results
+
+
+def encode(results, measurement=DEFAULT_MEASUREMENT, tag_keys=DEFAULT_TAG_KEYS):
+    """Encodes analytic results (see `frames`) as a list of lines."""
+    lines = []
+    for resp in frames(results):
+        lines.extend(frame_lines(resp, measurement, tag_keys))
+    return lines
+
+
+def dumps(results, measurement=DEFAULT_MEASUREMENT, tag_keys=DEFAULT_TAG_KEYS):
+    """Encodes analytic results as a single line protocol payload, ready to be sent to InfluxDB."""
+    return "\n".join(encode(results, measurement, tag_keys)) + "\n"
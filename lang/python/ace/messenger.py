@@ -1,31 +1,235 @@
 import asyncio
-
-from kafka import KafkaProducer
+import collections
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+
+import kafka
 from nats.aio.client import Client as NATS
-from nats.aio.errors import ErrConnectionClosed, ErrNoServers, ErrTimeout
+from nats.aio.errors import ErrConnectionClosed, ErrNoServers, ErrSlowConsumer, ErrTimeout
 
 from ace import analytic_pb2
+from ace.utils import percentile
+
+logger = logging.getLogger(__name__)
+
+# Compression which may be applied to message payloads. Payloads compressed with gzip start with its magic number,
+# which a serialized protobuf message never does, so consumers can detect them (see `decompress_payload`).
+COMPRESSION = (None, "gzip")
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+# The threads started to run event loops given to producers, so that a loop shared by several producers is run once.
+_loop_threads = weakref.WeakKeyDictionary()
+_loop_threads_lock = threading.Lock()
+
+
+def _run_loop(loop):
+    """Runs 'loop' on a daemon thread unless it is already running. Returns the thread, or None if none was started."""
+    with _loop_threads_lock:
+        thread = _loop_threads.get(loop)
+        if loop.is_running() or (thread is not None and thread.is_alive()):
+            return None
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        _loop_threads[loop] = thread
+        return thread
+
+
+def compress_payload(data, compression=None):
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=1)
+    return data
+
+
+def decompress_payload(data):
+    """Returns the payload of a message, decompressing it if it was compressed."""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    return data
 
 
 class NATSProducer:
-    def __init__(self, addr, value_serializer=None, loop=None):
-        """Light wrapper on a NATS client used to generate data and push it into a NATS subject."""
-        self.nc = NATS()
+    def __init__(self, addr, value_serializer=None, loop=None, max_pending=10000, flush_interval=0.1,
+                 flush_timeout=5.0, compression_type=None, client=None):
+        """
+        Light wrapper on a NATS client used to generate data and push it into a NATS subject.
+
+        The NATS client runs on its own event loop thread ('loop' is used if given and is run on that thread unless it
+        is already running; it may be shared with other producers and is left running when the producer is closed),
+        so `send` can be called from any thread and never waits for the server. Messages are
+        serialized by the caller and queued; at most 'max_pending' messages are held, after which the oldest are
+        dropped. Queued messages are handed to the client as soon as the loop is free and the connection is flushed
+        (a round trip to the server) every 'flush_interval' seconds. See `stats` for the pending, dropped and flush
+        latency counters. If 'compression_type' is "gzip", message payloads are compressed (see
+        `compress_payload`).
+        """
+        if compression_type not in COMPRESSION:
+            raise ValueError("Invalid compression specified: {!s}. Must be one of: {!s}".format(
+                compression_type, list(COMPRESSION)))
+        self.addr = addr
+        self.compression_type = compression_type
+        self.nc = client or NATS()
         self.value_serializer = value_serializer or (lambda value: value.encode())
-        self.loop = loop or asyncio.get_event_loop()
-        self.loop.run_until_complete(self.connect(addr))
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.flush_timeout = flush_timeout
+        self.queue = collections.deque()
+        self.sent = 0
+        self.dropped = 0
+        self.unflushed = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flush_latencies = collections.deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._wakeup_pending = False
+        # Held (on the event loop) while a batch is being published, so `flush` waits for a batch already in progress.
+        self._publishing = None
+        self._closed = False
+
+        self._owns_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
+        self._thread = _run_loop(self.loop)
+        self._call(self.connect(addr))
+        self._publisher = asyncio.run_coroutine_threadsafe(self._publish_loop(), self.loop)
+
+    def _call(self, coro, timeout=None):
+        """Runs 'coro' on the producer's event loop and waits for the result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
 
     async def connect(self, addr):
         await self.nc.connect(addr)
 
     def send(self, subject, msg):
-        """ Pushes data into a NATS subject"""
-        pub = self.nc.publish(subject, self.value_serializer(msg))
-        self.loop.run_until_complete(pub)
+        """ Queues data to be pushed into a NATS subject"""
+        data = compress_payload(self.value_serializer(msg), self.compression_type)
+        with self._lock:
+            if self._closed:
+                raise ValueError("Producer has been closed")
+            if len(self.queue) >= self.max_pending:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((subject, data))
+            if self._wakeup_pending or self._wakeup is None:
+                return
+            self._wakeup_pending = True
+        self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _publish_loop(self):
+        self._wakeup = asyncio.Event()
+        # Publish anything queued before the loop started.
+        self._wakeup.set()
+        last_flush = time.time()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, last_flush + self.flush_interval - time.time()))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            closed = await self._publish_queued()
+            if closed or (self.unflushed and time.time() - last_flush >= self.flush_interval):
+                await self._flush()
+                last_flush = time.time()
+            if closed:
+                return
+
+    async def _publish_queued(self):
+        """
+        Hands every queued message to the NATS client, after any batch already being published. Returns True if the
+        producer has been closed.
+        """
+        if self._publishing is None:
+            self._publishing = asyncio.Lock()
+        async with self._publishing:
+            with self._lock:
+                batch = list(self.queue)
+                self.queue.clear()
+                self._wakeup_pending = False
+                closed = self._closed
+            published = 0
+            try:
+                for subject, data in batch:
+                    await self.nc.publish(subject, data)
+                    published += 1
+            except Exception as e:
+                logger.warning("Failed to publish {:d} messages to NATS server at {!s}: {!s}".format(
+                    len(batch) - published, self.addr, e))
+            with self._lock:
+                self.dropped += len(batch) - published
+                self.sent += published
+                self.unflushed += published
+        return closed
+
+    async def _flush(self):
+        # Only the messages published before the flush starts are known to have reached the server when it returns.
+        with self._lock:
+            flushing = self.unflushed
+        start_time = time.time()
+        try:
+            await self.nc.flush(timeout=self.flush_timeout)
+        except Exception as e:
+            with self._lock:
+                self.flush_errors += 1
+            logger.warning("Failed to flush {:d} messages to NATS server at {!s}: {!s}".format(
+                flushing, self.addr, e))
+            return
+        self.flush_latencies.append(time.time() - start_time)
+        with self._lock:
+            self.flushes += 1
+            self.unflushed -= flushing
+
+    def flush(self, timeout=None):
+        """Blocks until every queued message (including any batch being published) has been published and flushed to the
+        server."""
+        async def flush():
+            await self._publish_queued()
+            await self._flush()
+        self._call(flush(), timeout)
+
+    def close(self, timeout=None):
+        """Publishes and flushes any queued messages, then closes the connection. The event loop thread is stopped
+        only if the producer created the loop."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._wakeup is not None:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+        try:
+            self._publisher.result(timeout)
+        finally:
+            self._call(self.nc.close(), timeout)
+            if self._owns_loop and self._thread:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join(timeout)
+
+    def stats(self):
+        """Returns the number of messages sent, pending (queued or not yet flushed) and dropped, along with the number
+        of flushes and the p50/p99 flush latency in milliseconds."""
+        with self._lock:
+            sent, pending, dropped = self.sent, len(self.queue) + self.unflushed, self.dropped
+        latencies = list(self.flush_latencies)
+        p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+        return {
+            "sent": sent,
+            "pending": pending,
+            "dropped": dropped,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "flush_latency_ms_p50": None if p50 is None else p50 * 1000,
+            "flush_latency_ms_p99": None if p99 is None else p99 * 1000
+        }
 
 
 class NATSConsumer:
-    def __init__(self, addr, value_deserializer=None, loop=None, callback_func=None):
+    def __init__(self, addr, value_deserializer=None, loop=None, callback_func=None, queue="", batch_size=100,
+                 batch_timeout=0.01, batch_callback=None, pending_msgs_limit=65536,
+                 pending_bytes_limit=64 * 1024 * 1024, client=None):
         """
         Light wrapper on a NATS client used to subscribe to a NATS subject and pull
         data from it. Default behavior is to print data to stdout as it is received. 
@@ -35,37 +239,272 @@ class NATSConsumer:
 
         By default the `.decode()` method is used to decode the data, but a custom value_deserializer
         may be specified. This function will recieve the data (as a byte string) as an argument and 
-        return the decoded value.
+        return the decoded value. Compressed payloads are decompressed first (see `decompress_payload`).
+
+        Messages are collected into batches of up to 'batch_size' messages (waiting at most 'batch_timeout' seconds
+        for a batch to fill) and decoded together. If 'batch_callback' is given, it is called with the list of
+        decoded messages of each batch rather than calling 'callback_func' for each message. Subscriptions join the
+        queue group 'queue' (if set), so that several consumers can share the messages of a subject. Each
+        subscription holds at most 'pending_msgs_limit' messages (and 'pending_bytes_limit' bytes) waiting to be
+        processed; the NATS client drops messages beyond these limits, which are counted in `stats` and logged.
         """
 
-        self.nc = NATS()
+        self.nc = client or NATS()
         self.value_deserializer = value_deserializer or (lambda data: data.decode())
+        self.queue = queue
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch_callback = batch_callback
+        self.pending_msgs_limit = pending_msgs_limit
+        self.pending_bytes_limit = pending_bytes_limit
+        self.received = 0
+        self.batches = 0
+        self.decode_errors = 0
+        self.slow_consumer_drops = collections.Counter()
+        self._batch_queue = None
+        self._batch_task = None
         self.loop = loop or asyncio.get_event_loop()
         self.loop.run_until_complete(self.connect(addr))
         self.callback_func = callback_func or (lambda value: print(value))
 
     async def subscription_handler(self, msg):
-        results = {
-            "subject": msg.subject,
-            "reply": msg.reply,
-            "data": self.value_deserializer(msg.data)
-        }
-        self.callback_func(results)
+        if self._batch_queue is None:
+            self._batch_queue = asyncio.Queue(maxsize=self.batch_size)
+            self._batch_task = asyncio.ensure_future(self._process_batches())
+        await self._batch_queue.put(msg)
+
+    async def _process_batches(self):
+        closed = False
+        while not closed:
+            batch = [await self._batch_queue.get()]
+            deadline = time.time() + self.batch_timeout
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._batch_queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            if batch[-1] is None:
+                # Sent by `close`
+                closed = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                self.process_batch(batch)
+            except Exception:
+                logger.exception("Error processing batch of {:d} messages".format(len(batch)))
+
+    def process_batch(self, msgs):
+        """Decodes a batch of messages and passes the results to the callback(s)."""
+        deserialize = self.value_deserializer
+        results = []
+        for msg in msgs:
+            try:
+                data = deserialize(decompress_payload(msg.data))
+            except Exception as e:
+                self.decode_errors += 1
+                logger.warning("Unable to decode message on subject {!s}: {!s}".format(msg.subject, e))
+                continue
+            results.append({"subject": msg.subject, "reply": msg.reply, "data": data})
+        self.received += len(msgs)
+        self.batches += 1
+        if self.batch_callback:
+            self.batch_callback(results)
+            return
+        for result in results:
+            self.callback_func(result)
+
+    async def error_handler(self, e):
+        if isinstance(e, ErrSlowConsumer):
+            self.slow_consumer_drops[e.subject] += 1
+            drops = self.slow_consumer_drops[e.subject]
+            # Log the first drop and then every 1000th, rather than every dropped message.
+            if drops % 1000 == 1:
+                logger.warning("Slow consumer on subject {!s}: {:d} messages dropped".format(e.subject, drops))
+            return
+        logger.error("NATS error: {!s}".format(e))
 
     async def connect(self, addr):
-        await self.nc.connect(addr)
+        await self.nc.connect(addr, error_cb=self.error_handler)
+
+    def subscribe(self, subject, queue=None):
+        """Subscribes to 'subject' as part of the queue group 'queue' (by default the consumer's queue group)."""
+        self.loop.run_until_complete(self.nc.subscribe(
+            subject, queue=self.queue if queue is None else queue, cb=self.subscription_handler,
+            pending_msgs_limit=self.pending_msgs_limit, pending_bytes_limit=self.pending_bytes_limit))
+
+    def close(self):
+        """Processes any messages waiting to be batched and closes the connection."""
+        async def close():
+            if self._batch_task:
+                await self._batch_queue.put(None)
+                await self._batch_task
+            await self.nc.close()
+        self.loop.run_until_complete(close())
+
+    def stats(self):
+        """Returns the number of messages received, batches processed, messages which could not be decoded and
+        messages dropped because the consumer could not keep up."""
+        return {
+            "received": self.received,
+            "batches": self.batches,
+            "decode_errors": self.decode_errors,
+            "slow_consumer_drops": sum(self.slow_consumer_drops.values())
+        }
+
 
-    def subscribe(self, subject):
-        self.loop.run_until_complete(self.nc.subscribe(subject, cb=self.subscription_handler))
+def stream_key(subject):
+    """Returns the stream id of an ACE subject ("stream.<stream id>.analytic.<analytic>"), or None."""
+    parts = subject.split(".")
+    if len(parts) > 1 and parts[0] == "stream":
+        return parts[1]
+    return None
 
 
-class KakfaProducer:
-    def __init__(self, addr, value_serializer=None, loop=None):
+class KafkaProducer:
+    def __init__(self, addr, value_serializer=None, loop=None, linger_ms=5, batch_size=64 * 1024,
+                 compression_type=None, key_func=stream_key, producer=None, **config):
+        """
+        Light wrapper on a Kafka producer with the same interface as the NATSProducer ('loop' is unused).
+
+        Messages are batched by the Kafka client: a batch is sent once it holds 'batch_size' bytes or after
+        'linger_ms' milliseconds, and is compressed with 'compression_type' ("gzip", "snappy", "lz4" or "zstd") if
+        set. Each message is keyed by 'key_func' applied to its subject (by default the stream id), so the results of
+        a stream always go to the same partition and keep their order. Other keyword arguments are passed to
+        `kafka.KafkaProducer`, and 'producer' may be given to use an existing (or stand-in) Kafka producer.
+        """
+        self.addr = addr
         self.value_serializer = value_serializer or (lambda value: value.encode())
-        self.producer = KafkaProducer(bootstrap_servers=addr, value_serializer=self.value_serializer)
+        self.key_func = key_func
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self.producer = producer or kafka.KafkaProducer(bootstrap_servers=addr, linger_ms=linger_ms,
+                                                        batch_size=batch_size, compression_type=compression_type,
+                                                        **config)
 
-    def send(self, topic, value):
-        self.producer.send(topic, value)
+    def send(self, subject, msg):
+        """ Pushes data into the Kafka topic 'subject'. Returns the future of the Kafka producer."""
+        key = self.key_func(subject) if self.key_func else None
+        future = self.producer.send(subject, value=self.value_serializer(msg),
+                                    key=key.encode() if key is not None else None)
+        future.add_callback(self._on_sent)
+        future.add_errback(self._on_error, subject)
+        return future
+
+    def _on_sent(self, metadata):
+        with self._lock:
+            self.sent += 1
+
+    def _on_error(self, e, subject):
+        with self._lock:
+            self.failed += 1
+        logger.warning("Failed to send message to Kafka topic {!s}: {!s}".format(subject, e))
+
+    def flush(self, timeout=None):
+        """Blocks until every message has been sent."""
+        self.producer.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        self.producer.close(timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "failed": self.failed}
+
+
+# Kept for backwards compatibility.
+KakfaProducer = KafkaProducer
+
+
+class DirectoryFrameStore:
+    """
+    Stores frames as files under 'directory' (e.g. a volume shared with the services which need the images), by the
+    key referenced in the published results.
+    """
+
+    def __init__(self, directory, extension=".jpg"):
+        self.directory = directory
+        self.extension = extension
+
+    def path(self, key):
+        parts = [re.sub(r"[^A-Za-z0-9_.-]", "_", part) for part in key.split("/")]
+        return os.path.join(self.directory, *parts) + self.extension
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def get(self, key):
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+
+class ResultPublisher:
+    """
+    Publishes analytic results, splitting any frame returned with a result from its metadata.
+
+    Results are published to 'subject' without the frame image, so that consumers which only need detections do not
+    have to download images. The image is either published as an InputFrame on 'frame_subject' or, if 'frame_store'
+    is given, written to the store. Either way the metadata carries the key of its frame in the FRAME_KEY_TAG tag
+    (see `frame_key`). If 'split_frames' is False, results are published unchanged.
+    """
+
+    FRAME_KEY_TAG = "frame_key"
+
+    def __init__(self, producer, subject, frame_subject=None, frame_store=None, stream_id=None, split_frames=True):
+        self.producer = producer
+        self.subject = subject
+        self.frame_subject = frame_subject or frame_subject_for(subject)
+        self.frame_store = frame_store
+        self.stream_id = stream_id or "default"
+        self.split_frames = split_frames
+
+    def frame_key(self, resp):
+        return "{!s}/{:d}".format(self.stream_id, resp.frame.frame_num)
+
+    def publish(self, resp):
+        frame = resp.frame.frame
+        if not self.split_frames or not frame.img:
+            self.producer.send(subject=self.subject, msg=resp)
+            return
+        key = self.frame_key(resp)
+        if self.frame_store:
+            self.frame_store.put(key, frame.img)
+        else:
+            input_frame = analytic_pb2.InputFrame()
+            input_frame.CopyFrom(resp.frame)
+            self.producer.send(subject=self.frame_subject, msg=input_frame)
+        meta = analytic_pb2.ProcessedFrame()
+        meta.CopyFrom(resp)
+        meta.frame.frame.ClearField("img")
+        meta.data.tags[self.FRAME_KEY_TAG] = key
+        self.producer.send(subject=self.subject, msg=meta)
+
+
+def frame_subject_for(subject):
+    """Returns the subject on which the frames for results published on 'subject' are published.
+
+    For "stream.<stream id>.analytic.<analytic>" this is "stream.<stream id>.frame.<analytic>", which is not matched
+    by subscriptions to the results of a stream ("stream.<stream id>.analytic.*").
+    """
+    parts = subject.split(".")
+    if len(parts) == 4 and parts[0] == "stream" and parts[2] == "analytic":
+        parts[2] = "frame"
+        return ".".join(parts)
+    return subject + ".frame"
 
 
 class ACEProducer:
@@ -80,17 +519,22 @@ class ACEProducer:
     The method used to serialize data can be specified with `value_serializer`
     """
 
-    def __init__(self, addr, value_serializer=None, messenger_type="NATS", loop=None):
+    def __init__(self, addr, value_serializer=None, messenger_type="NATS", loop=None, **kwargs):
         self.messenger_type = messenger_type
         producer_class = MESSENGER.get(messenger_type)
         if not producer_class:
             raise ValueError("Invalid messenger type specified. Got {}. Supported types are {}".format(messenger_type, list(MESSENGER.keys())))
-        self.producer = producer_class(addr=addr, value_serializer=value_serializer, loop=loop)
+        self.producer = producer_class(addr=addr, value_serializer=value_serializer, loop=loop, **kwargs)
+        self.addr = addr
 
     def send(self, subject, msg):
         """ Push the data in 'msg; into the queue with name `subject` """
         self.producer.send(subject, msg)
 
+    def close(self):
+        """ Sends any messages still held by the producer and closes its connection """
+        self.producer.close()
+
 
 MESSENGER = {
     "NATS": NATSProducer,
@@ -99,7 +543,7 @@ MESSENGER = {
 
 
 def ace_example_consumer(subject, loop, m_type="NATS"):
-    consumer = NATSConsumer(addr="localhost:4222", value_deserializer=lambda value: analytic_pb2.ProcessedFrame().FromString(value), loop=loop)
+    consumer = NATSConsumer(addr="localhost:4222", value_deserializer=lambda value: analytic_pb2.ProcessedFrame().FromString(decompress_payload(value)), loop=loop)
     consumer.subscribe(subject)
 
 
@@ -0,0 +1,155 @@
+"""
+Local columnar storage of analytic results for offline analysis.
+
+ParquetSink writes results to Parquet files (one row per region of interest) which can be loaded directly with
+pandas, pyarrow, DuckDB or Spark without running NATS or InfluxDB. It requires the optional pyarrow package.
+"""
+import logging
+import os
+import threading
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from ace.lineprotocol import frames
+
+logger = logging.getLogger(__name__)
+
+# Columns written for each region of interest, along with their types. Frames without any regions of interest are
+# written as a single row with empty classification, confidence and box columns.
+COLUMNS = (
+    ("session_id", "string"),
+    ("stream_address", "string"),
+    ("analytic_name", "string"),
+    ("analytic_addr", "string"),
+    ("frame_num", "int64"),
+    ("frame_timestamp", "float64"),
+    ("frame_byte_size", "int64"),
+    ("analytic_start_time", "int64"),
+    ("analytic_end_time", "int64"),
+    ("classification", "string"),
+    ("confidence", "float32"),
+    ("box_x1", "int32"),
+    ("box_y1", "int32"),
+    ("box_x2", "int32"),
+    ("box_y2", "int32"),
+    ("tags", "map"),
+    ("filters", "map")
+)
+
+
+def get_schema():
+    fields = []
+    for name, type_name in COLUMNS:
+        if type_name == "map":
+            fields.append(pa.field(name, pa.map_(pa.string(), pa.string())))
+        else:
+            fields.append(pa.field(name, getattr(pa, type_name)()))
+    return pa.schema(fields)
+
+
+class ParquetSink:
+    """
+    Writes ProcessedFrame results to rolling Parquet files in 'directory'.
+
+    Rows are buffered in memory and written as a row group once 'row_group_size' rows have been collected (or when
+    `flush` is called). A new file is started once the current file holds 'max_file_rows' rows or has been open for
+    'max_file_seconds' seconds. Files are named "<prefix>-<start time>-<sequence>.parquet" and are written under a
+    ".inprogress" suffix until they are closed, so readers only ever see complete files.
+    """
+
+    def __init__(self, directory, prefix="results", row_group_size=10000, max_file_rows=1000000,
+                 max_file_seconds=3600, compression="snappy"):
+        if pa is None:
+            raise ImportError("ParquetSink requires pyarrow. Install it with: pip install pyarrow")
+        self.directory = directory
+        self.prefix = prefix
+        self.row_group_size = row_group_size
+        self.max_file_rows = max_file_rows
+        self.max_file_seconds = max_file_seconds
+        self.compression = compression
+        self.schema = get_schema()
+        self.files = []
+        self.rows_written = 0
+        self._columns = {name: [] for name, _ in COLUMNS}
+        self._buffered = 0
+        self._writer = None
+        self._path = None
+        self._file_rows = 0
+        self._file_opened = 0.0
+        self._sequence = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write_proto(self, proto):
+        """Adds a ProcessedFrame (or a batch of results, see `lineprotocol.frames`) to the sink."""
+        with self._lock:
+            for resp in frames(proto):
+                self._add_frame(resp)
+            if self._buffered >= self.row_group_size:
+                self._write_row_group()
+
+    def _add_frame(self, resp):
+        frame, data, analytic = resp.frame, resp.data, resp.analytic
+        shared = (resp.session_id, data.stream_addr, analytic.name, analytic.addr, frame.frame_num, frame.timestamp,
+                  frame.frame_byte_size, data.start_time_millis, data.end_time_millis)
+        tags = list(data.tags.items())
+        filters = list(analytic.filters.items())
+        rois = [(roi.classification, roi.confidence, roi.box.corner1.x, roi.box.corner1.y, roi.box.corner2.x,
+                 roi.box.corner2.y) for roi in data.roi] or [(None,) * 6]
+        columns = [self._columns[name] for name, _ in COLUMNS]
+        for roi in rois:
+            for column, value in zip(columns, shared + roi + (tags, filters)):
+                column.append(value)
+        self._buffered += len(rois)
+
+    def _write_row_group(self):
+        if not self._buffered:
+            return
+        if self._writer and (self._file_rows >= self.max_file_rows or
+                             (self.max_file_seconds and time.time() - self._file_opened >= self.max_file_seconds)):
+            self._close_file()
+        if not self._writer:
+            self._open_file()
+        table = pa.Table.from_pydict(self._columns, schema=self.schema)
+        self._writer.write_table(table, row_group_size=len(table))
+        self._file_rows += self._buffered
+        self.rows_written += self._buffered
+        self._columns = {name: [] for name, _ in COLUMNS}
+        self._buffered = 0
+
+    def _open_file(self):
+        self._sequence += 1
+        name = "{!s}-{!s}-{:04d}.parquet".format(self.prefix, time.strftime("%Y%m%d-%H%M%S"), self._sequence)
+        self._path = os.path.join(self.directory, name)
+        self._writer = pq.ParquetWriter(self._path + ".inprogress", self.schema, compression=self.compression)
+        self._file_rows = 0
+        self._file_opened = time.time()
+        logger.info("Writing results to {!s}".format(self._path))
+
+    def _close_file(self):
+        self._writer.close()
+        os.rename(self._path + ".inprogress", self._path)
+        self.files.append(self._path)
+        self._writer = None
+
+    def flush(self):
+        """Writes any buffered rows as a row group."""
+        with self._lock:
+            self._write_row_group()
+
+    def close(self):
+        """Writes any buffered rows and closes the current file."""
+        with self._lock:
+            self._write_row_group()
+            if self._writer:
+                self._close_file()
+
+    def stats(self):
+        with self._lock:
+            return {"rows_written": self.rows_written, "buffered": self._buffered, "files": len(self.files)}
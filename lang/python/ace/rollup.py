@@ -0,0 +1,110 @@
+"""
+In-process rollups of analytic results.
+
+Rather than (or as well as) writing a point per region of interest, a Rollup aggregates results per stream, analytic,
+class and time window and emits one point per group when the window closes. Dashboards can then query these small
+aggregate series instead of the raw results.
+"""
+import math
+import threading
+import time
+
+from ace import lineprotocol
+
+DEFAULT_MEASUREMENT = "FrameRollup"
+
+
+class _Aggregate:
+    __slots__ = ("frames", "count", "confidence_sum", "confidence_max", "latency_sum", "latency_max")
+
+    def __init__(self):
+        self.frames = 0
+        self.count = 0
+        self.confidence_sum = 0.0
+        self.confidence_max = 0.0
+        self.latency_sum = 0
+        self.latency_max = 0
+
+    def fields(self):
+        fields = {
+            "frames": self.frames,
+            "count": self.count,
+            "mean_latency_ms": float(self.latency_sum) / self.frames,
+            "max_latency_ms": self.latency_max
+        }
+        if self.count:
+            fields["mean_confidence"] = self.confidence_sum / self.count
+            fields["max_confidence"] = self.confidence_max
+        return fields
+
+
+class Rollup:
+    """
+    Aggregates results into 'window' second windows keyed by stream, analytic and classification.
+
+    For each group a point is emitted with the number of frames and detections ("count"), the mean and max detection
+    confidence and the mean and max analytic latency. Frames without detections are counted in a group without a
+    classification. Results are placed in windows by the time the analytic finished processing the frame (falling
+    back to the local clock), and a window is emitted once it is 'lateness' seconds old. Results which arrive after
+    their window was emitted are counted in `late` and discarded.
+    """
+
+    def __init__(self, window=10.0, lateness=None, measurement=DEFAULT_MEASUREMENT, clock=time.time):
+        if window <= 0:
+            raise ValueError("Invalid rollup window specified: {!s}. Must be greater than 0".format(window))
+        self.window = window
+        self.lateness = window if lateness is None else lateness
+        self.measurement = measurement
+        self.clock = clock
+        self.groups = {}
+        self.emitted_until = 0.0
+        self.late = 0
+        self._lock = threading.Lock()
+
+    def add(self, results):
+        """Adds a ProcessedFrame (or a batch of results, see `lineprotocol.frames`) to the rollup."""
+        with self._lock:
+            for resp in lineprotocol.frames(results):
+                self._add_frame(resp)
+
+    def _add_frame(self, resp):
+        data = resp.data
+        end_time = data.end_time_millis / 1000.0 if data.end_time_millis else self.clock()
+        start = math.floor(end_time / self.window) * self.window
+        if start < self.emitted_until:
+            self.late += 1
+            return
+        latency = max(0, data.end_time_millis - data.start_time_millis)
+        base = (start, data.stream_addr, resp.analytic.name)
+        labels = {roi.classification for roi in data.roi} if data.roi else {""}
+        for label in labels:
+            agg = self.groups.get(base + (label,))
+            if agg is None:
+                agg = self.groups[base + (label,)] = _Aggregate()
+            agg.frames += 1
+            agg.latency_sum += latency
+            agg.latency_max = max(agg.latency_max, latency)
+        for roi in data.roi:
+            agg = self.groups[base + (roi.classification,)]
+            agg.count += 1
+            agg.confidence_sum += roi.confidence
+            agg.confidence_max = max(agg.confidence_max, roi.confidence)
+
+    def collect(self, force=False):
+        """Returns the line protocol points for every closed window (or for every window if 'force' is set)."""
+        with self._lock:
+            if force:
+                closed = sorted(self.groups)
+                if closed:
+                    self.emitted_until = max(self.emitted_until, closed[-1][0] + self.window)
+            else:
+                self.emitted_until = max(self.emitted_until,
+                                         math.floor((self.clock() - self.lateness) / self.window) * self.window)
+                closed = sorted(key for key in self.groups if key[0] < self.emitted_until)
+            groups = [(key, self.groups.pop(key)) for key in closed]
+        lines = []
+        for (start, stream_addr, analytic_name, classification), agg in groups:
+            tags = {"stream_address": stream_addr, "analytic_name": analytic_name, "classification": classification}
+            timestamp = int(round(start * 1e9))
+            lines.append(lineprotocol.point_line(self.measurement, tags, agg.fields(), timestamp=timestamp))
+        return lines
@@ -13,6 +13,7 @@ import numpy as np
 from google.protobuf import json_format
 
 from ace import analytic_pb2, analytic_pb2_grpc
+from ace.messenger import ResultPublisher
 from ace.utils import annotate_frame
 
 os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;udp"
@@ -175,8 +176,11 @@ class RTSPHandler:
         self.num_workers = num_workers
         self.is_running = False
         self.kill = threading.Event()
-        self.producer = producer
+        self.producer = None
+        self.publisher = None
+        self.stream_id = stream_id
         self.db_client = None
+        self.sinks = []
         self.verbose = verbose
         self.return_frame = return_frame
         self.params = params
@@ -202,10 +206,10 @@ class RTSPHandler:
             print("ERROR CREATING TOPIC NAME: {!s}".format(e))
             self.subject = "stream.default.analytic.default"
 
-        if self.producer:
-            print("WRITING UPDATES TO SUBJECT {!s} AT ADDRESS {!s}".format(sefl.subject, self.producer.addr))
+        if producer:
+            self.add_producer(producer)
         else:
-            print("No NATS address given.") 
+            print("No NATS address given.")
 
     def create_workers(self):
         """ Returns a FrameWorker equal to the number of analytics in use. The FrameWorker reads a frame and sends it to the queue."""
@@ -215,12 +219,23 @@ class RTSPHandler:
             workers.append(wkr)
         return workers
 
-    def add_producer(self, producer):
+    def add_producer(self, producer, frame_store=None, split_frames=True):
+        """
+        Publishes results with 'producer'. Frames returned with the results are published separately from the
+        metadata, either on the frame subject or to 'frame_store' (see `ResultPublisher`).
+        """
         self.producer = producer
+        self.publisher = ResultPublisher(producer, self.subject, frame_store=frame_store, stream_id=self.stream_id,
+                                         split_frames=split_frames)
+        print("WRITING UPDATES TO SUBJECT {!s} AT ADDRESS {!s}".format(self.subject, producer.addr))
 
     def add_database(self, db_client):
         self.db_client = db_client
 
+    def add_sink(self, sink):
+        """Adds a local results sink (e.g. a ParquetSink), which is passed each result and closed on termination."""
+        self.sinks.append(sink)
+
     def run(self):
         """
         Run service to read from RTSP stream and call registered function.
@@ -243,20 +258,25 @@ class RTSPHandler:
                     frame_batch_output = self.output_queue.pop()
                     resp, frame = frame_batch_output[0][2]
                     
-                    if self.producer:
+                    if self.publisher:
                         try:
                             logger.debug("Publishing to topic: {!s}".format(self.subject))
-                            print("Publishing to topic: {!s}".format(self.subject))
-                            self.producer.send(subject=self.subject, msg=resp)
+                            self.publisher.publish(resp)
                         except Exception:
                             logger.exception("Trying to publish results to message service (as topic {!s})".format(
                                 self.subject))
                     if self.db_client:
                         try:
-                            logger.debug("Database Entry: \n{}".format(self.db_client.json_from_resp(resp)))
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug("Database Entry: \n{}".format(self.db_client.json_from_resp(resp)))
                             self.db_client.write_proto(resp)
                         except Exception as e:
                             raise ValueError("Error writing database entry: {!s}".format(e))
+                    for sink in self.sinks:
+                        try:
+                            sink.write_proto(resp)
+                        except Exception:
+                            logger.exception("Trying to write results to sink {!s}".format(sink))
 
 
                     if self.verbose:
@@ -280,4 +300,10 @@ class RTSPHandler:
                     break
             time.sleep(0.2)
         logger.debug("Workers safely shut down")
+        if self.producer:
+            self.producer.close()
+        if self.db_client:
+            self.db_client.close()
+        for sink in self.sinks:
+            sink.close()
         logger.info("RTSP service terminated")
@@ -71,9 +71,9 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
 
 
 class GstServer(GstRtspServer.RTSPServer):
-    def __init__(self, cap, endpoint="/test", verbose=False, **properties):
+    def __init__(self, cap, endpoint="/test", verbose=False, width=640, height=480, **properties):
         super(GstServer, self).__init__(**properties)
-        self.factory = SensorFactory(cap, verbose=verbose)
+        self.factory = SensorFactory(cap, width=width, height=height, verbose=verbose)
         self.factory.set_shared(True)
         self.get_mount_points().add_factory(endpoint, self.factory)
         self.attach(None)
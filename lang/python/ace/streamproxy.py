@@ -1,39 +1,139 @@
 import argparse
+import collections
 import logging
 import os
 import threading
 import time
-from queue import PriorityQueue
 
 import cv2
 import numpy as np
 
 from ace import analytic_pb2, analytic_pb2_grpc
-from ace.aceclient import AnalyticClient
+from ace.aceclient import AnalyticClient, AnalyticPipeline
 from ace.analyticservice import AnalyticService
-from ace.utils import annotate_frame
+from ace.grpcservice import AnalyticServiceGRPC
+from ace.utils import annotate_frame, percentile
 
 logger = logging.getLogger(__name__)
 
 class StreamingProxy:
-    def __init__(self, name, port=3000, analytic_addr=None):
-        self.service = AnalyticService(name, port=port)
-        self.service.RegisterProcessVideoFrame(self.proxy_process_frame)
-        self.analytic_addr = analytic_addr
+    """
+    Forwards frames to the analytic at 'analytic_addr' and returns its results.
+
+    Frames which arrive encoded (over gRPC, if 'grpc_port' is given) are forwarded as the original bytes without being
+    decoded or re-encoded. Frames read from a stream through the configuration endpoint are encoded once at
+    'jpeg_quality'. The frame number, timestamp and session id are forwarded with each frame, and up to
+    'num_workers' frames are in flight to the analytic at once. If 'sink_dir' is given, the results for streams read
+    through the configuration endpoint are also written there as Parquet files.
+    """
+
+    def __init__(self, name, port=3000, analytic_addr=None, num_workers=4, jpeg_quality=95, grpc_port=None,
+                 timeout=None, sink_dir=None):
         if not analytic_addr:
             raise ValueError("Analytic address must be specified")
-        self.client = AnalyticClient(addr=self.analytic_addr)
+        self.service = AnalyticService(name, port=port, num_workers=num_workers, sink_dir=sink_dir)
+        self.service.RegisterProcessVideoFrame(self.proxy_process_frame)
+        self.analytic_addr = analytic_addr
+        self.num_workers = num_workers
+        self.jpeg_quality = jpeg_quality
+        self.grpc_port = grpc_port
+        self.client = AnalyticClient(addr=self.analytic_addr, timeout=timeout)
+        self.grpc_service = None
+        if grpc_port:
+            self.grpc_service = AnalyticServiceGRPC()
+            self.grpc_service.RegisterProcessVideoFrame(self.proxy_process_frame)
 
     def Run(self):
+        if self.grpc_service:
+            threading.Thread(target=self.grpc_service.Run, daemon=True,
+                             kwargs=dict(analytic_port=int(self.grpc_port),
+                                         max_workers=max(10, self.num_workers))).start()
         self.service.Run()
 
     def proxy_process_frame(self, handler):
-        resp = self.client.process_frame(handler.get_frame(), session_id=handler.resp.session_id)
-        handler.resp = resp
+        frame = handler.get_frame("JPEG", quality=self.jpeg_quality)
+        resp = self.client.process_frame(frame, session_id=handler.resp.session_id, frame_num=handler.frame_number,
+                                         timestamp=handler.timestamp)
+        handler.merge_response(resp)
+
+
+class LatestFrameBuffer:
+    """
+    A bounded buffer of captured frames. Once 'size' frames are waiting, the oldest is dropped for each new frame, so
+    a slow consumer always gets recent frames and memory use stays bounded. With the default size of 1 the consumer
+    always receives the latest frame.
+    """
+
+    def __init__(self, size=1):
+        if size < 1:
+            raise ValueError("Invalid buffer size specified: {!s}. Must be at least 1".format(size))
+        self.frames = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Returns the oldest waiting frame, or None if the buffer is closed (or 'timeout' expires) with none left."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.frames or self.closed, timeout)
+            return self.frames.popleft() if self.frames else None
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class FrameTimings:
+    """Records when each frame was captured, sent to the analytic, received back and rendered."""
+
+    STAGES = ("capture", "send", "receive", "render")
+
+    def __init__(self, max_frames=100000):
+        self.frames = collections.deque(maxlen=max_frames)
+
+    def add(self, capture, send, receive, render):
+        self.frames.append((capture, send, receive, render))
+
+    def report(self, dropped=0):
+        """Returns the end-to-end latency percentiles, per stage medians (in ms) and the achieved frame rate."""
+        if not self.frames:
+            return {"frames": 0, "dropped": dropped}
+        timings = np.array(self.frames)
+        latency = 1000 * (timings[:, 3] - timings[:, 0])
+        elapsed = timings[-1, 3] - timings[0, 3]
+        report = {
+            "frames": len(timings),
+            "dropped": dropped,
+            "fps": (len(timings) - 1) / elapsed if elapsed > 0 else 0.0,
+            "latency_ms_p50": percentile(latency, 50),
+            "latency_ms_p95": percentile(latency, 95),
+            "latency_ms_p99": percentile(latency, 99)
+        }
+        for i, stage in enumerate(self.STAGES[1:], 1):
+            report["{!s}_ms_p50".format(stage)] = percentile(1000 * (timings[:, i] - timings[:, i - 1]), 50)
+        return report
 
 
 class TestClient:
-    def __init__(self, videosrc, analytic_addr="localhost:50051", verbose=False):
+    """
+    Reads a stream, sends its frames to an analytic and displays the results.
+
+    Captured frames wait in a LatestFrameBuffer of 'buffer_size' frames, so frames are dropped rather than queued
+    without bound when the analytic can't keep up. If 'instrument' is set, the capture, send, receive and render time
+    of each frame is recorded and the end-to-end latency percentiles and achieved frame rate are printed on exit. The
+    client stops after 'duration' seconds, if given, and only displays frames if 'display' is set.
+    """
+
+    def __init__(self, videosrc, analytic_addr="localhost:50051", verbose=False, window=4, buffer_size=1,
+                 instrument=False, display=True, duration=None):
         self.src = videosrc
         self.analytic_addr = analytic_addr
         self.cap = cv2.VideoCapture(self.src, cv2.CAP_FFMPEG)
@@ -45,58 +145,101 @@ class TestClient:
         if self.analytic_addr:
             print("Establishing gRPC connection with analytic at {!s}".format(self.analytic_addr))
             self.client = AnalyticClient(self.analytic_addr)
+            self.pipeline = AnalyticPipeline(self.client, window=window, stamp=True)
         self.current_frame = 0
-        self.buffer = PriorityQueue()
+        self.buffer = LatestFrameBuffer(buffer_size)
+        self.timings = FrameTimings() if instrument else None
+        self.display_frames = display
+        self.duration = duration
 
     def load_frames(self):
         if self.verbose:
             print("Initializing frame loader")
-        while self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if not ret:
-                print("Stream unavailable")
-                return
-            self.buffer.put(
-                (-1 * self.current_frame, (time.time(), self.current_frame, frame)))
-            self.current_frame += 1
+        try:
+            while self.cap.isOpened():
+                ret, frame = self.cap.read()
+                if not ret:
+                    print("Stream unavailable")
+                    return
+                self.buffer.put((time.time(), self.current_frame, frame))
+                self.current_frame += 1
+        finally:
+            self.buffer.close()
 
     def start(self):
         t = threading.Thread(target=self.load_frames, daemon=True)
         t.start()
-        while self.buffer.empty():
-            print("Loading buffer")
-            time.sleep(.5)
-        print("Buffer loaded, starting stream")
+        print("Starting stream")
 
     def run(self):
         self.start()
+        try:
+            self._run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.timings:
+                self.print_report()
+
+    def _run(self):
         analytic = analytic_pb2.AnalyticData()
         if self.analytic_addr:
             analytic.addr = self.analytic_addr
         window_names = ["Analytic Results"]
         classes = {}
         db = None
-        curr_frame = 0
-        while True:
-            if self.buffer.empty():
-                time.sleep(1)
-            _, frame_obj = self.buffer.get()
-            # print(frame_obj)
-            if frame_obj[1] < curr_frame:
-                time.sleep(0.1)
-                continue
-            curr_frame = frame_obj[1]
-            frame = frame_obj[2]
-            if self.analytic_addr:
-                resp = self.client.process_frame(frame)
-                resp.analytic.MergeFrom(analytic)
-                if resp.frame.frame.ByteSize() > 0:
-                    img_bytes = np.fromstring(resp.frame.frame.img, dtype=np.uint8)
-                    frame = cv2.imdecode(img_bytes, 1)
-                frame = annotate_frame(resp, frame, classes, db)
-            cv2.imshow(window_names[0], frame)
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+        end_time = time.time() + self.duration if self.duration else None
+        while end_time is None or time.time() < end_time:
+            frame_obj = self.buffer.get(timeout=end_time - time.time() if end_time else None)
+            if frame_obj is None:
                 break
+            capture_time, curr_frame, frame = frame_obj
+            if not self.analytic_addr:
+                if not self.render(window_names[0], frame, (capture_time, capture_time, capture_time)):
+                    return
+                continue
+            # Frames are pipelined, so the results shown are for the oldest frames which have completed.
+            context = (frame, capture_time, time.time())
+            results = self.pipeline.submit(frame, context, frame_num=curr_frame, timestamp=capture_time)
+            if not self.show_results(results, analytic, window_names[0], classes, db):
+                return
+        if self.analytic_addr:
+            self.show_results(self.pipeline.flush(), analytic, window_names[0], classes, db)
+
+    def show_results(self, results, analytic, window_name, classes, db):
+        """Renders the results returned by the pipeline, returning False if the user has asked to quit."""
+        for (frame, capture_time, send_time), resp, receive_time in results:
+            resp.analytic.MergeFrom(analytic)
+            if resp.frame.frame.ByteSize() > 0:
+                img_bytes = np.frombuffer(resp.frame.frame.img, dtype=np.uint8)
+                frame = cv2.imdecode(img_bytes, 1)
+            frame = annotate_frame(resp, frame, classes, db)
+            if not self.render(window_name, frame, (capture_time, send_time, receive_time)):
+                return False
+        return True
+
+    def render(self, window_name, frame, times):
+        """Shows the frame (if displaying) and records its timings, returning False if the user has asked to quit."""
+        keep_going = self.display(window_name, frame) if self.display_frames else True
+        if self.timings:
+            self.timings.add(*times, time.time())
+        return keep_going
+
+    def display(self, window_name, frame):
+        """Shows the frame, returning False if the user has asked to quit."""
+        cv2.imshow(window_name, frame)
+        return not (cv2.waitKey(1) & 0xFF == ord('q'))
+
+    def print_report(self):
+        report = self.timings.report(dropped=self.buffer.dropped)
+        print("Frames rendered: {!s} (dropped before sending: {!s})".format(report["frames"], report["dropped"]))
+        if not report["frames"]:
+            return
+        print("Achieved fps: {:.1f}".format(report["fps"]))
+        print("End-to-end latency (ms): p50 {:.1f}, p95 {:.1f}, p99 {:.1f}".format(
+            report["latency_ms_p50"], report["latency_ms_p95"], report["latency_ms_p99"]))
+        print("Median stage latency (ms): buffered {:.1f}, analytic {:.1f}, render {:.1f}".format(
+            report["send_ms_p50"], report["receive_ms_p50"], report["render_ms_p50"]))
 
 
 if __name__ == "__main__":
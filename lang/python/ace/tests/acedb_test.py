@@ -0,0 +1,109 @@
+import time
+
+from ace import analytic_pb2
+from ace.aceclient import AceDB
+
+
+class _InfluxClient:
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    def write_points(self, points, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("database unavailable")
+        self.batches.append(list(points))
+
+
+def get_db(influx_client, **kwargs):
+    db = AceDB(**kwargs)
+    db.client = influx_client
+    return db
+
+
+def get_response(frame_num, classes=("person",)):
+    resp = analytic_pb2.ProcessedFrame(session_id="session")
+    resp.analytic.name = "test-analytic"
+    resp.frame.frame_num = frame_num
+    for c in classes:
+        roi = resp.data.roi.add()
+        roi.classification = c
+        roi.confidence = 0.5
+    return resp
+
+
+def test_batched_writes():
+    influx = _InfluxClient()
+    db = get_db(influx, batch_size=4, flush_interval=10)
+    for i in range(10):
+        db.write_proto(get_response(i))
+    assert db.flush(timeout=5)
+    db.close()
+    assert [len(b) for b in influx.batches] == [4, 4, 2]
+    assert db.stats() == {"written": 10, "buffered": 0, "dropped": 0, "failed_writes": 0}
+
+
+def test_retry():
+    influx = _InfluxClient(failures=2)
+    db = get_db(influx, batch_size=2, flush_interval=0.01, retries=1, retry_delay=0.01)
+    db.write_proto(get_response(1, classes=("a", "b")))
+    assert db.flush(timeout=5)
+    db.close()
+    # The first attempt and its retry fail, so the batch goes back on the buffer and is written on the next pass
+    assert db.stats()["failed_writes"] == 1
+    assert db.stats()["written"] == 2
+
+
+def test_close_when_unavailable():
+    influx = _InfluxClient(failures=1000)
+    db = get_db(influx, batch_size=2, flush_interval=0.01, retries=100, retry_delay=10)
+    for i in range(5):
+        db.write_proto(get_response(i))
+    start = time.time()
+    db.close(timeout=5)
+    # Closing interrupts the backoff and stops the retries, so the points which cannot be written are dropped.
+    assert time.time() - start < 1
+    assert not db._writer.is_alive()
+    assert db.stats()["dropped"] == 5
+    assert db.stats()["buffered"] == 0
+
+
+def test_drop_oldest():
+    influx = _InfluxClient()
+    db = get_db(influx, batch_size=100, flush_interval=10, max_buffer=3)
+    for i in range(5):
+        db.write_proto(get_response(i))
+    assert [",frame_num={:d}i".format(i) in line for i, line in zip([2, 3, 4], db.buffer)] == [True] * 3
+    db.close()
+    assert db.stats()["dropped"] == 2
+    assert len(influx.batches[0]) == 3
+
+
+def test_rollup_only():
+    influx = _InfluxClient()
+    db = get_db(influx, batch_size=0, rollup_window=60, write_raw=False)
+    for i in range(3):
+        db.write_proto(get_response(i, classes=("person", "person", "car")))
+    assert not influx.batches
+    db.close()
+    lines = influx.batches[0]
+    assert len(lines) == 2
+    assert all(line.startswith("FrameRollup,") for line in lines)
+    assert any("classification=person" in line and "count=6i" in line and "frames=3i" in line for line in lines)
+
+
+def test_unbuffered():
+    influx = _InfluxClient()
+    db = get_db(influx, batch_size=0)
+    db.write_proto(get_response(1))
+    assert len(influx.batches) == 1
+
+
+if __name__ == "__main__":
+    test_batched_writes()
+    test_retry()
+    test_close_when_unavailable()
+    test_drop_oldest()
+    test_rollup_only()
+    test_unbuffered()
@@ -0,0 +1,155 @@
+import time
+
+import grpc
+import pytest
+
+from ace.aceclient import AnalyticMultiClient
+from ace.balancer import HedgedCall, HedgePolicy, ReplicaPool
+
+
+class _Call:
+    def __init__(self, code):
+        self._code = code
+
+    def cancelled(self):
+        return False
+
+    def code(self):
+        return self._code
+
+
+class _Future(_Call):
+    def __init__(self, timeout):
+        super().__init__(None)
+        self.timeout = timeout
+        self.callbacks = []
+        self.value = None
+
+    def add_done_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def done(self):
+        return self._code is not None
+
+    def cancel(self):
+        self.finish(grpc.StatusCode.CANCELLED)
+
+    def finish(self, code, value=None):
+        if self.done():
+            return
+        self._code, self.value = code, value
+        for fn in self.callbacks:
+            fn(self)
+
+    def result(self):
+        return self.value
+
+
+class _Pool:
+    def __init__(self):
+        self.calls = []
+
+    def future(self, method, req, exclude=(), timeout=None):
+        self.calls.append(_Future(timeout))
+        return len(self.calls), self.calls[-1]
+
+
+def get_pool(policy):
+    return ReplicaPool(["localhost:1", "localhost:2", "localhost:3"], policy=policy, max_failures=2)
+
+
+def test_round_robin():
+    pool = get_pool("round_robin")
+    picks = [pool.pick().addr for _ in range(6)]
+    assert picks == ["localhost:1", "localhost:2", "localhost:3"] * 2
+    pool.close()
+
+
+def test_least_outstanding():
+    pool = get_pool("least_outstanding")
+    pool.replicas[0].outstanding = 2
+    pool.replicas[1].outstanding = 1
+    assert pool.pick().addr == "localhost:3"
+    pool.replicas[2].outstanding = 1
+    assert set(pool.pick().addr for _ in range(4)) == set(["localhost:2", "localhost:3"])
+    pool.close()
+
+
+def test_ejection():
+    pool = get_pool("round_robin")
+    bad = pool.replicas[1]
+    pool._finish(bad, _Call(grpc.StatusCode.UNAVAILABLE))
+    assert not bad.is_ejected()
+    pool._finish(bad, _Call(grpc.StatusCode.UNAVAILABLE))
+    assert bad.is_ejected()
+    assert "localhost:2" not in [pool.pick().addr for _ in range(6)]
+    assert pool.pick(exclude=[pool.replicas[0], pool.replicas[2]]) is bad
+
+    # Overload is not a reason to eject a replica
+    pool._finish(pool.replicas[0], _Call(grpc.StatusCode.RESOURCE_EXHAUSTED))
+    pool._finish(pool.replicas[0], _Call(grpc.StatusCode.RESOURCE_EXHAUSTED))
+    assert not pool.replicas[0].is_ejected()
+    pool.close()
+
+
+def test_hedge_policy():
+    policy = HedgePolicy(percentile=90, min_delay=0.002, min_samples=10)
+    for _ in range(9):
+        policy.add_latency(0.001)
+    assert policy.delay() is None
+    policy.add_latency(0.001)
+    assert policy.delay() == 0.002
+    for ms in range(1, 101):
+        policy.add_latency(ms / 1000.0)
+    assert 0.08 < policy.delay() < 0.1
+
+    policy.count(requests=10, hedges_sent=2, hedges_won=1)
+    stats = policy.stats()
+    assert stats["hedge_rate"] == 0.2
+    assert stats["hedge_win_rate"] == 0.5
+
+
+def test_hedged_call():
+    policy = HedgePolicy(min_delay=0.05, min_samples=1)
+    policy.add_latency(0.001)
+    pool = _Pool()
+    call = HedgedCall(pool, "ProcessVideoFrame", None, policy, {"timeout": 1.0})
+    finished = []
+    call.add_done_callback(finished.append)
+    with pytest.raises(grpc.FutureTimeoutError):
+        call.result(timeout=0.01)
+    deadline = time.time() + 5
+    while len(pool.calls) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    # The hedge is only given the time left before the original deadline.
+    assert 0.99 < pool.calls[0].timeout <= 1.0
+    assert pool.calls[1].timeout < 0.96
+    pool.calls[1].finish(grpc.StatusCode.OK, "hedge")
+    assert finished == [call]
+    assert call.result(timeout=0) == "hedge"
+    assert pool.calls[0].code() == grpc.StatusCode.CANCELLED
+    call.add_done_callback(finished.append)
+    assert finished == [call, call]
+
+
+def test_multi_client_replicas():
+    multi = AnalyticMultiClient()
+    multi.connect(["localhost:1"])
+    single = multi.get_client("localhost:1")
+    replicated = multi.get_client("localhost:1", replica_addrs=["localhost:2"])
+    assert replicated is not single
+    assert [r.addr for r in single.pool.replicas] == ["localhost:1"]
+    assert [r.addr for r in replicated.pool.replicas] == ["localhost:1", "localhost:2"]
+    assert multi.get_client("localhost:1", replica_addrs=["localhost:2"]) is replicated
+    changed = multi.get_client("localhost:1", replica_addrs=["localhost:2", "localhost:3"])
+    assert [r.addr for r in changed.pool.replicas] == ["localhost:1", "localhost:2", "localhost:3"]
+    multi.close()
+
+
+if __name__ == "__main__":
+    test_round_robin()
+    test_least_outstanding()
+    test_ejection()
+    test_hedge_policy()
+    test_hedged_call()
+    test_multi_client_replicas()
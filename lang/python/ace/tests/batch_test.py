@@ -0,0 +1,65 @@
+import socket
+
+import cv2
+import numpy as np
+
+from ace import analytic_pb2
+from ace.aceclient import AnalyticClient
+from ace.analytichandler import BatchHandler
+from ace.grpcservice import AnalyticServiceGRPC
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def get_jpeg(value):
+    frame = np.full((48, 64, 3), value, dtype=np.uint8)
+    return cv2.imencode(".jpeg", frame)[1].tobytes()
+
+
+def detect(handler):
+    """Labels each frame of the batch with its mean brightness."""
+    for i, frame in enumerate(handler.get_frame_batch()):
+        handler.add_bounding_box(str(int(round(frame.mean() / 10.0) * 10)), 0.5, 4, 4, 20, 20, frame_index=i)
+
+
+def test_from_request():
+    req = analytic_pb2.ProcessFrameBatchRequest(session_id="a")
+    for frame_num, value in ((3, 50), (4, 200)):
+        input_frame = req.frame.add(frame_num=frame_num, timestamp=frame_num / 4.0)
+        input_frame.frame.img = get_jpeg(value)
+    handler = BatchHandler.from_request(req)
+    detect(handler)
+    resp = handler.get_response()
+    assert [r.frame.frame_num for r in resp.processed_frames] == [3, 4]
+    assert [r.frame.timestamp for r in resp.processed_frames] == [0.75, 1.0]
+    assert [r.data.roi[0].classification for r in resp.processed_frames] == ["50", "200"]
+    assert all(r.session_id == "a" for r in resp.processed_frames)
+
+
+def test_round_trip():
+    port = free_port()
+    svc = AnalyticServiceGRPC()
+    svc.register_name("batch_detector")
+    svc.RegisterProcessFrameBatch(detect)
+    server = svc.Start(analytic_port=port, max_workers=2)
+    client = AnalyticClient("localhost:{!s}".format(port))
+    try:
+        resp = client.process_frame_batch([get_jpeg(50), get_jpeg(200)], frame_nums=[7, 8], timestamps=[1.5, 1.75],
+                                          session_id="b")
+    finally:
+        client.close()
+        server.stop(0)
+    assert len(resp.processed_frames) == 2
+    assert [r.frame.frame_num for r in resp.processed_frames] == [7, 8]
+    assert [r.frame.timestamp for r in resp.processed_frames] == [1.5, 1.75]
+    assert [r.data.roi[0].classification for r in resp.processed_frames] == ["50", "200"]
+    assert all(r.session_id == "b" and r.analytic.name == "batch_detector" for r in resp.processed_frames)
+
+
+if __name__ == "__main__":
+    test_from_request()
+    test_round_trip()
@@ -0,0 +1,215 @@
+import logging
+
+import cv2
+import numpy as np
+
+from ace import analytic_pb2, utils
+from ace.analytichandler import FrameHandler
+from ace.grpcservice import ProxySvc
+from ace.utils import FilterProfiles, FrameFilter
+
+
+class _Handler:
+    def __init__(self):
+        self.operations = []
+        self.filters = {}
+
+    def add_operation(self, operation):
+        self.operations.append(operation)
+
+    def add_filter(self, f, value):
+        self.filters[f] = str(value)
+
+
+def get_frame(width=320, height=240):
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def decode(jpeg):
+    return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def test_update_does_not_mutate_defaults():
+    defaults = dict(utils.default_filter_map)
+    first = FrameFilter()
+    first.update({"GaussianBlur": "true", "DegradeFactor": "2", "ScaleFactor": "0"})
+    assert utils.default_filter_map == defaults
+    assert FrameFilter().filters == defaults
+    assert first.filters["GaussianBlur"] is True
+    assert first.filters["DegradeFactor"] == 2
+    assert first.filters["ScaleFactor"] is None
+
+    old = first.pipeline
+    first.update({"GaussianBlur": False})
+    assert first.pipeline is not old
+    assert [op[1] for op in first.pipeline.ops] == [("Degraded through resizing by a factor of 2",)]
+
+
+def test_filter_output(caplog):
+    frame = get_frame()
+    frame_filter = FrameFilter({"MedianBlur": "true", "DegradeFactor": "4", "ScaleFactor": "0.5",
+                                "CompressionFactor": "80"})
+    handler = _Handler()
+    with caplog.at_level(logging.INFO):
+        jpeg = frame_filter.filter(frame.copy(), handler)
+    assert not caplog.records
+
+    expected = cv2.medianBlur(frame, 15)
+    expected = cv2.resize(expected, (80, 60))
+    expected = cv2.resize(expected, (160, 120))
+    expected = cv2.imencode(".jpeg", expected, [int(cv2.IMWRITE_JPEG_QUALITY), 80])[1].tobytes()
+    assert jpeg == expected
+    assert decode(jpeg).shape == (120, 160, 3)
+    assert handler.filters == {"MedianBlur": "True", "DegradeFactor": "4", "ScaleFactor": "0.5"}
+    assert handler.operations[-1] == "Compressed with JPEG quality level 80"
+
+
+def test_fit_jpeg_quality():
+    sizes = {q: 100 + 10 * q for q in range(1, 101)}
+    calls = []
+
+    def encode(quality):
+        calls.append(quality)
+        return b"x" * sizes[quality]
+
+    assert utils.fit_jpeg_quality(encode, 600, 50)[0] == 50
+    assert utils.fit_jpeg_quality(encode, 605, 10)[0] == 50
+    assert utils.fit_jpeg_quality(encode, 5000, 50) == (100, b"x" * 1100)
+    assert utils.fit_jpeg_quality(encode, 50, 50) == (1, b"x" * 110)
+    assert utils.fit_jpeg_quality(encode, 5000, 50, max_quality=80)[0] == 80
+    del calls[:]
+    utils.fit_jpeg_quality(encode, 600, 50)
+    assert len(calls) == 2
+
+
+def test_target_frame_bytes():
+    frame = get_frame(640, 480)
+    frame_filter = FrameFilter({"TargetFrameBytes": "40000"})
+    for _ in range(2):
+        handler = _Handler()
+        jpeg = frame_filter.filter(frame, handler)
+        quality = int(handler.filters["JPEGQuality"])
+        assert len(jpeg) <= 40000
+        assert handler.filters["FrameBytes"] == str(len(jpeg))
+        higher = cv2.imencode(".jpeg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality + 1])[1]
+        assert len(higher) > 40000
+    assert frame_filter.pipeline.last_quality() == quality
+
+    frame_filter.update({"TargetFrameBytes": "0", "TargetBitrate": str(40000 * 8 * 10), "FrameRate": "10"})
+    assert frame_filter.pipeline.target_bytes == 40000
+
+
+def test_target_frame_bytes_per_stream():
+    busy, flat = get_frame(640, 480), np.full((480, 640, 3), 128, dtype=np.uint8)
+    profiles = FilterProfiles(FrameFilter({"TargetFrameBytes": "40000"}))
+    qualities = {}
+    for session_id, frame in (("busy", busy), ("flat", flat), ("busy", busy)):
+        handler = _Handler()
+        profiles.filter(frame, handler, session_id=session_id)
+        qualities[session_id] = int(handler.filters["JPEGQuality"])
+    pipeline = profiles.default.pipeline
+    # Each stream keeps its own seed, so the flat stream does not move the busy stream's search.
+    assert qualities["flat"] > qualities["busy"]
+    assert pipeline.last_quality("busy") == qualities["busy"]
+    assert pipeline.last_quality("flat") == qualities["flat"]
+    # Removing a session without a profile of its own still releases its seed.
+    assert not profiles.remove("flat")
+    assert pipeline.last_quality("flat") == pipeline.last_quality()
+    assert list(pipeline._last_quality) == ["busy"]
+
+
+def test_target_frame_bytes_max_streams():
+    pipeline = utils.FilterPipeline(dict(utils.default_filter_map, TargetFrameBytes=1000), max_streams=2)
+    frame = get_frame(64, 48)
+    for stream in ("a", "b", "a", "c"):
+        pipeline.apply(frame, _Handler(), stream=stream)
+    # The least recently seen stream is forgotten first.
+    assert list(pipeline._last_quality) == ["a", "c"]
+
+
+def test_tiled_filter_matches():
+    frame = get_frame(640, 371)
+    frame_filter = FrameFilter(num_threads=4, tile_min_pixels=0)
+    for name, func in (("GaussianBlur", utils._gaussian_blur), ("MedianBlur", utils._median_blur),
+                       ("BilateralBlur", utils._bilateral_blur)):
+        assert np.array_equal(utils.filter_tiled(func, frame, frame_filter.executor, 4), func(frame))
+        frame_filter.update({"GaussianBlur": "false", "MedianBlur": "false", "BilateralBlur": "false", name: "true"})
+        expected = FrameFilter({name: "true"}).filter(frame, _Handler())
+        assert frame_filter.filter(frame, _Handler()) == expected
+
+
+def test_jpeg_fast_paths():
+    frame = cv2.GaussianBlur(get_frame(640, 480), (31, 31), 0)
+    jpeg = cv2.imencode(".jpeg", frame)[1].tobytes()
+    assert utils.jpeg_size(jpeg) == (640, 480)
+    assert utils.jpeg_size(b"not a jpeg") is None
+
+    frame_filter = FrameFilter()
+    assert frame_filter.filter_jpeg(jpeg, _Handler()) is jpeg
+
+    frame_filter.update({"DegradeFactor": "4", "ScaleFactor": "0.5"})
+    assert frame_filter.pipeline.reduce == 4
+    handler = _Handler()
+    reduced = decode(frame_filter.filter_jpeg(jpeg, handler))
+    full = decode(frame_filter.filter(decode(jpeg), _Handler()))
+    assert reduced.shape == full.shape == (240, 320, 3)
+    assert np.abs(reduced.astype(int) - full.astype(int)).mean() < 10
+    assert handler.filters == {"DegradeFactor": "4", "ScaleFactor": "0.5"}
+
+    frame_filter.update({"MedianBlur": "true"})
+    assert frame_filter.pipeline.reduce == 1
+
+
+def test_lazy_decode():
+    frame = get_frame()
+    req = analytic_pb2.ProcessFrameRequest()
+    req.frame.frame.img = cv2.imencode(".jpeg", frame)[1].tobytes()
+    handler = FrameHandler.from_request(req)
+    assert handler._frame is None
+    assert handler.get_frame("JPEG") == req.frame.frame.img
+    handler.add_frame_info()
+    assert handler.resp.frame.frame_byte_size == len(req.frame.frame.img)
+    assert handler._frame is None
+    assert handler.get_frame().shape == frame.shape
+
+
+def test_filter_profiles():
+    profiles = FilterProfiles(FrameFilter({"CompressionFactor": "50"}))
+    profile = profiles.update({"ScaleFactor": "0.5"}, session_id="a")
+    assert profiles.get("a") is profile
+    assert profiles.get("b") is profiles.get() is profiles.default
+    assert profile.filters["CompressionFactor"] == 50
+    assert profiles.default.filters["ScaleFactor"] is None
+
+    pipeline = profile.pipeline
+    frame = get_frame()
+    assert decode(profiles.filter(frame, _Handler(), session_id="a")).shape == (120, 160, 3)
+    assert decode(profiles.filter(frame, _Handler(), session_id="b")).shape == (240, 320, 3)
+    assert profile.pipeline is pipeline
+
+    assert profiles.remove("a")
+    assert not profiles.remove("a")
+    assert profiles.get("a") is profiles.default
+
+
+def test_proxy_profiles():
+    svc = ProxySvc(__name__, FrameFilter())
+    client = svc.app.test_client()
+    assert client.post("/update?session_id=a", json={"MedianBlur": "true"}).status_code == 200
+    assert client.post("/update", json={"DegradeFactor": "2"}).status_code == 200
+    filters = client.get("/filters").get_json()
+    assert filters["default"]["DegradeFactor"] == 2
+    assert filters["profiles"]["a"]["MedianBlur"] is True
+    assert svc.filter.filters["MedianBlur"] is False
+    assert client.delete("/update?session_id=a").status_code == 200
+    assert client.delete("/update?session_id=a").status_code == 404
+
+
+def test_session_id():
+    req = analytic_pb2.ProcessFrameRequest(session_id="a")
+    assert FrameHandler.from_request(req).resp.session_id == "a"
+
+
+if __name__ == "__main__":
+    test_update_does_not_mutate_defaults()
@@ -0,0 +1,85 @@
+import threading
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+from ace.utils import FrameFilter
+from ace.video_file_server import FilteredCapture, FilteredStreamServer, LatestFrame
+
+
+def write_video(path, frames=10):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (160, 120))
+    for i in range(frames):
+        frame = np.full((120, 160, 3), 20 * i, dtype=np.uint8)
+        writer.write(frame)
+    writer.release()
+
+
+def test_latest_frame():
+    latest = LatestFrame()
+    assert latest.wait(None, timeout=0.01) == (None, None)
+    latest.put(b"1")
+    latest.put(b"2")
+    assert latest.wait(None) == (2, b"2")
+    assert latest.wait(2, timeout=0.01) == (2, None)
+    latest.close()
+    assert latest.wait(2) == (2, None)
+
+
+def test_filtered_stream(tmp_path):
+    path = str(tmp_path / "video.avi")
+    write_video(path)
+    frame_filter = FrameFilter({"ScaleFactor": "0.5"})
+    server = FilteredStreamServer(path, frame_filter, server_address=("127.0.0.1", 0), fps=100)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{!s}/cam.mjpg".format(server.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            assert resp.headers["Content-type"].startswith("multipart/x-mixed-replace")
+            assert resp.readline() == b"--jpgboundary\r\n"
+            headers = {}
+            line = resp.readline()
+            while line.strip():
+                key, value = line.decode().split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+                line = resp.readline()
+            jpeg = resp.read(int(headers["content-length"]))
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        assert frame.shape == (60, 80, 3)
+        assert server.frames_filtered > 0
+        assert server.last_record.filters["ScaleFactor"] == "0.5"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_capture_open_failure(tmp_path):
+    server = FilteredStreamServer(str(tmp_path / "missing.avi"), FrameFilter(), server_address=("127.0.0.1", 0))
+    try:
+        with pytest.raises(IOError):
+            server.start_capture()
+    finally:
+        server.server_close()
+
+
+def test_capture_ends(tmp_path):
+    path = str(tmp_path / "video.avi")
+    write_video(path, frames=3)
+    server = FilteredStreamServer(path, FrameFilter(), server_address=("127.0.0.1", 0), loop_play=False)
+    capture = FilteredCapture(server.latest, width=160, height=120)
+    try:
+        server.start_capture()
+        server._thread.join(5)
+        # The last frame is still read, then the capture reports the end of the stream rather than blocking.
+        assert capture.read()[0]
+        assert capture.read() == (False, None)
+        assert not capture.isOpened()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    test_latest_frame()
@@ -0,0 +1,109 @@
+from google.rpc import code_pb2
+
+from ace import analytic_pb2
+from ace.joiner import JoinService, ResultJoiner, parse_subject
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_result(analytic, frame_num):
+    resp = analytic_pb2.ProcessedFrame()
+    resp.analytic.name = analytic
+    resp.frame.frame_num = frame_num
+    return resp
+
+
+def get_joiner(**kwargs):
+    joined = []
+    clock = _Clock()
+    joiner = ResultJoiner(lambda stream_id, frame_num, c: joined.append((stream_id, frame_num, c)), clock=clock,
+                          **kwargs)
+    return joiner, joined, clock
+
+
+def test_join():
+    joiner, joined, clock = get_joiner(analytics=["a", "b"])
+    joiner.add("s1", "a", get_result("a", 1))
+    joiner.add("s2", "b", get_result("b", 1))
+    joiner.add("s1", "b", get_result("b", 1))
+    assert [(s, f, [r.analytic.name for r in c.results]) for s, f, c in joined] == [("s1", 1, ["a", "b"])]
+    assert joiner.stats() == {"joined": 1, "incomplete": 0, "late": 0, "pending": 1}
+
+
+def test_missing_and_late():
+    joiner, joined, clock = get_joiner(analytics=["a", "b"], window_seconds=1.0)
+    joiner.add("s1", "a", get_result("a", 1))
+    clock.now = 0.5
+    joiner.expire()
+    assert not joined
+    clock.now = 1.0
+    joiner.expire()
+    (_, _, composite), = joined
+    missing = composite.results[1]
+    assert (missing.analytic.name, missing.frame.frame_num) == ("b", 1)
+    assert missing.data.status.code == code_pb2.DEADLINE_EXCEEDED
+
+    late = []
+    joiner.late_callback = lambda stream_id, analytic, resp: late.append(analytic)
+    joiner.add("s1", "b", get_result("b", 1))
+    assert late == ["b"]
+    assert joiner.stats() == {"joined": 0, "incomplete": 1, "late": 1, "pending": 0}
+
+
+def test_frame_window_and_bounds():
+    joiner, joined, clock = get_joiner(analytics=["a", "b"], window_frames=5, max_pending=3)
+    joiner.add("s1", "a", get_result("a", 1))
+    joiner.add("s1", "a", get_result("a", 6))
+    assert [f for _, f, _ in joined] == [1]
+    for i in range(7, 10):
+        joiner.add("s1", "a", get_result("a", i))
+    assert [f for _, f, _ in joined] == [1, 6]
+    assert len(joiner.pending) == 3
+    joiner.flush()
+    assert [f for _, f, _ in joined] == [1, 6, 7, 8, 9]
+
+
+def test_discovered_analytics():
+    joiner, joined, clock = get_joiner(window_seconds=1.0)
+    joiner.add("s1", "a", get_result("a", 1))
+    joiner.add("s1", "b", get_result("b", 1))
+    joiner.add("s1", "a", get_result("a", 2))
+    assert [f for _, f, _ in joined] == [1]
+    joiner.add("s1", "b", get_result("b", 2))
+    assert [f for _, f, _ in joined] == [1, 2]
+
+
+class _Producer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, subject, msg):
+        self.sent.append((subject, msg))
+
+
+def test_join_service():
+    producer = _Producer()
+    svc = JoinService("nats://localhost:4222", consumer=object(), producer=producer, analytics=["a", "b"])
+    svc.on_results([
+        {"subject": "stream.s1.analytic.a", "data": get_result("detector-a", 3)},
+        {"subject": "results", "data": get_result("x", 3)},
+        {"subject": "stream.s1.analytic.b", "data": get_result("detector-b", 3)}
+    ])
+    (subject, composite), = producer.sent
+    assert subject == "stream.s1.joined"
+    assert [r.analytic.name for r in composite.results] == ["detector-a", "detector-b"]
+    assert parse_subject("stream.s1.analytic.host") == ("s1", "host")
+
+
+if __name__ == "__main__":
+    test_join()
+    test_missing_and_late()
+    test_frame_window_and_bounds()
+    test_discovered_analytics()
+    test_join_service()
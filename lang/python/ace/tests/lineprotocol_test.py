@@ -0,0 +1,82 @@
+from influxdb.line_protocol import make_lines
+
+from ace import analytic_pb2, lineprotocol
+from ace.aceclient import AceDB
+
+
+def get_response(classes=("person", "car")):
+    resp = analytic_pb2.ProcessedFrame(session_id="session")
+    resp.analytic.name = "test-analytic"
+    resp.analytic.addr = "localhost:50051"
+    resp.analytic.filters["blur"] = "7"
+    resp.frame.frame_num = 12
+    resp.frame.timestamp = 0.5
+    resp.frame.frame_byte_size = 2048
+    resp.data.start_time_millis = 1000
+    resp.data.end_time_millis = 1020
+    resp.data.tags["camera"] = "front"
+    for i, c in enumerate(classes):
+        roi = resp.data.roi.add()
+        roi.classification = c
+        roi.confidence = 0.25 * (i + 1)
+        roi.box.corner1.x, roi.box.corner1.y = i, i + 1
+        roi.box.corner2.x, roi.box.corner2.y = i + 10, i + 20
+    return resp
+
+
+def split_line(line):
+    """Splits a line without escaped characters into its series and set of fields."""
+    series, fields = line.split(" ")
+    return series, set(fields.split(","))
+
+
+def test_matches_json_path():
+    for tag_keys in [None, ["analytic_name", "frame_num", "session_id"]]:
+        db = AceDB(batch_size=0, tag_keys=tag_keys)
+        for classes in [("person", "car"), ()]:
+            resp = get_response(classes)
+            expected = make_lines({"points": db.json_from_resp(resp)}).splitlines()
+            lines = lineprotocol.encode(resp, tag_keys=db.tag_keys)
+            assert [split_line(l) for l in lines] == [split_line(l) for l in expected]
+
+
+def test_default_schema():
+    series, fields = split_line(lineprotocol.encode(get_response(("person",)))[0])
+    assert series == "FrameInfo,analytic_addr=localhost:50051,analytic_name=test-analytic,camera=front," \
+                     "classification=person"
+    assert {"frame_num=12i", "frame_timestamp=0.5", "session_id=\"session\""} <= fields
+
+
+def test_batch():
+    batch = analytic_pb2.ProcessedFrameBatch()
+    batch.processed_frames.add().CopyFrom(get_response(("a",)))
+    batch.processed_frames.add().CopyFrom(get_response(("b", "c")))
+    payload = lineprotocol.dumps(batch)
+    assert payload.endswith("\n")
+    assert len(payload.splitlines()) == 3
+
+
+def test_escaping():
+    line = lineprotocol.point_line("Frame Info", {"my tag": "a,b=c", "empty": ""},
+                                   {"label": "say \"hi\"\\", "count": 3, "ok": True, "bad": float("nan")})
+    assert line == 'Frame\\ Info,my\\ tag=a\\,b\\=c label="say \\"hi\\"\\\\",count=3i,ok=true'
+    assert lineprotocol.escape_key("trailing\\") == "trailing\\\\"
+    assert lineprotocol.point_line("m", {}, {"x": 1.5}, timestamp=10) == "m x=1.5 10"
+
+
+def test_non_finite_confidence():
+    resp = get_response()
+    resp.data.roi[0].confidence = float("nan")
+    resp.data.roi[1].confidence = float("inf")
+    lines = lineprotocol.encode(resp)
+    assert len(lines) == 2
+    assert all(not any(f.startswith("confidence=") for f in split_line(line)[1]) for line in lines)
+    assert all("box_x1=" in line for line in lines)
+
+
+if __name__ == "__main__":
+    test_matches_json_path()
+    test_default_schema()
+    test_batch()
+    test_escaping()
+    test_non_finite_confidence()
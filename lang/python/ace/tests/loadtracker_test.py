@@ -0,0 +1,124 @@
+import socket
+import threading
+import time
+
+import grpc
+import numpy as np
+from grpc_health.v1 import health_pb2, health_pb2_grpc
+
+from ace.aceclient import AnalyticClient, parse_load_report
+from ace.grpcservice import AnalyticServiceGRPC, LoadTracker
+
+
+class _Aborted(Exception):
+    pass
+
+
+class _Context:
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.code = None
+
+    def time_remaining(self):
+        return self.remaining
+
+    def abort(self, code, details):
+        self.code = code
+        raise _Aborted(details)
+
+
+def _check_admission(svc, ctx, stage):
+    try:
+        svc._CheckAdmission(ctx, stage)
+    except _Aborted:
+        pass
+    return ctx.code
+
+
+def test_report():
+    tracker = LoadTracker(max_workers=4)
+    for ms in range(1, 101):
+        tracker.add_latency(ms / 1000.0)
+    with tracker.track_request():
+        report = tracker.report()
+    assert report["in_flight"] == 1
+    assert report["queue_depth"] == 0
+    assert report["processed"] == 100
+    assert abs(report["p50_latency_ms"] - 50.5) < 1e-6
+    assert report["p99_latency_ms"] > 98
+    assert abs(report["capacity_fps"] - 4000 / 50.5) < 1e-6
+    assert tracker.report()["in_flight"] == 0
+
+
+def test_metadata_round_trip():
+    tracker = LoadTracker(max_workers=2)
+    tracker.add_latency(0.02)
+    report = parse_load_report(tracker.metadata() + (("other-key", "1"),))
+    assert set(report.keys()) == set(tracker.report().keys())
+    assert report["p50_latency_ms"] == 20.0
+    assert report["capacity_fps"] == 100.0
+
+
+def test_admission():
+    svc = AnalyticServiceGRPC(deadline_margin=0.01)
+    assert _check_admission(svc, _Context(None), svc.STAGE_DECODE) is None
+    assert _check_admission(svc, _Context(1.0), svc.STAGE_DECODE) is None
+    assert _check_admission(svc, _Context(0.005), svc.STAGE_DECODE) == grpc.StatusCode.DEADLINE_EXCEEDED
+
+    # Once the analytic is known to take ~100ms, frames with less time than that left are not processed.
+    svc.load.add_latency(0.1)
+    assert _check_admission(svc, _Context(0.2), svc.STAGE_PROCESS) is None
+    assert _check_admission(svc, _Context(0.05), svc.STAGE_PROCESS) == grpc.StatusCode.DEADLINE_EXCEEDED
+
+    report = svc.load.report()
+    assert report["shed_deadline_decode"] == 1
+    assert report["shed_deadline_process"] == 1
+    assert report["shed_queue_full"] == 0
+
+
+def test_queue_full():
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        port = sock.getsockname()[1]
+    release = threading.Event()
+    svc = AnalyticServiceGRPC(max_queue=1)
+    svc.RegisterProcessVideoFrame(lambda handler: release.wait(10))
+    server = svc.Start(analytic_port=port, max_workers=1)
+    client = AnalyticClient("localhost:{!s}".format(port))
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+    try:
+        calls = [client.process_frame_async(frame)]
+        deadline = time.time() + 5
+        while svc.load.report()["in_flight"] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        calls.extend(client.process_frame_async(frame) for _ in range(5))
+        # Requests beyond the busy worker and the one queued request are rejected while the worker is still busy.
+        deadline = time.time() + 5
+        while sum(call.done() for call in calls[1:]) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        rejected = [call for call in calls[1:] if call.done()]
+        assert not release.is_set()
+        assert len(rejected) == 4
+        assert all(call.code() == grpc.StatusCode.RESOURCE_EXHAUSTED for call in rejected)
+        report = svc.load.report()
+        assert (report["shed_queue_full"], report["in_flight"], report["queue_depth"]) == (4, 1, 1)
+        # Health checks are not subject to admission, so a busy server is not mistaken for an unhealthy one.
+        with grpc.insecure_channel("localhost:{!s}".format(port)) as channel:
+            health = health_pb2_grpc.HealthStub(channel).Check(
+                health_pb2.HealthCheckRequest(service="ace.Analytic"), timeout=2)
+        assert health.status == health_pb2.HealthCheckResponse.SERVING
+        release.set()
+        for call in calls:
+            if call not in rejected:
+                assert call.result(timeout=5) is not None
+    finally:
+        release.set()
+        client.close()
+        server.stop(0)
+
+
+if __name__ == "__main__":
+    test_report()
+    test_metadata_round_trip()
+    test_admission()
+    test_queue_full()
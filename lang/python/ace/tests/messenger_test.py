@@ -0,0 +1,271 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from ace import analytic_pb2
+from ace.messenger import (ACEProducer, DirectoryFrameStore, ErrSlowConsumer, NATSConsumer, NATSProducer,
+                           ResultPublisher, compress_payload, decompress_payload, stream_key)
+
+
+class _NATSClient:
+    def __init__(self):
+        self.published = []
+        self.flushes = 0
+        self.closed = False
+
+    async def connect(self, addr, error_cb=None):
+        self.addr = addr
+        self.error_cb = error_cb
+
+    async def subscribe(self, subject, queue="", cb=None, pending_msgs_limit=None, pending_bytes_limit=None):
+        self.subscription = (subject, queue, pending_msgs_limit)
+        self.cb = cb
+
+    async def deliver(self, payloads):
+        for payload in payloads:
+            await self.cb(SimpleNamespace(subject="stream.s1.analytic.a", reply="", data=payload))
+        await asyncio.sleep(0.1)
+
+    async def publish(self, subject, payload):
+        self.published.append((subject, payload))
+
+    async def flush(self, timeout=60):
+        self.flushes += 1
+
+    async def close(self):
+        self.closed = True
+
+
+def test_producer_threads():
+    nc = _NATSClient()
+    producer = NATSProducer("nats://localhost:4222", client=nc, flush_interval=0.01)
+
+    def send(n):
+        for i in range(100):
+            producer.send("stream.{:d}".format(n), "msg {:d}".format(i))
+
+    threads = [threading.Thread(target=send, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    producer.flush(timeout=5)
+    stats = producer.stats()
+    assert (stats["sent"], stats["pending"], stats["dropped"]) == (400, 0, 0)
+    assert stats["flush_latency_ms_p50"] is not None
+    # Messages from each thread are published in order
+    assert [p for s, p in nc.published if s == "stream.2"] == [("msg {:d}".format(i)).encode() for i in range(100)]
+    producer.close(timeout=5)
+    assert nc.closed
+    assert not producer._thread.is_alive()
+
+
+def test_producer_drops_oldest():
+    nc = _NATSClient()
+    producer = NATSProducer("nats://localhost:4222", client=nc, max_pending=3)
+    # Block the event loop so that messages stay queued while they are sent
+    unblock = threading.Event()
+    producer.loop.call_soon_threadsafe(unblock.wait)
+    for i in range(5):
+        producer.send("subject", str(i))
+    unblock.set()
+    producer.close(timeout=5)
+    assert producer.stats()["dropped"] == 2
+    assert nc.published == [("subject", b"2"), ("subject", b"3"), ("subject", b"4")]
+
+
+class _KafkaFuture:
+    def __init__(self, error=None):
+        self.error = error
+
+    def add_callback(self, f, *args):
+        if not self.error:
+            f("metadata", *args)
+
+    def add_errback(self, f, *args):
+        if self.error:
+            f(self.error, *args)
+
+
+class _KafkaProducer:
+    """Stands in for a broker by recording the messages sent to each partition."""
+
+    def __init__(self, partitions=4):
+        self.partitions = [[] for _ in range(partitions)]
+
+    def send(self, topic, value=None, key=None):
+        if topic == "bad":
+            return _KafkaFuture(error=IOError("unknown topic"))
+        self.partitions[hash(key) % len(self.partitions)].append((topic, key, value))
+        return _KafkaFuture()
+
+
+def test_kafka_producer():
+    broker = _KafkaProducer()
+    producer = ACEProducer("localhost:9092", messenger_type="Kafka", producer=broker)
+    for i in range(10):
+        for stream in ("a", "b", "c"):
+            producer.send("stream.{!s}.analytic.detector".format(stream), "{!s}{:d}".format(stream, i))
+    producer.send("bad", "x")
+    assert producer.producer.stats() == {"sent": 30, "failed": 1}
+    for partition in broker.partitions:
+        for stream in ("a", "b", "c"):
+            values = [v for _, k, v in partition if k == stream.encode()]
+            assert values in ([], [("{!s}{:d}".format(stream, i)).encode() for i in range(10)])
+    assert stream_key("stream.1234.analytic.detector") == "1234"
+    assert stream_key("results") is None
+
+
+class _Producer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, subject, msg):
+        self.sent.append((subject, msg.SerializeToString()))
+
+
+def get_result(img=b"jpeg"):
+    resp = analytic_pb2.ProcessedFrame(session_id="session")
+    resp.frame.frame.img = img
+    resp.frame.frame_num = 7
+    resp.data.roi.add().classification = "person"
+    return resp
+
+
+def test_publisher_frame_subject():
+    producer = _Producer()
+    publisher = ResultPublisher(producer, "stream.s1.analytic.detector", stream_id="s1")
+    resp = get_result()
+    publisher.publish(resp)
+    assert resp.frame.frame.img == b"jpeg"
+    (frame_subject, frame), (subject, meta) = producer.sent
+    assert (frame_subject, subject) == ("stream.s1.frame.detector", "stream.s1.analytic.detector")
+    frame = analytic_pb2.InputFrame.FromString(frame)
+    meta = analytic_pb2.ProcessedFrame.FromString(meta)
+    assert (frame.frame.img, frame.frame_num) == (b"jpeg", 7)
+    assert meta.frame.frame.img == b"" and meta.frame.frame_num == 7
+    assert meta.data.tags["frame_key"] == "s1/7"
+    assert meta.data.roi[0].classification == "person"
+
+    # Results without a frame are published unchanged
+    publisher.publish(get_result(img=b""))
+    assert len(producer.sent) == 3
+
+
+def test_publisher_frame_store(tmpdir):
+    producer = _Producer()
+    store = DirectoryFrameStore(str(tmpdir))
+    publisher = ResultPublisher(producer, "stream.s1.analytic.detector", frame_store=store, stream_id="s1")
+    publisher.publish(get_result())
+    (subject, meta), = producer.sent
+    key = analytic_pb2.ProcessedFrame.FromString(meta).data.tags["frame_key"]
+    assert store.get(key) == b"jpeg"
+
+
+def test_compression():
+    nc = _NATSClient()
+    producer = NATSProducer("nats://localhost:4222", client=nc, compression_type="gzip",
+                            value_serializer=lambda value: value.SerializeToString())
+    resp = get_result()
+    producer.send("subject", resp)
+    producer.close(timeout=5)
+    (_, payload), = nc.published
+    assert payload != resp.SerializeToString()
+    assert analytic_pb2.ProcessedFrame.FromString(decompress_payload(payload)) == resp
+    assert decompress_payload(b"plain") == b"plain"
+
+
+def test_consumer_batches():
+    nc = _NATSClient()
+    loop = asyncio.new_event_loop()
+    batches = []
+    consumer = NATSConsumer("nats://localhost:4222", loop=loop, queue="workers", batch_size=10, pending_msgs_limit=50,
+                            batch_callback=batches.append, client=nc,
+                            value_deserializer=lambda data: analytic_pb2.ProcessedFrame.FromString(data))
+    consumer.subscribe("stream.*.analytic.*")
+    assert nc.subscription == ("stream.*.analytic.*", "workers", 50)
+
+    payloads = [get_result().SerializeToString() for _ in range(24)] + [b"\xff", compress_payload(b"", "gzip")]
+    loop.run_until_complete(nc.deliver(payloads))
+    loop.run_until_complete(nc.error_cb(ErrSlowConsumer(subject="stream.s1.analytic.a", sid=1)))
+    assert max(len(b) for b in batches) == 10
+    assert sum(len(b) for b in batches) == 25
+    assert batches[0][0]["data"].frame.frame_num == 7
+    assert consumer.stats() == {"received": 26, "batches": len(batches), "decode_errors": 1, "slow_consumer_drops": 1}
+    consumer.close()
+    assert nc.closed
+    loop.close()
+
+
+class _SlowNATSClient(_NATSClient):
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+
+    async def publish(self, subject, payload):
+        self.started.set()
+        await asyncio.sleep(0.01)
+        await super().publish(subject, payload)
+
+    async def flush(self, timeout=60):
+        self.flushed_at = len(self.published)
+        await super().flush(timeout)
+
+
+def test_producer_flush_waits_for_batch():
+    nc = _SlowNATSClient()
+    producer = NATSProducer("nats://localhost:4222", client=nc, flush_interval=60)
+    for i in range(20):
+        producer.send("subject", str(i))
+    # The publish loop has taken the whole queue and is still publishing it when flush is called.
+    assert nc.started.wait(5)
+    producer.flush(timeout=5)
+    assert nc.flushed_at == 20
+    assert producer.stats()["pending"] == 0
+    producer.close(timeout=5)
+
+
+def test_producers_share_loop():
+    loop = asyncio.new_event_loop()
+    clients = [_NATSClient(), _NATSClient()]
+    producers = [NATSProducer("nats://localhost:4222", client=nc, loop=loop) for nc in clients]
+    # The given loop is run on one thread, which is left running when a producer is closed.
+    assert producers[0]._thread is not None and producers[1]._thread is None
+    producers[0].close(timeout=5)
+    assert loop.is_running()
+    producers[1].send("subject", "after")
+    producers[1].flush(timeout=5)
+    assert clients[1].published == [("subject", b"after")]
+    producers[1].close(timeout=5)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_producer_flush_counts():
+    nc = _SlowNATSClient()
+    producer = NATSProducer("nats://localhost:4222", client=nc, flush_interval=60)
+    producer.flush(timeout=5)
+
+    async def publish_during_flush(timeout=60):
+        # A message published while the flush is waiting on the server is not covered by it.
+        producer.send("subject", "late")
+        await producer._publish_queued()
+
+    nc.flush = publish_during_flush
+    producer.send("subject", "early")
+    producer.flush(timeout=5)
+    assert producer.stats()["pending"] == 1
+    del nc.flush
+    producer.close(timeout=5)
+    assert producer.stats()["pending"] == 0
+
+
+if __name__ == "__main__":
+    test_producer_threads()
+    test_producer_drops_oldest()
+    test_producer_flush_waits_for_batch()
+    test_producers_share_loop()
+    test_producer_flush_counts()
+    test_kafka_producer()
+    test_publisher_frame_subject()
+    test_compression()
+    test_consumer_batches()
@@ -0,0 +1,92 @@
+import time
+from concurrent import futures
+
+from ace import analytic_pb2
+from ace.aceclient import AnalyticPipeline, CompositeFuture
+
+
+class _Future:
+    def __init__(self, value):
+        self.value = value
+        self.finished = False
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        self.finished = True
+        return self.value
+
+
+class _Client:
+    def __init__(self):
+        self.futures = []
+
+    def process_frame_async(self, frame, **kwargs):
+        self.futures.append(_Future(frame * 10))
+        return self.futures[-1]
+
+
+def test_window():
+    client = _Client()
+    delivered = []
+    pipeline = AnalyticPipeline(client, window=3, callback=lambda ctx, resp: delivered.append(ctx))
+    assert pipeline.submit(1, "a") == []
+    assert pipeline.submit(2, "b") == []
+    assert pipeline.submit(3, "c") == []
+    assert pipeline.in_flight() == 3
+
+    # A full window waits for the oldest frame before sending the next one
+    assert pipeline.submit(4, "d") == [("a", 10)]
+
+    # Results which are already complete are delivered, but only in order
+    client.futures[2].finished = True
+    assert pipeline.submit(5, "e") == [("b", 20), ("c", 30)]
+    assert pipeline.flush() == [("d", 40), ("e", 50)]
+    assert delivered == ["a", "b", "c", "d", "e"]
+
+
+def test_imap():
+    pipeline = AnalyticPipeline(_Client(), window=2)
+    assert list(pipeline.imap((i, i) for i in range(5))) == [(i, i * 10) for i in range(5)]
+
+
+def test_stamp():
+    calls = [futures.Future() for _ in range(2)]
+    pipeline = AnalyticPipeline(_Client(), window=2, stamp=True)
+    pipeline.client.process_frame_async = lambda frame, **kwargs: calls[frame]
+    pipeline.submit(0, "a")
+    pipeline.submit(1, "b")
+    # The second response arrives first, but is stamped with its own arrival time rather than its delivery time.
+    calls[1].set_result("second")
+    arrived = time.time()
+    time.sleep(0.05)
+    calls[0].set_result("first")
+    (a, first, first_time), (b, second, second_time) = pipeline.flush()
+    assert (a, first, b, second) == ("a", "first", "b", "second")
+    assert second_time <= arrived < first_time
+
+
+def test_composite_future():
+    calls = [(analytic_pb2.AnalyticData(addr="localhost:{:d}".format(i)), futures.Future()) for i in range(2)]
+    composite = CompositeFuture(analytic_pb2.InputFrame(frame_num=3), calls)
+    pipeline = AnalyticPipeline(_Client(), stamp=True)
+    pipeline.client.process_frame_async = lambda frame, **kwargs: composite
+    pipeline.submit(0, "a")
+    finished = []
+    composite.add_done_callback(finished.append)
+    calls[0][1].set_result(analytic_pb2.ProcessedFrame())
+    assert not finished and not composite.done()
+    calls[1][1].set_result(analytic_pb2.ProcessedFrame())
+    assert finished == [composite]
+    [(context, resp, receive_time)] = pipeline.flush()
+    assert context == "a"
+    assert [res.frame.frame_num for res in resp.results] == [3, 3]
+    assert resp == composite.result(timeout=0)
+
+
+if __name__ == "__main__":
+    test_window()
+    test_imap()
+    test_stamp()
+    test_composite_future()
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+from ace import analytic_pb2, analyticservice
+from ace.resultsink import ParquetSink
+
+
+def get_response(frame_num, classes=("person", "car")):
+    resp = analytic_pb2.ProcessedFrame(session_id="session")
+    resp.analytic.name = "detector"
+    resp.analytic.filters["blur"] = "7"
+    resp.frame.frame_num = frame_num
+    resp.data.tags["camera"] = "front"
+    for i, c in enumerate(classes):
+        roi = resp.data.roi.add()
+        roi.classification = c
+        roi.confidence = 0.5
+        roi.box.corner2.x = i + 10
+    return resp
+
+
+def test_rows_and_row_groups(tmpdir):
+    sink = ParquetSink(str(tmpdir), row_group_size=4)
+    for i in range(5):
+        sink.write_proto(get_response(i))
+    sink.write_proto(get_response(5, classes=()))
+    assert sink.stats() == {"rows_written": 8, "buffered": 3, "files": 0}
+    sink.close()
+    assert os.listdir(str(tmpdir)) == [os.path.basename(sink.files[0])]
+
+    f = pq.ParquetFile(sink.files[0])
+    assert f.metadata.num_rows == 11
+    assert [f.metadata.row_group(i).num_rows for i in range(f.num_row_groups)] == [4, 4, 3]
+    table = f.read().to_pydict()
+    assert table["frame_num"] == [0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5]
+    assert table["classification"][:2] == ["person", "car"]
+    assert table["classification"][-1] is None
+    assert table["box_x2"][:2] == [10, 11]
+    assert table["tags"][0] == [("camera", "front")]
+
+
+def test_rolling_files(tmpdir):
+    sink = ParquetSink(str(tmpdir), row_group_size=2, max_file_rows=4)
+    for i in range(5):
+        sink.write_proto(get_response(i))
+    sink.close()
+    assert len(sink.files) == 3
+    assert [pq.ParquetFile(f).metadata.num_rows for f in sink.files] == [4, 4, 2]
+
+
+class _RTSPHandler:
+    def __init__(self, *args, **kwargs):
+        self.sinks = []
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def run(self):
+        pass
+
+    def terminate(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def test_service_sink(tmpdir, monkeypatch):
+    monkeypatch.setattr(analyticservice, "RTSPHandler", _RTSPHandler)
+    svc = analyticservice.AnalyticService(__name__, sink_dir=str(tmpdir))
+    svc.RegisterProcessVideoFrame(lambda handler: None)
+    req = analytic_pb2.StreamRequest(stream_source="rtsp://camera", stream_id="front")
+    client = svc.app.test_client()
+    assert client.put("/config", data=req.SerializeToString()).status_code == 200
+    [sink] = svc.handler.sinks
+    sink.write_proto(get_response(1))
+    # Stopping the stream closes the sink, leaving a complete file.
+    assert client.post("/kill").status_code == 200
+    assert [os.path.basename(f).startswith("front-") for f in sink.files] == [True]
+    assert pq.ParquetFile(sink.files[0]).metadata.num_rows == 2
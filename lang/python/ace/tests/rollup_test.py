@@ -0,0 +1,61 @@
+from ace import analytic_pb2
+from ace.rollup import Rollup
+
+
+class _Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def get_response(end_time, classes, confidence=0.5, stream_addr="rtsp://camera"):
+    resp = analytic_pb2.ProcessedFrame()
+    resp.analytic.name = "detector"
+    resp.data.stream_addr = stream_addr
+    resp.data.start_time_millis = int(end_time * 1000) - 20
+    resp.data.end_time_millis = int(end_time * 1000)
+    for c in classes:
+        roi = resp.data.roi.add()
+        roi.classification = c
+        roi.confidence = confidence
+    return resp
+
+
+def parse(line):
+    series, fields, timestamp = line.split(" ")
+    return series, dict(f.split("=") for f in fields.split(",")), int(timestamp)
+
+
+def test_windows():
+    clock = _Clock(100.0)
+    rollup = Rollup(window=10, lateness=5, clock=clock)
+    rollup.add(get_response(101.0, ["person", "person"], confidence=0.5))
+    rollup.add(get_response(105.0, ["person"], confidence=1.0))
+    rollup.add(get_response(106.0, []))
+    rollup.add(get_response(111.0, ["car"]))
+    assert rollup.collect() == []
+
+    clock.now = 115.0
+    lines = sorted(parse(line) for line in rollup.collect())
+    assert [series for series, _, _ in lines] == [
+        "FrameRollup,analytic_name=detector,classification=person,stream_address=rtsp://camera",
+        "FrameRollup,analytic_name=detector,stream_address=rtsp://camera"
+    ]
+    person = lines[0][1]
+    assert (person["frames"], person["count"], person["max_confidence"]) == ("2i", "3i", "1.0")
+    assert abs(float(person["mean_confidence"]) - 2.0 / 3) < 1e-6
+    assert lines[0][2] == 100 * 10 ** 9
+    assert lines[1][1] == {"frames": "1i", "count": "0i", "mean_latency_ms": "20.0", "max_latency_ms": "20i"}
+
+    # Results for a window which has already been emitted are discarded
+    rollup.add(get_response(109.0, ["person"]))
+    assert rollup.late == 1
+    assert [parse(line)[0] for line in rollup.collect(force=True)] == [
+        "FrameRollup,analytic_name=detector,classification=car,stream_address=rtsp://camera"
+    ]
+
+
+if __name__ == "__main__":
+    test_windows()
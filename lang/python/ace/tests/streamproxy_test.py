@@ -0,0 +1,142 @@
+import time
+from concurrent import futures
+
+import cv2
+import numpy as np
+
+from ace import analytic_pb2, streamproxy
+from ace.aceclient import AnalyticClient, AnalyticPipeline
+from ace.analytichandler import FrameHandler
+from ace.streamproxy import FrameTimings, LatestFrameBuffer, StreamingProxy
+
+
+class _Client:
+    def __init__(self):
+        self.calls = []
+
+    def process_frame(self, frame, **kwargs):
+        self.calls.append((frame, kwargs))
+        resp = analytic_pb2.ProcessedFrame()
+        resp.data.roi.add(classification="person", confidence=0.9)
+        return resp
+
+
+def get_proxy():
+    proxy = StreamingProxy(__name__, analytic_addr="localhost:50051")
+    proxy.client = _Client()
+    return proxy
+
+
+def test_forwards_original_bytes():
+    proxy = get_proxy()
+    frame = np.random.RandomState(0).randint(0, 256, size=(48, 64, 3), dtype=np.uint8)
+    req = analytic_pb2.ProcessFrameRequest(session_id="a")
+    req.frame.frame.img = cv2.imencode(".jpeg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), 60])[1].tobytes()
+    req.frame.frame_num = 7
+    req.frame.timestamp = 1.5
+    handler = FrameHandler.from_request(req)
+    proxy.proxy_process_frame(handler)
+
+    sent, kwargs = proxy.client.calls[0]
+    assert sent == req.frame.frame.img
+    assert kwargs == {"session_id": "a", "frame_num": 7, "timestamp": 1.5}
+    assert handler._frame is None
+    resp = handler.get_response()
+    assert resp.session_id == "a"
+    assert resp.frame.frame_num == 7
+    assert resp.frame.frame_byte_size == len(req.frame.frame.img)
+    assert resp.data.roi[0].classification == "person"
+
+
+def test_forwarded_bytes_keep_dimensions():
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    jpeg = cv2.imencode(".jpeg", frame)[1].tobytes()
+    client = AnalyticClient("localhost:50051")
+    input_frame = analytic_pb2.InputFrame()
+    client.encode_frame(input_frame, jpeg)
+    assert input_frame.frame.img == jpeg
+    assert (input_frame.frame.height, input_frame.frame.width, input_frame.frame.color) == (48, 64, 3)
+    client.close()
+
+
+def test_encodes_stream_frames_once():
+    proxy = get_proxy()
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    handler = FrameHandler([(2.0, 3, frame)], stream_addr="rtsp://camera", session_id="b")
+    proxy.proxy_process_frame(handler)
+
+    sent, kwargs = proxy.client.calls[0]
+    assert isinstance(sent, bytes)
+    assert kwargs == {"session_id": "b", "frame_num": 3, "timestamp": 2.0}
+    assert handler.get_response().data.stream_addr == "rtsp://camera"
+
+
+class _AsyncClient:
+    def __init__(self):
+        self.frame_nums = []
+
+    def process_frame_async(self, frame, **kwargs):
+        self.frame_nums.append(kwargs["frame_num"])
+        future = futures.Future()
+        future.set_result(analytic_pb2.ProcessedFrame())
+        return future
+
+
+def test_latest_frame_buffer():
+    buff = LatestFrameBuffer(2)
+    for i in range(5):
+        buff.put(i)
+    assert buff.dropped == 3
+    assert buff.get() == 3
+    assert buff.get() == 4
+    assert buff.get(timeout=0.01) is None
+    buff.close()
+    assert buff.get() is None
+
+
+def test_frame_timings():
+    timings = FrameTimings()
+    for i in range(11):
+        timings.add(i, i + 0.01, i + 0.02, i + 0.1 * (1 + i % 2))
+    report = timings.report(dropped=2)
+    assert report["frames"] == 11
+    assert report["dropped"] == 2
+    assert abs(report["fps"] - 1.0) < 0.05
+    assert abs(report["latency_ms_p50"] - 100) < 1e-6
+    assert abs(report["latency_ms_p99"] - 200) < 1e-6
+    assert abs(report["send_ms_p50"] - 10) < 1e-6
+
+
+def test_instrumented_client(tmp_path, capsys):
+    path = str(tmp_path / "video.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (64, 48))
+    for i in range(20):
+        writer.write(np.full((48, 64, 3), 10 * i, dtype=np.uint8))
+    writer.release()
+
+    client = streamproxy.TestClient(path, window=2, buffer_size=100, instrument=True, display=False)
+    client.pipeline = AnalyticPipeline(_AsyncClient(), window=2, stamp=True)
+    client.run()
+    assert client.pipeline.client.frame_nums == list(range(20))
+    assert len(client.timings.frames) == 20
+    out = capsys.readouterr().out
+    assert "Frames rendered: 20" in out
+    assert "End-to-end latency (ms): p50" in out
+
+
+def test_client_duration(tmp_path):
+    path = str(tmp_path / "video.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 30, (64, 48))
+    writer.write(np.zeros((48, 64, 3), dtype=np.uint8))
+    writer.release()
+
+    client = streamproxy.TestClient(path, display=False, duration=0.1)
+    client.pipeline = AnalyticPipeline(_AsyncClient(), stamp=True)
+    # No frames are ever captured, so the client stops when the duration is up rather than waiting for one.
+    start = time.time()
+    client._run()
+    assert time.time() - start < 1
+
+
+if __name__ == "__main__":
+    test_forwards_original_bytes()
@@ -1,4 +1,7 @@
+import collections
 import logging
+import threading
+from concurrent import futures
 
 import cv2
 import numpy as np
@@ -6,6 +9,13 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of 'values', or None if there are no values."""
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, q))
+
+
 def get_operations(operations):
     s = ""
     for o in operations:
@@ -63,73 +73,426 @@ default_filter_map = {
     "BilateralBlur": False,
     "DegradeFactor": None,
     "CompressionFactor": 100,
-    "ScaleFactor": None
+    "ScaleFactor": None,
+    "TargetFrameBytes": None,
+    "TargetBitrate": None,
+    "FrameRate": 30.0
 }
 
+MIN_JPEG_QUALITY = 1
+
+# Rows of context shared between neighbouring tiles. It must be at least the radius of the largest blur kernel (7 for
+# the 15x15 kernels used below) for the tiled result to match the result for the whole frame.
+TILE_HALO = 8
+# Frames with fewer pixels than this are filtered in one piece.
+DEFAULT_TILE_MIN_PIXELS = 1280 * 720
+# Streams for which a pipeline remembers the last JPEG quality. The least recently seen stream is forgotten first.
+DEFAULT_MAX_STREAMS = 1024
+
+# Flags for decoding a JPEG at a fraction of its size, which is much cheaper than decoding it at full size.
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+# JPEG start of frame markers, which hold the size of the image.
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _parse_bool(value):
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def _parse_factor(value, cast):
+    """Returns 'value' as a positive number, or None (no filter) if it is not positive."""
+    value = cast(value)
+    return value if value > 0 else None
+
+
+def _gaussian_blur(frame):
+    return cv2.GaussianBlur(frame, (15, 15), 0)
+
+
+def _median_blur(frame):
+    return cv2.medianBlur(frame, 15)
+
+
+def _bilateral_blur(frame):
+    return cv2.bilateralFilter(frame, 15, 75, 75)
+
+
+def filter_tiled(func, frame, executor, tiles, halo=TILE_HALO):
+    """
+    Applies 'func' to horizontal strips of 'frame' on 'executor' and returns the combined result. Each strip is
+    extended by 'halo' rows of its neighbours so that, as long as 'halo' is at least the radius of the filter, the
+    result is identical to 'func(frame)'.
+    """
+    height = frame.shape[0]
+    tiles = max(1, min(tiles, height // (2 * halo)))
+    if tiles == 1:
+        return func(frame)
+    bounds = [height * i // tiles for i in range(tiles + 1)]
+    output = np.empty_like(frame)
+
+    def run(i):
+        start, end = bounds[i], bounds[i + 1]
+        top = max(0, start - halo)
+        output[start:end] = func(frame[top:min(height, end + halo)])[start - top:end - top]
+
+    list(executor.map(run, range(tiles)))
+    return output
+
+
+def jpeg_size(jpeg):
+    """Returns the (width, height) of a JPEG from its headers without decoding it, or None if it can't be read."""
+    shape = jpeg_shape(jpeg)
+    return (shape[1], shape[0]) if shape else None
+
+
+def jpeg_shape(jpeg):
+    """Returns the (height, width, channels) of a JPEG from its headers without decoding it, or None if it can't be
+    read."""
+    if jpeg[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 10 <= len(jpeg):
+        if jpeg[i] != 0xFF:
+            return None
+        marker = jpeg[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in _SOF_MARKERS:
+            return int.from_bytes(jpeg[i + 5:i + 7], "big"), int.from_bytes(jpeg[i + 7:i + 9], "big"), jpeg[i + 9]
+        i += 2 + int.from_bytes(jpeg[i + 2:i + 4], "big")
+    return None
+
+
+def decode_jpeg(jpeg, reduce=1):
+    """Decodes a JPEG, at 1/'reduce' of its size if 'reduce' is 2, 4 or 8."""
+    return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), REDUCED_DECODE_FLAGS.get(reduce, cv2.IMREAD_COLOR))
+
+
+def _tiled_op(func, executor, tiles, min_pixels):
+    if executor is None or tiles <= 1:
+        return func
+
+    def tiled(frame):
+        if frame.shape[0] * frame.shape[1] < min_pixels:
+            return func(frame)
+        return filter_tiled(func, frame, executor, tiles)
+    return tiled
+
+
+def _resize_op(degrade_factor, scale_factor):
+    """
+    Returns a single operation which degrades the frame (by shrinking it by 'degrade_factor' and scaling it back up)
+    and then resizes it by 'scale_factor'. The resize back up and the final resize are fused into one. If the frame was
+    decoded at a reduced size, 'size' is the (width, height) of the original frame.
+    """
+    def resize(frame, size=None):
+        width, height = size or (frame.shape[1], frame.shape[0])
+        if degrade_factor:
+            frame = cv2.resize(frame, (int(width / degrade_factor), int(height / degrade_factor)))
+        if scale_factor:
+            size = (int(width * scale_factor), int(height * scale_factor))
+        else:
+            size = (width, height)
+        if (frame.shape[1], frame.shape[0]) != size:
+            frame = cv2.resize(frame, size)
+        return frame
+    return resize
+
+
+def fit_jpeg_quality(encode, target_bytes, seed, max_quality=100):
+    """
+    Returns the highest JPEG quality (and the encoded frame) for which 'encode(quality)' fits in 'target_bytes'.
+
+    The search starts at 'seed' (normally the quality chosen for the previous frame) and steps away from it in growing
+    steps until the best quality is bracketed, then bisects. Consecutive frames of a stream usually need similar
+    qualities, so this typically takes two or three encodes. If the frame does not fit even at the lowest quality, it
+    is encoded at the lowest quality.
+    """
+    encoded = {}
+
+    def fits(quality):
+        if quality not in encoded:
+            encoded[quality] = encode(quality)
+        return len(encoded[quality]) <= target_bytes
+
+    seed = max(MIN_JPEG_QUALITY, min(seed, max_quality))
+    step = 1
+    if fits(seed):
+        low, high = seed, max_quality + 1
+        while low < max_quality:
+            quality = min(low + step, max_quality)
+            if not fits(quality):
+                high = quality
+                break
+            low = quality
+            step *= 2
+    else:
+        low, high = MIN_JPEG_QUALITY - 1, seed
+        while high > MIN_JPEG_QUALITY:
+            quality = max(high - step, MIN_JPEG_QUALITY)
+            if fits(quality):
+                low = quality
+                break
+            high = quality
+            step *= 2
+    while high - low > 1:
+        quality = (low + high) // 2
+        if fits(quality):
+            low = quality
+        else:
+            high = quality
+    quality = max(low, MIN_JPEG_QUALITY)
+    fits(quality)
+    return quality, encoded[quality]
+
+
+class FilterPipeline:
+    """
+    A compiled chain of filter operations. Each operation is a tuple of the function applied to the frame and the
+    operations and filters recorded on the handler when it is applied.
+
+    The operations do not change once compiled. The only state updated while filtering is the JPEG quality chosen for
+    the last frame of each stream (keyed by the 'stream' given to `apply`), which seeds the search for the next frame of
+    that stream when a byte budget is set, so streams sharing a pipeline do not disturb each other's search. Only the
+    'max_streams' most recently seen streams are remembered; `forget` drops a stream which has ended.
+
+    If an 'executor' is given, the blurs of frames with at least 'tile_min_pixels' pixels are split into 'tiles'
+    overlapping strips which are filtered in parallel (OpenCV releases the GIL while filtering).
+
+    `apply_jpeg` takes fast paths for encoded frames: if no filter changes the frame, the original JPEG is passed
+    through as is, and if the frame is only shrunk (by "DegradeFactor" or "ScaleFactor"), it is decoded at a reduced
+    size (`reduce`) rather than at full size.
+    """
+
+    def __init__(self, filters, executor=None, tiles=1, tile_min_pixels=DEFAULT_TILE_MIN_PIXELS,
+                 max_streams=DEFAULT_MAX_STREAMS):
+        ops = []
+        for name, func, description in (("GaussianBlur", _gaussian_blur, "Gaussian blur"),
+                                         ("MedianBlur", _median_blur, "Median blur"),
+                                         ("BilateralBlur", _bilateral_blur, "Bilateral blur")):
+            if filters[name]:
+                ops.append((_tiled_op(func, executor, tiles, tile_min_pixels), (description,), ((name, True),)))
+        degrade, scale = filters["DegradeFactor"], filters["ScaleFactor"]
+        if degrade or scale:
+            operations, applied = [], []
+            if degrade:
+                operations.append("Degraded through resizing by a factor of {!s}".format(degrade))
+                applied.append(("DegradeFactor", degrade))
+            if scale:
+                operations.append("Resized by a factor of {!s}".format(scale))
+                applied.append(("ScaleFactor", scale))
+            ops.append((_resize_op(degrade, scale), tuple(operations), tuple(applied)))
+        self.ops = tuple(ops)
+        self.quality = max(0, min(int(filters["CompressionFactor"]), 100))
+        self.encode_params = (int(cv2.IMWRITE_JPEG_QUALITY), self.quality)
+        self.compression_operation = "Compressed with JPEG quality level {!s}".format(filters["CompressionFactor"])
+        # A per frame byte budget, either given directly or derived from the target bitrate (in bits per second).
+        self.target_bytes = filters["TargetFrameBytes"]
+        if not self.target_bytes and filters["TargetBitrate"]:
+            self.target_bytes = max(1, int(filters["TargetBitrate"] / 8.0 / (filters["FrameRate"] or 30.0)))
+        # The quality chosen for the previous frame of each stream, used to seed the search for the next one.
+        self._last_quality = collections.OrderedDict()
+        self.max_streams = max_streams
+        self._quality_lock = threading.Lock()
+        self.passthrough = not self.ops and not self.target_bytes and self.quality >= 100
+        self.reduce = 1
+        if (degrade or scale) and len(self.ops) == 1:
+            shrink = degrade if degrade else 1.0 / scale
+            self.reduce = max([r for r in REDUCED_DECODE_FLAGS if r <= shrink], default=1)
+
+    def last_quality(self, stream=None):
+        """Returns the JPEG quality chosen for the last frame of 'stream' (the starting quality if there is none)."""
+        with self._quality_lock:
+            return self._last_quality.get(stream, max(self.quality, MIN_JPEG_QUALITY))
+
+    def forget(self, stream):
+        """Drops the quality remembered for 'stream'."""
+        with self._quality_lock:
+            self._last_quality.pop(stream, None)
+
+    def _remember(self, stream, quality):
+        with self._quality_lock:
+            self._last_quality[stream] = quality
+            self._last_quality.move_to_end(stream)
+            while len(self._last_quality) > self.max_streams:
+                self._last_quality.popitem(last=False)
+
+    def apply_jpeg(self, jpeg, handler, stream=None):
+        """Applies the filters to an encoded frame of 'stream' and returns the filtered frame."""
+        if self.passthrough:
+            handler.add_operation("Passed through without re-encoding")
+            return jpeg
+        size = jpeg_size(jpeg) if self.reduce > 1 else None
+        if size:
+            return self.apply(decode_jpeg(jpeg, self.reduce), handler, size=size, stream=stream)
+        return self.apply(decode_jpeg(jpeg), handler, stream=stream)
+
+    def apply(self, frame, handler, size=None, stream=None):
+        """
+        Applies the filters to a decoded frame of 'stream' and returns the filtered frame. 'size' is given when the
+        frame was decoded at a reduced size (only if `reduce` is greater than 1), and is the size of the original frame.
+        """
+        for func, operations, applied in self.ops:
+            frame = func(frame) if size is None else func(frame, size)
+            for operation in operations:
+                handler.add_operation(operation)
+            for name, value in applied:
+                handler.add_filter(name, value)
+        if not self.target_bytes:
+            handler.add_operation(self.compression_operation)
+            return cv2.imencode(".jpeg", frame, self.encode_params)[1].tobytes()
+        return self._encode_to_target(frame, handler, stream)
+
+    def _encode_to_target(self, frame, handler, stream):
+        def encode(quality):
+            return cv2.imencode(".jpeg", frame, (int(cv2.IMWRITE_JPEG_QUALITY), quality))[1].tobytes()
+        quality, jpeg = fit_jpeg_quality(encode, self.target_bytes, self.last_quality(stream),
+                                         max_quality=max(self.quality, MIN_JPEG_QUALITY))
+        self._remember(stream, quality)
+        handler.add_operation("Compressed with JPEG quality level {!s} to fit {!s} bytes".format(
+            quality, self.target_bytes))
+        handler.add_filter("TargetFrameBytes", self.target_bytes)
+        handler.add_filter("JPEGQuality", quality)
+        handler.add_filter("FrameBytes", len(jpeg))
+        return jpeg
+
 
 class FrameFilter:
-    def __init__(self, filter_map=default_filter_map):
+    """
+    Applies the configured filters to frames.
+
+    The settings are compiled into a FilterPipeline. `update` builds a new pipeline and swaps it in with a single
+    assignment, so `filter` (which may run on many threads at once) always sees a complete set of settings without
+    taking a lock.
+
+    Frames are encoded at the fixed JPEG quality "CompressionFactor" unless a byte budget is set, either per frame
+    ("TargetFrameBytes") or as a bitrate in bits per second ("TargetBitrate", spread over "FrameRate" frames per
+    second). The highest quality (up to "CompressionFactor") which fits the budget is then chosen for each frame and
+    reported in the "JPEGQuality" and "FrameBytes" filters.
+
+    If 'num_threads' is greater than one, the blurs of frames with at least 'tile_min_pixels' pixels are split into
+    that many tiles and run on a thread pool of that size (or on 'executor' if given). The output is identical to
+    filtering on a single thread.
+    """
+
+    def __init__(self, filter_map=None, num_threads=1, tile_min_pixels=DEFAULT_TILE_MIN_PIXELS, executor=None):
         # TODO Update to include min/max values. JSON Schema?
-        self.filters = default_filter_map
+        filters = dict(default_filter_map)
+        self.num_threads = num_threads
+        self.tile_min_pixels = tile_min_pixels
+        if executor is None and num_threads > 1:
+            executor = futures.ThreadPoolExecutor(max_workers=num_threads)
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._state = (filters, self._compile(filters))
+        if filter_map:
+            self.update(filter_map)
+
+    @property
+    def filters(self):
+        """The current filter settings (a copy)."""
+        return dict(self._state[0])
+
+    @property
+    def pipeline(self):
+        return self._state[1]
+
+    def _compile(self, filters):
+        return FilterPipeline(filters, executor=self.executor, tiles=self.num_threads,
+                              tile_min_pixels=self.tile_min_pixels)
 
     def update(self, new_filters):
-        # self.filters.update(new_filters)
-        if new_filters.get("GaussianBlur"):
-            self.filters["GaussianBlur"] = bool(new_filters.get("GaussianBlur").lower() == "true")
-        if new_filters.get("MedianBlur"):
-            self.filters["MedianBlur"] = bool(new_filters.get("MedianBlur").lower() == "true")
-        if new_filters.get("BilateralBlur"):
-            self.filters["BilateralBlur"] = bool(new_filters.get("BilateralBlur").lower() == "true")
-
-        if new_filters.get("DegradeFactor"):
-            self.filters["DegradeFactor"] = int(new_filters.get("DegradeFactor"))
-            if self.filters["DegradeFactor"] <= 0:
-                self.filters["DegradeFactor"] = None
-
-        if new_filters.get("ScaleFactor"):
-            self.filters["ScaleFactor"] = float(new_filters.get("ScaleFactor"))
-            if self.filters["ScaleFactor"] <= 0:
-                self.filters["ScaleFactor"] = None
-
-        logger.info(self.filters)
-
-    def filter(self, frame, handler):
-        """Applies filters to the input frame and returns the filtered frame."""
-        logger.info(self.filters)
-        if self.filters.get("GaussianBlur"):
-            self.filters["GaussianBlur"] = bool(self.filters.get("GaussianBlur"))
-            if self.filters.get("GaussianBlur"):
-                frame = cv2.GaussianBlur(frame, (15, 15), 0)
-                handler.add_operation("Gaussian blur")
-                handler.add_filter("GaussianBlur", self.filters.get("GaussianBlur"))
-        if self.filters.get("MedianBlur"):
-            self.filters["MedianBlur"] = bool(self.filters.get("MedianBlur"))
-            if self.filters.get("MedianBlur"):
-                frame = cv2.medianBlur(frame, 15)
-                handler.add_operation("Median blur")
-                handler.add_filter("MedianBlur", self.filters.get("MedianBlur"))
-        if self.filters.get("BilateralBlur"):
-            self.filters["BilateralBlur"] = bool(self.filters.get("BilateralBlur"))
-            if self.filters.get("BilateralBlur"):
-                frame = cv2.bilateralFilter(frame, 15, 75, 75)
-                handler.add_operation("Bilateral blur")
-                handler.add_filter("BilateralBlur", self.filters.get("BilateralBlur"))
-
-        size = (frame.shape[1], frame.shape[0])
-        if self.filters.get("DegradeFactor"):
-            size_adj = (int(frame.shape[1]/int(self.filters.get("DegradeFactor"))), int(frame.shape[0]/int(self.filters.get("DegradeFactor"))))
-            logger.info(size_adj)
-            frame = cv2.resize(frame, size_adj)
-            frame = cv2.resize(frame, size)
-            handler.add_operation("Degraded through resizing by a factor of {!s}".format(self.filters.get("DegradeFactor")))
-            handler.add_filter("DegradeFactor", self.filters.get("DegradeFactor"))
-        if self.filters.get("ScaleFactor"):
-            scale_adj = (int(frame.shape[1]*float(self.filters.get("ScaleFactor"))), int(frame.shape[0]*float(self.filters.get("ScaleFactor"))))
-            frame = cv2.resize(frame, scale_adj)
-            handler.add_operation("Resized by a factor of {!s}".format(self.filters.get("ScaleFactor")))
-            handler.add_filter("ScaleFactor", self.filters.get("ScaleFactor"))
-
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), max(0, min(int(self.filters.get("CompressionFactor")), 100))]
-        handler.add_operation("Compressed with JPEG quality level {!s}".format(self.filters.get("CompressionFactor")))
-
-        return cv2.imencode(".jpeg", frame, encode_param)[1].tostring()
+        with self._lock:
+            filters = dict(self._state[0])
+            for name in ("GaussianBlur", "MedianBlur", "BilateralBlur"):
+                if name in new_filters:
+                    filters[name] = _parse_bool(new_filters[name])
+            if new_filters.get("DegradeFactor") not in (None, ""):
+                filters["DegradeFactor"] = _parse_factor(new_filters["DegradeFactor"], int)
+            if new_filters.get("ScaleFactor") not in (None, ""):
+                filters["ScaleFactor"] = _parse_factor(new_filters["ScaleFactor"], float)
+            if new_filters.get("CompressionFactor") not in (None, ""):
+                filters["CompressionFactor"] = int(new_filters["CompressionFactor"])
+            if new_filters.get("TargetFrameBytes") not in (None, ""):
+                filters["TargetFrameBytes"] = _parse_factor(new_filters["TargetFrameBytes"], int)
+            if new_filters.get("TargetBitrate") not in (None, ""):
+                filters["TargetBitrate"] = _parse_factor(new_filters["TargetBitrate"], float)
+            if new_filters.get("FrameRate") not in (None, ""):
+                filters["FrameRate"] = _parse_factor(new_filters["FrameRate"], float)
+            self._state = (filters, self._compile(filters))
+        logger.info("Updated filters: {!s}".format(filters))
+
+    def filter(self, frame, handler, stream=None):
+        """Applies filters to the input frame of 'stream' and returns the filtered frame."""
+        return self._state[1].apply(frame, handler, stream=stream)
+
+    def filter_jpeg(self, jpeg, handler, stream=None):
+        """Applies filters to the encoded input frame and returns the filtered frame (see `FilterPipeline.apply_jpeg`)."""
+        return self._state[1].apply_jpeg(jpeg, handler, stream=stream)
+
+
+class FilterProfiles:
+    """
+    Filter settings per session, so a single filter service can apply different filters to many streams at once.
+
+    Each session's settings are compiled into their own FrameFilter (starting from the default settings) when they are
+    updated, so looking up the filter for a frame is a dictionary lookup. Frames of sessions without a profile use the
+    'default' FrameFilter. Every profile shares the default's thread pool.
+    """
+
+    def __init__(self, default=None):
+        self.default = default or FrameFilter()
+        self.profiles = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id=None):
+        """Returns the FrameFilter for 'session_id'."""
+        if not session_id:
+            return self.default
+        return self.profiles.get(session_id, self.default)
+
+    def update(self, new_filters, session_id=None):
+        """Updates the filters of 'session_id' (or the default filters if not given) and returns its FrameFilter."""
+        if not session_id:
+            self.default.update(new_filters)
+            return self.default
+        with self._lock:
+            profile = self.profiles.get(session_id)
+            if profile is None:
+                profile = FrameFilter(self.default.filters, num_threads=self.default.num_threads,
+                                      tile_min_pixels=self.default.tile_min_pixels, executor=self.default.executor)
+            profile.update(new_filters)
+            self.profiles[session_id] = profile
+        return profile
+
+    def remove(self, session_id):
+        """
+        Removes the profile of 'session_id', whose frames are then filtered with the default filters, and forgets the
+        state kept for the session (whether or not it had a profile). Call it when a session ends. Returns True if the
+        session had a profile.
+        """
+        self.default.pipeline.forget(session_id)
+        with self._lock:
+            profile = self.profiles.pop(session_id, None)
+        if profile is None:
+            return False
+        profile.pipeline.forget(session_id)
+        return True
+
+    def filters(self):
+        """Returns the settings of the default filter and of each profile."""
+        return {"default": self.default.filters,
+                "profiles": {session_id: profile.filters for session_id, profile in list(self.profiles.items())}}
+
+    def filter(self, frame, handler, session_id=None):
+        return self.get(session_id).filter(frame, handler, stream=session_id)
+
+    def filter_jpeg(self, jpeg, handler, session_id=None):
+        return self.get(session_id).filter_jpeg(jpeg, handler, stream=session_id)
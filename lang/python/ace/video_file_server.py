@@ -15,6 +15,7 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
 import cv2
+import numpy as np
 
 
 class CamHandler(BaseHTTPRequestHandler):
@@ -42,19 +43,19 @@ class CamHandler(BaseHTTPRequestHandler):
             self.send_response(http.HTTPStatus.OK)
             self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=--jpgboundary')
             self.end_headers()
+            last = None
             while True:
                 try:
-                    img = self.server.read_frame()
-                    retval, jpg = cv2.imencode('.jpg', img)
-                    if not retval:
-                        raise RuntimeError('Could not encode img to JPEG')
-                    jpg_bytes = jpg.tobytes()
+                    last, jpg_bytes = self.server.next_jpeg(last)
+                    if jpg_bytes is None:
+                        continue
                     self.wfile.write("--jpgboundary\r\n".encode())
                     self.send_header('Content-type', 'image/jpeg')
                     self.send_header('Content-length', len(jpg_bytes))
                     self.end_headers()
                     self.wfile.write(jpg_bytes)
-                    time.sleep(self.server.read_delay)
+                    if self.server.read_delay:
+                        time.sleep(self.server.read_delay)
 
                 except (IOError, ConnectionError):
                     break
@@ -104,6 +105,14 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
                     return img
         return img
 
+    def next_jpeg(self, last):
+        """Returns the next frame to send to a client as a JPEG (each client reads its own frames from the video)."""
+        img = self.read_frame()
+        retval, jpg = cv2.imencode('.jpg', img)
+        if not retval:
+            raise RuntimeError('Could not encode img to JPEG')
+        return None, jpg.tobytes()
+
     def serve_forever(self, poll_interval=0.5):
         self.open_video()
         try:
@@ -117,6 +126,158 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 
 
 
+class LatestFrame:
+    """
+    Holds the most recent JPEG of a stream for any number of readers, each of which waits for the next frame. Once the
+    stream has ended (see `close`), readers no longer wait.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.jpeg = None
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def put(self, jpeg):
+        with self._cond:
+            self.seq += 1
+            self.jpeg = jpeg
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait(self, last=None, timeout=None):
+        """
+        Returns the sequence number and JPEG of the first frame newer than 'last', or ('last', None) if no new frame
+        arrives within 'timeout' seconds (or the stream has ended). Readers which fall behind skip straight to the
+        latest frame.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq != (last or 0) or self.closed, timeout):
+                return last, None
+            if self.seq == (last or 0):
+                return last, None
+            return self.seq, self.jpeg
+
+
+class FilterRecord:
+    """Collects the operations and filters reported by FrameFilter for a frame."""
+
+    def __init__(self):
+        self.operations = []
+        self.filters = {}
+
+    def add_operation(self, operation):
+        self.operations.append(operation)
+
+    def add_filter(self, f, value):
+        self.filters[f] = str(value)
+
+
+class FilteredStreamServer(ThreadingMixIn, HTTPServer):
+    """
+    Reads frames from 'capture_path', applies 'frame_filter' to each frame once and serves the filtered stream as an
+    MJPEG on "/cam.mjpg" to any number of clients. Every client receives the latest filtered frame, so a slow client
+    skips frames rather than delaying the others. If 'fps' is given, reading is paced to that rate (for video files).
+
+    `start_capture` (called by `serve_forever` if it has not been already) raises IOError if the source can't be
+    opened. Clients are disconnected once the source ends.
+    """
+    daemon_threads = True
+
+    def __init__(self, capture_path, frame_filter, server_address=("0.0.0.0", 6420), loop_play=True, fps=None,
+                 RequestHandlerClass=CamHandler, bind_and_activate=True):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+        try:
+            # verifies whether is a webcam
+            capture_path = int(capture_path)
+        except (TypeError, ValueError):
+            pass
+        self._capture_path = capture_path
+        self.frame_filter = frame_filter
+        self.loop_play = loop_play
+        self.fps = fps
+        self.read_delay = 0
+        self.latest = LatestFrame()
+        self.last_record = None
+        self.frames_filtered = 0
+        self._running = threading.Event()
+        self._thread = None
+
+    def next_jpeg(self, last):
+        last, jpeg = self.latest.wait(last, timeout=1.0)
+        if jpeg is None and self.latest.closed:
+            raise IOError("Video {!s} has ended".format(self._capture_path))
+        return last, jpeg
+
+    def start_capture(self):
+        """Opens the source and starts filtering its frames on a background thread."""
+        camera = cv2.VideoCapture(self._capture_path)
+        if not camera.isOpened():
+            raise IOError('Could not open video {}'.format(self._capture_path))
+        self._running.set()
+        self._thread = threading.Thread(target=self._capture, args=(camera,), daemon=True)
+        self._thread.start()
+
+    def _capture(self, camera):
+        next_time = time.time()
+        try:
+            while self._running.is_set():
+                retval, img = camera.read()
+                if not retval:
+                    if not self.loop_play or not camera.open(self._capture_path):
+                        break
+                    continue
+                record = FilterRecord()
+                self.latest.put(self.frame_filter.filter(img, record))
+                self.last_record = record
+                self.frames_filtered += 1
+                if self.fps:
+                    next_time += 1. / self.fps
+                    time.sleep(max(0, next_time - time.time()))
+        finally:
+            camera.release()
+            self.latest.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        if self._thread is None:
+            self.start_capture()
+        try:
+            super().serve_forever(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._running.clear()
+
+
+class FilteredCapture:
+    """
+    A capture-like reader (see cv2.VideoCapture) of the frames in a LatestFrame, used to serve a filtered stream over
+    RTSP. Frames are decoded and resized to 'width' x 'height'. Like cv2.VideoCapture, `read` returns (False, None)
+    once the stream has ended, or if no frame arrives within 'timeout' seconds (if given).
+    """
+
+    def __init__(self, latest, width=640, height=480):
+        self.latest = latest
+        self.size = (width, height)
+        self._last = None
+
+    def isOpened(self):
+        return not self.latest.closed
+
+    def read(self, timeout=None):
+        self._last, jpeg = self.latest.wait(self._last, timeout)
+        if jpeg is None:
+            return False, None
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size)
+        return True, frame
+
+
 class VideoFileServer(ThreadedHTTPServer):
     def __init__(self, video_path:str, address:str = "0.0.0.0", port: int = 6420, loop: bool = True, fps: int =30):
         ThreadedHTTPServer.__init__(self, video_path, (address, port), loop, CamHandler, fps)
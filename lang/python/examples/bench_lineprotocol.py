@@ -0,0 +1,72 @@
+"""
+Compares the per-frame cost of serializing analytic results for InfluxDB through the dictionary path
+(`AceDB.json_from_resp`, then the influx client's own line protocol conversion) with `ace.lineprotocol`.
+
+Usage: python bench_lineprotocol.py [--frames 2000] [--rois 10]
+"""
+import argparse
+import time
+
+from influxdb.line_protocol import make_lines
+
+from ace import analytic_pb2, lineprotocol
+from ace.aceclient import AceDB
+
+
+def build_frame(frame_num, rois):
+    resp = analytic_pb2.ProcessedFrame(session_id="f3a1c2d4")
+    resp.analytic.name = "object_detector"
+    resp.analytic.addr = "object_detector:50051"
+    resp.analytic.filters["resize"] = "0.5"
+    resp.frame.frame_num = frame_num
+    resp.frame.timestamp = frame_num / 30.0
+    resp.frame.frame_byte_size = 150000
+    resp.data.start_time_millis = 1600000000000 + frame_num
+    resp.data.end_time_millis = 1600000000025 + frame_num
+    resp.data.stream_addr = "rtsp://camera:8554/stream"
+    for i in range(rois):
+        roi = resp.data.roi.add()
+        roi.classification = "person" if i % 2 else "traffic light"
+        roi.confidence = 0.5 + i / (2.0 * rois)
+        roi.box.corner1.x, roi.box.corner1.y = 10 * i, 20 * i
+        roi.box.corner2.x, roi.box.corner2.y = 10 * i + 50, 20 * i + 100
+    return resp
+
+
+def run(name, serialize, frames):
+    start = time.perf_counter()
+    payload = serialize(frames)
+    elapsed = time.perf_counter() - start
+    print("{:<14s} {:8.1f} us/frame  {:8.1f} frames/s  ({:d} bytes)".format(
+        name, 1e6 * elapsed / len(frames), len(frames) / elapsed, len(payload)))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=2000, help="Number of frames to serialize.")
+    parser.add_argument("--rois", type=int, default=10, help="Number of regions of interest per frame.")
+    args = parser.parse_args()
+
+    db = AceDB(batch_size=0)
+    frames = [build_frame(i, args.rois) for i in range(args.frames)]
+
+    def dict_path(frames):
+        points = []
+        for resp in frames:
+            points.extend(db.json_from_resp(resp))
+        return make_lines({"points": points}).encode("utf-8")
+
+    def line_path(frames):
+        return lineprotocol.dumps(frames).encode("utf-8")
+
+    # Warm up both paths before timing.
+    dict_path(frames[:100])
+    line_path(frames[:100])
+    dict_time = run("dict", dict_path, frames)
+    line_time = run("line protocol", line_path, frames)
+    print("speedup: {:.1f}x".format(dict_time / line_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,9 @@ setup(name=pkg_name,
           'kafka-python>=2.0.0',
           'asyncio-nats-client'
             ],
+        extras_require={
+          'parquet': ['pyarrow>=1.0.0'],
+            },
         data_files=list(iter_protos(pkg_name)),
         py_modules = [
             'ace.analytic_pb2',